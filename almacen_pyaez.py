@@ -0,0 +1,327 @@
+"""
+ALMACÉN GLOBAL PyAEZ: CONSULTA POR SMU SIN ACCEDER A HWSD2.db
+==============================================================
+
+El extractor (eswatini_pyaez_suelos.py) consolida HWSD2_LAYERS en cada
+consulta. Para un servicio interactivo (el usuario elige un área y espera los
+parámetros de suelo al instante) eso es demasiado lento. Este módulo separa
+la consolidación de la consulta:
+
+1. construir_almacen consolida todos los SMU de HWSD2 una sola vez (por
+   bloques, con iterar_pyaez_por_bloques) y escribe un arreglo .npy por capa
+   y variable, alineado con un índice ordenado de HWSD2_SMU_ID
+2. AlmacenPyAEZ abre esos arreglos mapeados en memoria y responde cada
+   consulta con una búsqueda binaria (np.searchsorted) sobre el índice y una
+   lectura indexada de cada columna: sin SQLite, sin consolidación
+
+ESTRUCTURA:
+-----------
+    <directorio>/metadatos.json     capas, tipos, leyendas, huella de HWSD2.db
+    <directorio>/CODE.npy           int32, HWSD2_SMU_ID ordenados (el índice)
+    <directorio>/D1/presente.npy    bool, el SMU tiene registro válido en D1
+    <directorio>/D1/OC.npy          float64, mismo tipo que TIPOS_PYAEZ
+    <directorio>/D1/TXT.npy         int16, código de categoría (-1 = sin dato)
+    ...
+
+Las variables de texto (TXT, SPR, SPH, DRG) se guardan con los códigos de la
+categórica de pandas; metadatos.json['leyendas'] guarda sus categorías, así
+que la consulta las reconstruye sin traducir valores. metadatos.json se
+escribe al final: un almacén sin ese archivo está incompleto.
+
+USO:
+----
+    python almacen_pyaez.py almacen/ --construir --db HWSD2.db
+    python almacen_pyaez.py almacen/ --ids 7001 18372 --capas D1 D2 --salida consulta.csv
+"""
+
+import argparse
+import json
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import eswatini_pyaez_suelos as extractor
+
+# Versión del formato en disco; AlmacenPyAEZ rechaza almacenes de otra versión
+VERSION_ALMACEN = 1
+
+METADATOS = 'metadatos.json'
+INDICE = 'CODE.npy'
+PRESENTE = 'presente.npy'
+
+# Variables PyAEZ de cada capa (CODE es el índice, LAYER la carpeta)
+VARIABLES_ALMACEN = [v for v in extractor.COLUMNAS_PYAEZ if v not in ('CODE', 'LAYER')]
+
+# Tipo en disco de los códigos de las variables de texto (-1 = sin dato)
+TIPO_CODIGOS = np.int16
+
+def _tipo_en_disco(variable):
+    tipo = extractor.TIPOS_PYAEZ[variable]
+    return TIPO_CODIGOS if tipo == 'category' else np.dtype(tipo)
+
+# ============================================================================
+# SECCIÓN 1: CONSTRUCCIÓN
+# ============================================================================
+
+def consolidar_todo(db, smu_ids=None, capas=None, tamano_bloque=extractor.TAMANO_BLOQUE, reglas=None,
+                    verbose=True):
+    """
+    Consolida (por bloques) los SMU de HWSD2 en un DataFrame PyAEZ multicapa tipado
+
+    Parámetros:
+    - db: Ruta a HWSD2.db o conexión sqlite3 abierta
+    - smu_ids: Lista de HWSD2_SMU_ID (None = toda la base de datos)
+    - capas: Capas a consolidar (por defecto CAPAS, D1-D7)
+    - tamano_bloque, reglas: Ver extractor.extraer_pyaez_por_bloques
+    """
+    conn = extractor.conectar_solo_lectura(db) if not isinstance(db, sqlite3.Connection) else db
+    try:
+        bloques = []
+        for df_bloque in extractor.iterar_pyaez_por_bloques(conn, smu_ids, capas, tamano_bloque,
+                                                            reglas=reglas):
+            bloques.append(df_bloque)
+            if verbose:
+                print(f"  - Bloque {len(bloques)}: {df_bloque['CODE'].nunique()} SMU, "
+                      f"{len(df_bloque)} registros")
+    finally:
+        if conn is not db:
+            conn.close()
+
+    if not bloques:
+        raise ValueError("No hay datos válidos para ninguna capa de los IDs solicitados")
+    return extractor.concatenar_pyaez(bloques)
+
+def escribir_almacen(df_multicapa, directorio, **origen):
+    """
+    Escribe un DataFrame PyAEZ multicapa tipado como almacén de arreglos .npy
+
+    Cada arreglo tiene una posición por SMU del índice (CODE.npy, ordenado);
+    los SMU sin registro en una capa quedan con presente = False. origen se
+    guarda tal cual en metadatos.json (huella de la base, reglas, ...).
+
+    Retorna:
+    - dict de metadatos (también guardado en metadatos.json)
+    """
+    directorio = Path(directorio)
+    directorio.mkdir(parents=True, exist_ok=True)
+    # Un almacén a medio reescribir no debe parecer completo
+    (directorio / METADATOS).unlink(missing_ok=True)
+
+    df_multicapa = extractor.tipar_pyaez(df_multicapa)
+    ids = np.unique(df_multicapa['CODE'].to_numpy()).astype(np.int32)
+    np.save(directorio / INDICE, ids)
+
+    leyendas = {}
+    for variable in VARIABLES_ALMACEN:
+        if extractor.TIPOS_PYAEZ[variable] == 'category':
+            leyendas[variable] = [str(v) for v in df_multicapa[variable].cat.categories]
+
+    capas = [capa for capa in extractor.CAPAS if capa in set(df_multicapa['LAYER'].astype(str))]
+    for capa, df_capa in df_multicapa.groupby('LAYER', sort=False, observed=True):
+        carpeta = directorio / str(capa)
+        carpeta.mkdir(exist_ok=True)
+        posiciones = np.searchsorted(ids, df_capa['CODE'].to_numpy())
+
+        presente = np.zeros(len(ids), dtype=bool)
+        presente[posiciones] = True
+        np.save(carpeta / PRESENTE, presente)
+
+        for variable in VARIABLES_ALMACEN:
+            serie = df_capa[variable]
+            if variable in leyendas:
+                columna = np.full(len(ids), -1, dtype=TIPO_CODIGOS)
+                columna[posiciones] = serie.cat.codes.to_numpy()
+            else:
+                columna = np.zeros(len(ids), dtype=_tipo_en_disco(variable))
+                columna[posiciones] = serie.to_numpy()
+            np.save(carpeta / f"{variable}.npy", columna)
+
+    metadatos = {
+        'version': VERSION_ALMACEN,
+        'capas': capas,
+        'smu': len(ids),
+        'registros': len(df_multicapa),
+        'variables': {variable: extractor.TIPOS_PYAEZ[variable] for variable in VARIABLES_ALMACEN},
+        'leyendas': leyendas,
+        **origen,
+    }
+    with open(directorio / METADATOS, 'w', encoding='utf-8') as f:
+        json.dump(metadatos, f, indent=2, ensure_ascii=False)
+    return metadatos
+
+def construir_almacen(db, directorio, smu_ids=None, capas=None, tamano_bloque=extractor.TAMANO_BLOQUE,
+                      reglas=None, verbose=True):
+    """
+    Consolida HWSD2 una sola vez y lo guarda como almacén consultable
+
+    Parámetros:
+    - db: Ruta a HWSD2.db o conexión sqlite3 abierta
+    - directorio: Carpeta del almacén (se sobrescribe)
+    - smu_ids: Lista de HWSD2_SMU_ID (None = toda la base de datos)
+    - capas: Capas a guardar (por defecto CAPAS, D1-D7)
+    - tamano_bloque: Filas de HWSD2_LAYERS leídas a la vez (memoria acotada en la lectura)
+    - reglas: Reglas de validación (ver extractor.validar_registros)
+
+    Retorna:
+    - dict de metadatos
+    """
+    if verbose:
+        print("="*80)
+        print(f"CONSTRUYENDO ALMACÉN PyAEZ EN {directorio}")
+        print("="*80)
+
+    df_multicapa = consolidar_todo(db, smu_ids, capas, tamano_bloque, reglas=reglas, verbose=verbose)
+    origen = {
+        'huella_bd': None if isinstance(db, sqlite3.Connection) else extractor.huella_bd(db),
+        'huella_reglas': extractor.huella_reglas(reglas),
+    }
+    metadatos = escribir_almacen(df_multicapa, directorio, **origen)
+
+    if verbose:
+        print(f"✓ Guardado: {directorio} ({metadatos['smu']} SMU, {len(metadatos['capas'])} capas, "
+              f"{metadatos['registros']} registros)")
+    return metadatos
+
+# ============================================================================
+# SECCIÓN 2: CONSULTA
+# ============================================================================
+
+class AlmacenPyAEZ:
+    """
+    Almacén generado por construir_almacen, abierto en solo lectura
+
+    Los arreglos se abren mapeados en memoria la primera vez que se consultan
+    (np.load(mmap_mode='r')): abrir el almacén no lee las columnas, y una
+    consulta solo toca las páginas de los SMU pedidos.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = Path(directorio)
+        ruta = self.directorio / METADATOS
+        if not ruta.exists():
+            raise FileNotFoundError(f"{self.directorio} no es un almacén PyAEZ completo (falta {METADATOS})")
+        with open(ruta, encoding='utf-8') as f:
+            self.metadatos = json.load(f)
+        if self.metadatos.get('version') != VERSION_ALMACEN:
+            raise ValueError(f"Versión de almacén {self.metadatos.get('version')} no soportada "
+                             f"(se esperaba {VERSION_ALMACEN}); reconstruya con --construir")
+
+        self.capas = self.metadatos['capas']
+        self.ids = np.load(self.directorio / INDICE, mmap_mode='r')
+        self._categorias = {variable: pd.CategoricalDtype(categorias)
+                            for variable, categorias in self.metadatos['leyendas'].items()}
+        self._columnas = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _columna(self, capa, variable):
+        clave = (capa, variable)
+        if clave not in self._columnas:
+            self._columnas[clave] = np.load(self.directorio / capa / f"{variable}.npy", mmap_mode='r')
+        return self._columnas[clave]
+
+    def posiciones(self, smu_ids):
+        """
+        Posiciones en el índice de los SMU pedidos (búsqueda binaria)
+
+        Retorna:
+        - ndarray de posiciones de los SMU presentes en el almacén, ordenadas
+          por HWSD2_SMU_ID y sin repetidos
+        """
+        smu_ids = np.unique(np.asarray(smu_ids, dtype=np.int64))
+        posiciones = np.searchsorted(self.ids, smu_ids)
+        dentro = posiciones < len(self.ids)
+        posiciones = posiciones[dentro]
+        return posiciones[self.ids[posiciones] == smu_ids[dentro]]
+
+    def consultar_capa(self, capa, smu_ids, variables=None):
+        """
+        Registros PyAEZ tipados de una capa para los SMU pedidos
+
+        Mismo formato que un DataFrame de extraer_pyaez (ordenado por CODE,
+        sin LAYER); los SMU ausentes o sin registro válido en la capa se
+        omiten. Las categóricas usan las categorías de todo el almacén.
+        """
+        if capa not in self.capas:
+            raise KeyError(f"Capa {capa!r} no está en el almacén (capas: {', '.join(self.capas)})")
+        variables = VARIABLES_ALMACEN if variables is None else list(variables)
+
+        posiciones = self.posiciones(smu_ids)
+        posiciones = posiciones[self._columna(capa, 'presente')[posiciones]]
+
+        datos = {'CODE': self.ids[posiciones]}
+        for variable in variables:
+            valores = self._columna(capa, variable)[posiciones]
+            if variable in self._categorias:
+                valores = pd.Categorical.from_codes(valores, dtype=self._categorias[variable])
+            datos[variable] = valores
+        return pd.DataFrame(datos)
+
+    def consultar(self, smu_ids, capas=None, variables=None):
+        """
+        Registros PyAEZ de los SMU pedidos, con el contrato de extraer_pyaez
+
+        Retorna:
+        - dict capa → DataFrame PyAEZ tipado (solo capas con registros)
+        """
+        capas = self.capas if capas is None else [capa for capa in capas if capa in self.capas]
+        resultados = {capa: self.consultar_capa(capa, smu_ids, variables) for capa in capas}
+        return {capa: df for capa, df in resultados.items() if len(df) > 0}
+
+    def vigente(self, db_path, reglas=None):
+        """
+        True si el almacén se construyó con esta HWSD2.db y estas reglas
+
+        Compara la huella de la base (tamaño + fecha, ver extractor.huella_bd)
+        y la de las reglas (extractor.huella_reglas; None = reglas por defecto).
+        """
+        return (self.metadatos.get('huella_bd') == extractor.huella_bd(db_path)
+                and self.metadatos.get('huella_reglas') == extractor.huella_reglas(reglas))
+
+# ============================================================================
+# LÍNEA DE COMANDOS
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Almacén global PyAEZ precalculado: construcción desde HWSD2 y consulta por SMU")
+    parser.add_argument('almacen', help="Carpeta del almacén")
+    parser.add_argument('--construir', action='store_true',
+                        help="Consolida --db (por defecto todos los SMU) y escribe el almacén")
+    parser.add_argument('--db', default='HWSD2.db', help="Base de datos SQLite HWSD v2.0 (por defecto: HWSD2.db)")
+    parser.add_argument('--ids', type=int, nargs='+',
+                        help="HWSD2_SMU_ID a consultar (con --construir: a incluir; por defecto todos)")
+    parser.add_argument('--capas', nargs='+', choices=extractor.CAPAS)
+    parser.add_argument('--bloque', type=int, default=extractor.TAMANO_BLOQUE, metavar='FILAS',
+                        help=f"Con --construir, filas de HWSD2_LAYERS por bloque "
+                             f"(por defecto: {extractor.TAMANO_BLOQUE})")
+    parser.add_argument('--salida', help="Archivo de la consulta (por defecto se imprime)")
+    parser.add_argument('--formato', choices=extractor.FORMATOS_SALIDA,
+                        help="Formato de salida (por defecto: según la extensión de --salida)")
+    parser.add_argument('--silencioso', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.construir:
+        construir_almacen(args.db, args.almacen, args.ids, args.capas, args.bloque,
+                          verbose=not args.silencioso)
+        return
+    if not args.ids:
+        parser.error("--ids es obligatorio al consultar (o use --construir)")
+
+    almacen = AlmacenPyAEZ(args.almacen)
+    resultados = almacen.consultar(args.ids, args.capas)
+    if not resultados:
+        parser.error(f"El almacén no tiene registros para los IDs solicitados ({len(args.ids)} SMU)")
+    df_multicapa = extractor.combinar_capas(resultados)
+    if args.salida:
+        extractor.guardar_multicapa(df_multicapa, args.salida, formato=args.formato,
+                                    verbose=not args.silencioso)
+    else:
+        print(extractor.exportar_pyaez(df_multicapa).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
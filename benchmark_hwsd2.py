@@ -0,0 +1,414 @@
+"""
+BENCHMARKS DEL EXTRACTOR HWSD2 → PyAEZ
+======================================
+
+Mide el costo de las etapas del extractor (eswatini_pyaez_suelos.py) para
+detectar regresiones antes de usar una optimización en producción.
+
+La base HWSD2.db real es grande y no forma parte del repositorio, así que
+generar_bd_sintetica crea una base SQLite con el mismo esquema que consulta
+el extractor (HWSD2_SMU, HWSD2_LAYERS y tablas D_*), con el número de SMU y
+de perfiles por SMU que se quiera. Los valores son aleatorios pero con los
+rangos, códigos y faltantes (NULL, -9) de HWSD2.
+
+USO:
+----
+    python benchmark_hwsd2.py etapas --tamanos 31 1000 100000 1000000
+    python benchmark_hwsd2.py salidas --db HWSD2.db --replicas 100
+    python benchmark_hwsd2.py generar HWSD2_sintetica.db --smu 10000
+"""
+
+import argparse
+import json
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import eswatini_pyaez_suelos as extractor
+
+# ============================================================================
+# SECCIÓN 1: BASE DE DATOS SINTÉTICA HWSD2
+# ============================================================================
+
+# Profundidades de las capas D1-D7 (cm)
+PROFUNDIDADES = [(0, 20), (20, 40), (40, 60), (60, 80), (80, 100), (100, 150), (150, 200)]
+
+TABLAS_REFERENCIA = {
+    'D_DRAINAGE': (['CODE', 'VALUE', 'SYMBOL'], [
+        (1, 'Very poorly drained', 'VP'), (2, 'Poorly drained', 'P'),
+        (3, 'Imperfectly drained', 'I'), (4, 'Moderately well drained', 'MW'),
+        (5, 'Well drained', 'W'), (6, 'Somewhat excessively drained', 'SE'),
+        (7, 'Excessively drained', 'E'),
+    ]),
+    'D_PHASE': (['CODE', 'VALUE'], list(enumerate([
+        'Stony', 'Lithic', 'Petric', 'Saline', 'Sodic', 'Gelic', 'Duripan', 'Skeletic',
+        'Rudic', 'Phreatic', 'Inundic', 'Yermic', 'Salic', 'Gravelly', 'Fragipan',
+    ], start=1))),
+    'D_ROOTS': (['CODE', 'VALUE'], [
+        (0, 'No information'), (1, '> 80 cm'), (2, '60-80 cm'), (3, '40-60 cm'),
+        (4, '20-40 cm'), (5, '0-80 cm'), (6, '0-20 cm'),
+    ]),
+    'D_TEXTURE_USDA': (['CODE', 'VALUE'], list(enumerate([
+        'clay (heavy)', 'silty clay', 'clay', 'silty clay loam', 'clay loam', 'silt',
+        'silt loam', 'sandy clay', 'loam', 'sandy clay loam', 'sandy loam', 'loamy sand', 'sand',
+    ], start=1))),
+    'D_WRB4': (['CODE', 'VALUE'], [
+        ('VRha', 'Haplic Vertisols'), ('CMvr', 'Vertic Cambisols'), ('LVha', 'Haplic Luvisols'),
+        ('ACha', 'Haplic Acrisols'), ('LPli', 'Lithic Leptosols'), ('FRha', 'Haplic Ferralsols'),
+        ('ARha', 'Haplic Arenosols'), ('LVvr', 'Vertic Luvisols'),
+    ]),
+    'D_WRB2': (['CODE', 'Value'], [
+        ('VR', 'Vertisols'), ('CM', 'Cambisols'), ('LV', 'Luvisols'), ('AC', 'Acrisols'),
+        ('LP', 'Leptosols'), ('FR', 'Ferralsols'), ('AR', 'Arenosols'),
+    ]),
+}
+
+COLUMNAS_CAPAS = [
+    ('ID', 'INTEGER'), ('HWSD2_SMU_ID', 'INTEGER'), ('SEQUENCE', 'INTEGER'), ('SHARE', 'REAL'),
+    ('LAYER', 'TEXT'), ('TOPDEP', 'INTEGER'), ('BOTDEP', 'INTEGER'),
+    ('TEXTURE_USDA', 'INTEGER'), ('ROOT_DEPTH', 'INTEGER'), ('PHASE1', 'INTEGER'), ('PHASE2', 'INTEGER'),
+    ('ROOTS', 'INTEGER'), ('DRAINAGE', 'TEXT'), ('COARSE', 'REAL'), ('SAND', 'REAL'), ('SILT', 'REAL'),
+    ('CLAY', 'REAL'), ('ORG_CARBON', 'REAL'), ('PH_WATER', 'REAL'), ('CEC_SOIL', 'REAL'),
+    ('CEC_CLAY', 'REAL'), ('TEB', 'REAL'), ('BSAT', 'REAL'), ('ESP', 'REAL'), ('TCARBON_EQ', 'REAL'),
+    ('GYPSUM', 'REAL'), ('ELEC_COND', 'REAL'),
+]
+
+def _filas_sql(df):
+    """Filas como tuplas de tipos Python (sqlite3 no acepta escalares numpy)"""
+    df = df.astype(object)
+    return df.where(df.notna(), None).itertuples(index=False, name=None)
+
+def _perfiles_sinteticos(rng, smu_ids, perfiles_por_smu, primer_id):
+    """Genera las filas de HWSD2_LAYERS de un bloque de SMU"""
+    n_perfiles = rng.integers(1, perfiles_por_smu + 1, size=len(smu_ids))
+    smu_perfil = np.repeat(smu_ids, n_perfiles)
+    secuencia = np.concatenate([np.arange(1, n + 1) for n in n_perfiles])
+    share = np.repeat(100.0 / n_perfiles, n_perfiles).round(1)
+
+    # Cada perfil tiene entre 3 y 7 capas (los suelos someros no llegan a D7)
+    n_capas = rng.integers(3, len(PROFUNDIDADES) + 1, size=len(smu_perfil))
+    fila_perfil = np.repeat(np.arange(len(smu_perfil)), n_capas)
+    indice_capa = np.concatenate([np.arange(n) for n in n_capas])
+    n = len(fila_perfil)
+
+    def con_faltantes(valores, fraccion=0.05):
+        valores = valores.astype(float)
+        valores[rng.random(n) < fraccion] = np.nan
+        return valores
+
+    # Atributos del perfil (iguales en todas sus capas)
+    textura = rng.integers(1, 14, size=len(smu_perfil))[fila_perfil]
+    raices = rng.integers(0, 7, size=len(smu_perfil))[fila_perfil]
+    drenaje = np.array(['VP', 'P', 'I', 'MW', 'W', 'SE', 'E'], dtype=object)[
+        rng.integers(0, 7, size=len(smu_perfil))][fila_perfil]
+
+    clay = rng.uniform(5, 60, size=n).round(0)
+    sand = (rng.random(n) * (100 - clay)).round(0)
+    # ORG_CARBON: -9 (sin dato en HWSD2), 0 o un valor real
+    org_carbon = np.where(rng.random(n) < 0.25, rng.choice([-9.0, 0.0], size=n),
+                          rng.uniform(0.05, 5, size=n).round(2))
+
+    return pd.DataFrame({
+        'ID': np.arange(primer_id, primer_id + n),
+        'HWSD2_SMU_ID': smu_perfil[fila_perfil],
+        'SEQUENCE': secuencia[fila_perfil],
+        'SHARE': share[fila_perfil],
+        'LAYER': np.array([f"D{i + 1}" for i in range(len(PROFUNDIDADES))], dtype=object)[indice_capa],
+        'TOPDEP': np.array([p[0] for p in PROFUNDIDADES])[indice_capa],
+        'BOTDEP': np.array([p[1] for p in PROFUNDIDADES])[indice_capa],
+        'TEXTURE_USDA': con_faltantes(textura, 0.02),
+        'ROOT_DEPTH': con_faltantes(rng.choice([30, 60, 100, 150], size=len(smu_perfil))[fila_perfil], 0.02),
+        'PHASE1': con_faltantes(rng.integers(1, 16, size=len(smu_perfil))[fila_perfil], 0.6),
+        'PHASE2': con_faltantes(rng.integers(1, 16, size=len(smu_perfil))[fila_perfil], 0.85),
+        'ROOTS': con_faltantes(raices, 0.02),
+        'DRAINAGE': np.where(rng.random(n) < 0.02, None, drenaje),
+        'COARSE': con_faltantes(rng.uniform(0, 60, size=n).round(0)),
+        'SAND': sand,
+        'SILT': 100 - clay - sand,
+        'CLAY': clay,
+        'ORG_CARBON': org_carbon,
+        'PH_WATER': con_faltantes(rng.uniform(3.5, 10, size=n).round(1)),
+        'CEC_SOIL': con_faltantes(rng.uniform(1, 60, size=n).round(0)),
+        'CEC_CLAY': con_faltantes(rng.uniform(10, 90, size=n).round(0)),
+        'TEB': con_faltantes(rng.uniform(0, 40, size=n).round(1)),
+        'BSAT': rng.uniform(0, 100, size=n).round(0),
+        'ESP': con_faltantes(rng.uniform(0, 30, size=n).round(1)),
+        'TCARBON_EQ': con_faltantes(rng.uniform(0, 25, size=n).round(1)),
+        'GYPSUM': con_faltantes(rng.uniform(0, 10, size=n).round(1)),
+        'ELEC_COND': con_faltantes(rng.uniform(0, 16, size=n).round(1)),
+    })
+
+def generar_bd_sintetica(ruta, n_smu, perfiles_por_smu=3, semilla=0, smu_por_bloque=50_000):
+    """
+    Genera una base SQLite con el esquema de HWSD2 que consulta el extractor
+
+    Parámetros:
+    - ruta: Archivo SQLite a crear (se sobrescribe)
+    - n_smu: Número de tipos de suelo (HWSD2_SMU_ID 1..n_smu)
+    - perfiles_por_smu: Máximo de perfiles (componentes) por SMU; cada SMU
+      recibe entre 1 y este número, con 3 a 7 capas cada uno
+    - semilla: Semilla del generador aleatorio (bases reproducibles)
+    - smu_por_bloque: SMU generados e insertados por bloque (memoria acotada)
+
+    Retorna:
+    - Número de filas de HWSD2_LAYERS generadas
+    """
+    ruta = Path(ruta)
+    if ruta.exists():
+        ruta.unlink()
+
+    rng = np.random.default_rng(semilla)
+    conn = sqlite3.connect(ruta)
+    try:
+        for tabla, (columnas, filas) in TABLAS_REFERENCIA.items():
+            conn.execute(f"CREATE TABLE {tabla} ({', '.join(columnas)})")
+            conn.executemany(f"INSERT INTO {tabla} VALUES ({', '.join('?' * len(columnas))})", filas)
+
+        conn.execute("CREATE TABLE HWSD2_SMU (HWSD2_SMU_ID INTEGER, WRB4 TEXT, WRB2 TEXT)")
+        conn.execute(f"CREATE TABLE HWSD2_LAYERS ({', '.join(f'{c} {t}' for c, t in COLUMNAS_CAPAS)})")
+
+        wrb4 = np.array([codigo for codigo, _ in TABLAS_REFERENCIA['D_WRB4'][1]], dtype=object)
+        wrb2 = np.array([codigo for codigo, _ in TABLAS_REFERENCIA['D_WRB2'][1]], dtype=object)
+        marcadores = ', '.join('?' * len(COLUMNAS_CAPAS))
+
+        filas = 0
+        for inicio in range(1, n_smu + 1, smu_por_bloque):
+            smu_ids = np.arange(inicio, min(inicio + smu_por_bloque, n_smu + 1))
+            df_smu = pd.DataFrame({
+                'HWSD2_SMU_ID': smu_ids,
+                'WRB4': wrb4[rng.integers(0, len(wrb4), size=len(smu_ids))],
+                'WRB2': wrb2[rng.integers(0, len(wrb2), size=len(smu_ids))],
+            })
+            df_capas = _perfiles_sinteticos(rng, smu_ids, perfiles_por_smu, primer_id=filas + 1)
+
+            with conn:
+                conn.executemany("INSERT INTO HWSD2_SMU VALUES (?, ?, ?)", _filas_sql(df_smu))
+                conn.executemany(f"INSERT INTO HWSD2_LAYERS VALUES ({marcadores})", _filas_sql(df_capas))
+            filas += len(df_capas)
+    finally:
+        conn.close()
+
+    return filas
+
+# ============================================================================
+# SECCIÓN 2: TIEMPOS POR ETAPA
+# ============================================================================
+
+def medir_etapas(db_path, smu_ids=None, capas=None, motor='pandas', formato='parquet', directorio=None):
+    """
+    Mide el tiempo de cada etapa de una extracción completa
+
+    Etapas: tablas de referencia (sin memorizar), consulta de capas, VSP (a
+    partir de la misma consulta), consolidación + formato PyAEZ, y escritura
+    de la salida.
+
+    Parámetros:
+    - smu_ids: Lista de HWSD2_SMU_ID (None = todos los de HWSD2_SMU)
+    - motor: 'pandas' o 'sql' (ver extractor.extraer_pyaez)
+    - formato: Formato de salida para la etapa de escritura
+    - directorio: Carpeta para el archivo de salida (por defecto una temporal)
+
+    Retorna:
+    - dict etapa → segundos, más smu, registros_capas y registros_pyaez
+    """
+    capas = extractor.CAPAS if capas is None else list(capas)
+    tiempos = {}
+
+    def medir(etapa, funcion, *args, **kwargs):
+        inicio = time.perf_counter()
+        resultado = funcion(*args, **kwargs)
+        tiempos[etapa] = time.perf_counter() - inicio
+        return resultado
+
+    conn = sqlite3.connect(db_path)
+    try:
+        if smu_ids is None:
+            smu_ids = [fila[0] for fila in conn.execute("SELECT HWSD2_SMU_ID FROM HWSD2_SMU")]
+
+        extractor._REGISTROS.clear()
+        tablas = medir('tablas', extractor.cargar_tablas_referencia, conn, verbose=False)
+
+        if motor == 'sql':
+            df_consolidated = medir('consulta', extractor.obtener_consolidado_sql,
+                                    conn, smu_ids, capas, verbose=False)
+            registros_capas = len(df_consolidated)
+            df_arcilla = df_consolidated[['HWSD2_SMU_ID'] + extractor.COLUMNAS_ARCILLA_VSP] \
+                .drop_duplicates('HWSD2_SMU_ID')
+        else:
+            df_all = medir('consulta', extractor.obtener_capas, conn, smu_ids, verbose=False)
+            registros_capas = len(df_all)
+            df_arcilla = extractor.arcilla_d1(df_all)
+        vsp_map = medir('vsp', extractor.calcular_vsp, conn, smu_ids, verbose=False, tablas=tablas,
+                        df_arcilla=df_arcilla)
+
+        if motor == 'sql':
+            resultados = medir('consolidacion', lambda: extractor.separar_por_capa(
+                extractor.formatear_pyaez(df_consolidated, tablas, vsp_map), capas, verbose=False))
+        else:
+            resultados = medir('consolidacion', extractor.procesar_capas,
+                               df_all, capas, tablas, vsp_map, verbose=False)
+    finally:
+        conn.close()
+
+    with tempfile.TemporaryDirectory() as temporal:
+        destino = Path(directorio or temporal) / f"benchmark{extractor.EXTENSION_POR_FORMATO[formato]}"
+        medir('escritura', extractor.guardar_resultados, resultados, destino, formato=formato, verbose=False)
+
+    tiempos['total'] = sum(tiempos.values())
+    tiempos.update({
+        'smu': len(smu_ids),
+        'registros_capas': registros_capas,
+        'registros_pyaez': sum(len(df) for df in resultados.values()),
+    })
+    return tiempos
+
+def benchmark_etapas(tamanos, perfiles_por_smu=3, motor='pandas', formato='parquet', directorio=None,
+                     semilla=0):
+    """
+    Genera una base sintética por tamaño y mide las etapas de cada una
+
+    Parámetros:
+    - tamanos: Números de SMU a probar (p. ej. [31, 1000, 100000, 1000000])
+    - directorio: Carpeta donde conservar las bases generadas (por defecto
+      temporal; reutiliza una base ya generada con el mismo tamaño y semilla)
+
+    Retorna:
+    - DataFrame con una fila por tamaño y una columna por etapa
+    """
+    filas = []
+    with tempfile.TemporaryDirectory() as temporal:
+        carpeta = Path(directorio or temporal)
+        carpeta.mkdir(parents=True, exist_ok=True)
+        for n_smu in tamanos:
+            db_path = carpeta / f"hwsd2_sintetica_{n_smu}_{perfiles_por_smu}_{semilla}.db"
+            if not db_path.exists():
+                generar_bd_sintetica(db_path, n_smu, perfiles_por_smu, semilla)
+            filas.append(medir_etapas(db_path, motor=motor, formato=formato))
+    return pd.DataFrame(filas)
+
+# ============================================================================
+# SECCIÓN 3: FORMATOS DE SALIDA
+# ============================================================================
+
+def replicar_multicapa(df_multicapa, replicas):
+    """
+    Agranda un DataFrame multicapa copiándolo con CODE desplazados
+
+    Simula una extracción de replicas veces el tamaño de la original.
+    """
+    desplazamiento = int(df_multicapa['CODE'].max()) + 1
+    copias = []
+    for i in range(replicas):
+        copia = df_multicapa.copy()
+        copia['CODE'] = copia['CODE'] + i * desplazamiento
+        copias.append(copia)
+    return pd.concat(copias, ignore_index=True)
+
+def comparar_formatos_salida(df_multicapa, directorio, formatos=None, repeticiones=3):
+    """
+    Compara tiempos de escritura y lectura de cada formato de salida
+
+    Parámetros:
+    - df_multicapa: DataFrame PyAEZ multicapa (ver combinar_capas)
+    - directorio: Carpeta donde escribir los archivos de prueba
+    - formatos: Lista de formatos (por defecto extractor.FORMATOS_SALIDA)
+    - repeticiones: Se reporta el mejor tiempo de cada medición
+
+    Retorna:
+    - DataFrame con formato, escritura_s, lectura_s y tamano_mb
+    """
+    formatos = extractor.FORMATOS_SALIDA if formatos is None else formatos
+    directorio = Path(directorio)
+    filas = []
+
+    for formato in formatos:
+        ruta = directorio / f"benchmark{extractor.EXTENSION_POR_FORMATO[formato]}"
+
+        escritura = []
+        lectura = []
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            extractor.escribir_salida(df_multicapa, ruta, formato)
+            escritura.append(time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            extractor.leer_salida(ruta, formato)
+            lectura.append(time.perf_counter() - inicio)
+
+        filas.append({
+            'formato': formato,
+            'registros': len(df_multicapa),
+            'escritura_s': min(escritura),
+            'lectura_s': min(lectura),
+            'tamano_mb': ruta.stat().st_size / 1e6,
+        })
+
+    return pd.DataFrame(filas)
+
+# ============================================================================
+# LÍNEA DE COMANDOS
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks del extractor HWSD2 → PyAEZ")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    generar = subparsers.add_parser('generar', help="Genera una base HWSD2 sintética")
+    generar.add_argument('ruta', help="Archivo SQLite a crear")
+    generar.add_argument('--smu', type=int, default=31, help="Número de SMU")
+    generar.add_argument('--perfiles', type=int, default=3, help="Máximo de perfiles por SMU")
+    generar.add_argument('--semilla', type=int, default=0)
+
+    etapas = subparsers.add_parser('etapas', help="Tiempos por etapa sobre bases sintéticas de varios tamaños")
+    etapas.add_argument('--tamanos', type=int, nargs='+', default=[31, 1000, 10000, 100000],
+                        help="Números de SMU a probar (hasta ~1000000)")
+    etapas.add_argument('--perfiles', type=int, default=3, help="Máximo de perfiles por SMU")
+    etapas.add_argument('--motor', default='pandas', choices=extractor.MOTORES)
+    etapas.add_argument('--formato', default='parquet', choices=extractor.FORMATOS_SALIDA)
+    etapas.add_argument('--directorio', help="Carpeta donde conservar y reutilizar las bases generadas")
+    etapas.add_argument('--json', help="Guarda los resultados en este archivo JSON")
+
+    salidas = subparsers.add_parser('salidas', help="Tiempos de escritura/lectura por formato de salida")
+    salidas.add_argument('--db', help="Base de datos HWSD2 de origen (por defecto una sintética de --smu SMU)")
+    salidas.add_argument('--smu', type=int, default=1000, help="SMU de la base sintética si no se da --db")
+    salidas.add_argument('--ids', type=int, nargs='+', help="HWSD2_SMU_ID a extraer (por defecto: todos)")
+    salidas.add_argument('--replicas', type=int, default=1,
+                         help="Multiplica el tamaño de la extracción copiando registros")
+    salidas.add_argument('--formatos', nargs='+', choices=extractor.FORMATOS_SALIDA,
+                         default=extractor.FORMATOS_SALIDA)
+    salidas.add_argument('--repeticiones', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.comando == 'generar':
+        filas = generar_bd_sintetica(args.ruta, args.smu, args.perfiles, args.semilla)
+        print(f"✓ {args.ruta}: {args.smu} SMU, {filas} registros en HWSD2_LAYERS")
+
+    elif args.comando == 'etapas':
+        resultado = benchmark_etapas(args.tamanos, args.perfiles, args.motor, args.formato, args.directorio)
+        print(resultado.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(resultado.to_dict(orient='records'), f, indent=2)
+
+    else:
+        with tempfile.TemporaryDirectory() as directorio:
+            db_path = args.db
+            if db_path is None:
+                db_path = Path(directorio) / 'hwsd2_sintetica.db'
+                generar_bd_sintetica(db_path, args.smu)
+            smu_ids = args.ids
+            if smu_ids is None:
+                with sqlite3.connect(db_path) as conn:
+                    smu_ids = [fila[0] for fila in conn.execute("SELECT HWSD2_SMU_ID FROM HWSD2_SMU")]
+            df_multicapa = extractor.combinar_capas(extractor.extraer_pyaez(db_path, smu_ids))
+            df_multicapa = replicar_multicapa(df_multicapa, args.replicas)
+            resultado = comparar_formatos_salida(df_multicapa, directorio, args.formatos, args.repeticiones)
+        print(resultado.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
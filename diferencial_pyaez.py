@@ -0,0 +1,362 @@
+"""
+EXTRACCIÓN DIFERENCIAL: ACTUALIZAR SALIDAS PyAEZ ENTRE VERSIONES DE HWSD2 O DE REGLAS
+=====================================================================================
+
+Cuando se publica una corrección de HWSD2 o cambian las reglas de
+consolidación (umbrales de VSP, OSD_RANGOS, acciones de validación), regenerar
+cada región desde cero cuesta lo mismo que la primera extracción. Este módulo
+actualiza una salida existente con un costo proporcional al cambio:
+
+1. Adjunta la versión anterior de HWSD2.db a la nueva (ATTACH) y compara
+   fila a fila, dentro de SQLite (EXCEPT), las columnas de HWSD2_LAYERS que
+   usa el extractor y las de HWSD2_SMU (WRB4, WRB2). Las tablas D_* se
+   comparan completas: si cambia una, todos los SMU quedan afectados
+2. Obtiene los SMU modificados, nuevos y eliminados sin transferir filas a Python
+3. Vuelve a consolidar solo esos SMU con extraer_pyaez
+4. Reemplaza sus registros en la salida existente (archivo, carpeta
+   particionada por capa o almacén de almacen_pyaez.py) y la reescribe
+5. Emite un registro de cambios: un renglón por (CODE, LAYER, variable) que
+   cambió, más los registros agregados y eliminados
+
+Sin base anterior (--anterior), el cambio es de reglas: HWSD2 no cambió, así
+que se vuelven a consolidar todos los SMU de la salida con las reglas nuevas,
+pero la salida solo se reescribe, y el registro solo lista, lo que cambió.
+
+USO:
+----
+    python diferencial_pyaez.py salida.xlsx --db HWSD2_v2.db --anterior HWSD2_v1.db --registro cambios.csv
+    python diferencial_pyaez.py almacen/ --db HWSD2_v2.db --anterior HWSD2_v1.db --nuevos
+    python diferencial_pyaez.py salida.parquet --db HWSD2.db --accion pH_rango=rechazar --registro cambios.csv
+"""
+
+import argparse
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import almacen_pyaez
+import eswatini_pyaez_suelos as extractor
+
+# Columnas de HWSD2_SMU que intervienen en la consolidación (criterio WRB de VSP)
+COLUMNAS_SMU_PYAEZ = ['HWSD2_SMU_ID', 'WRB4', 'WRB2']
+
+# Tipos de cambio del registro de cambios
+CAMBIOS = ['modificado', 'agregado', 'eliminado']
+
+COLUMNAS_REGISTRO = ['CODE', 'LAYER', 'variable', 'anterior', 'nuevo', 'cambio']
+
+# ============================================================================
+# SECCIÓN 1: SMU AFECTADOS
+# ============================================================================
+
+def _smu_distintos(conn, tabla, columnas, filtro):
+    """
+    HWSD2_SMU_ID con alguna fila de tabla distinta entre main y anterior
+
+    EXCEPT en ambos sentidos sobre las columnas dadas: la comparación se hace
+    dentro de SQLite y solo se transfieren los IDs afectados.
+    """
+    lista = ', '.join(columnas)
+    consulta = f"""
+        SELECT HWSD2_SMU_ID FROM (
+            SELECT {lista} FROM main.{tabla} {filtro} EXCEPT SELECT {lista} FROM anterior.{tabla} {filtro})
+        UNION
+        SELECT HWSD2_SMU_ID FROM (
+            SELECT {lista} FROM anterior.{tabla} {filtro} EXCEPT SELECT {lista} FROM main.{tabla} {filtro})
+    """
+    return {fila[0] for fila in conn.execute(consulta)}
+
+def _smu_presentes(conn, esquema, filtro):
+    return {fila[0] for fila in conn.execute(f"""
+        SELECT HWSD2_SMU_ID FROM {esquema}.HWSD2_LAYERS {filtro}
+        UNION SELECT HWSD2_SMU_ID FROM {esquema}.HWSD2_SMU {filtro}
+    """)}
+
+def _referencia_distinta(conn, tabla):
+    """True si la tabla D_* cambió (o cambiaron sus columnas) entre main y anterior"""
+    try:
+        for a, b in (('main', 'anterior'), ('anterior', 'main')):
+            consulta = f"SELECT * FROM {a}.{tabla} EXCEPT SELECT * FROM {b}.{tabla} LIMIT 1"
+            if conn.execute(consulta).fetchone():
+                return True
+    except sqlite3.OperationalError:
+        return True
+    return False
+
+def smu_afectados(db_anterior, db_nuevo, smu_ids=None):
+    """
+    SMU cuyos datos de entrada cambian entre dos versiones de HWSD2.db
+
+    Compara fila a fila HWSD2_LAYERS (COLUMNAS_CAPAS_PYAEZ) y HWSD2_SMU
+    (COLUMNAS_SMU_PYAEZ) con la versión anterior adjunta (ATTACH) a la nueva.
+    Las columnas que el extractor no usa no cuentan como cambio.
+
+    Parámetros:
+    - db_anterior, db_nuevo: Rutas a las dos versiones
+    - smu_ids: SMU a comparar (None = toda la base de datos)
+
+    Retorna:
+    - dict con listas ordenadas de HWSD2_SMU_ID 'modificados', 'nuevos' y
+      'eliminados', y 'referencias': tablas D_* que cambiaron (si hay alguna,
+      todos los SMU presentes en ambas versiones cuentan como modificados)
+    """
+    conn = extractor.conectar_solo_lectura(db_nuevo)
+    try:
+        conn.execute("ATTACH DATABASE ? AS anterior", (extractor.uri_solo_lectura(db_anterior),))
+        filtro = '' if smu_ids is None else \
+            f"WHERE HWSD2_SMU_ID IN ({extractor._tabla_ids(conn, smu_ids, 'pyaez_ids_diferencia')})"
+
+        presentes_anterior = _smu_presentes(conn, 'anterior', filtro)
+        presentes_nuevo = _smu_presentes(conn, 'main', filtro)
+        comunes = presentes_anterior & presentes_nuevo
+
+        tablas = [tabla for tabla, _, _ in extractor.RegistroTablas.TABLAS.values()
+                  if _referencia_distinta(conn, tabla)]
+        if tablas:
+            modificados = comunes
+        else:
+            distintos = (_smu_distintos(conn, 'HWSD2_LAYERS', extractor.COLUMNAS_CAPAS_PYAEZ, filtro)
+                         | _smu_distintos(conn, 'HWSD2_SMU', COLUMNAS_SMU_PYAEZ, filtro))
+            modificados = distintos & comunes
+    finally:
+        conn.close()
+
+    return {
+        'modificados': sorted(modificados),
+        'nuevos': sorted(presentes_nuevo - presentes_anterior),
+        'eliminados': sorted(presentes_anterior - presentes_nuevo),
+        'referencias': sorted(tablas),
+    }
+
+# ============================================================================
+# SECCIÓN 2: REGISTRO DE CAMBIOS Y PARCHE
+# ============================================================================
+
+def registro_cambios(df_anterior, df_nuevo, rtol=1e-9):
+    """
+    Diferencias entre dos DataFrames PyAEZ multicapa (con LAYER)
+
+    Compara los valores exportados (exportar_pyaez) registro por registro
+    (CODE, LAYER); los reales con tolerancia relativa rtol.
+
+    Retorna:
+    - DataFrame COLUMNAS_REGISTRO: un renglón por variable modificada y uno
+      por registro agregado o eliminado (variable vacía)
+    """
+    claves = ['CODE', 'LAYER']
+    anterior = extractor.exportar_pyaez(df_anterior).assign(LAYER=lambda df: df['LAYER'].astype(str))
+    nuevo = extractor.exportar_pyaez(df_nuevo).assign(LAYER=lambda df: df['LAYER'].astype(str))
+
+    partes = []
+    for df, otro, cambio in ((nuevo, anterior, 'agregado'), (anterior, nuevo, 'eliminado')):
+        solo = df[claves].merge(otro[claves], on=claves, how='left', indicator=True)
+        solo = solo.loc[solo['_merge'] == 'left_only', claves]
+        partes.append(solo.assign(variable=None, anterior=None, nuevo=None, cambio=cambio))
+
+    # Solo los registros presentes en ambos: cada columna conserva su tipo
+    ambos = anterior.merge(nuevo, on=claves, how='inner', suffixes=('_anterior', '_nuevo'))
+    for variable in almacen_pyaez.VARIABLES_ALMACEN:
+        valores_anterior = ambos[f'{variable}_anterior']
+        valores_nuevo = ambos[f'{variable}_nuevo']
+        if pd.api.types.is_numeric_dtype(valores_anterior) and pd.api.types.is_numeric_dtype(valores_nuevo):
+            iguales = np.isclose(valores_anterior, valores_nuevo, rtol=rtol, atol=0, equal_nan=True)
+        else:
+            iguales = ((valores_anterior.astype(str) == valores_nuevo.astype(str)).fillna(False)
+                       | (valores_anterior.isna() & valores_nuevo.isna())).to_numpy(dtype=bool)
+        if iguales.all():
+            continue
+        distintos = ambos[~iguales]
+        partes.append(pd.DataFrame({
+            'CODE': distintos['CODE'], 'LAYER': distintos['LAYER'], 'variable': variable,
+            'anterior': distintos[f'{variable}_anterior'].astype(object),
+            'nuevo': distintos[f'{variable}_nuevo'].astype(object), 'cambio': 'modificado',
+        }))
+
+    registro = pd.concat(partes, ignore_index=True)[COLUMNAS_REGISTRO]
+    registro['cambio'] = pd.Categorical(registro['cambio'], categories=CAMBIOS)
+    return registro.sort_values(['CODE', 'LAYER', 'cambio']).reset_index(drop=True)
+
+def parchear(df_anterior, df_parcial, smu_ids):
+    """
+    Reemplaza los registros de smu_ids de df_anterior por los de df_parcial
+
+    df_parcial trae los registros vueltos a consolidar de esos SMU (los SMU
+    sin registros en df_parcial quedan eliminados). Retorna el DataFrame
+    multicapa tipado, ordenado por LAYER y CODE.
+    """
+    conservados = df_anterior[~df_anterior['CODE'].isin(smu_ids)]
+    df_parcheado = extractor.concatenar_pyaez([conservados, df_parcial]) if len(df_parcial) else conservados
+    df_parcheado = df_parcheado.assign(LAYER=df_parcheado['LAYER'].astype(str))
+    return extractor.tipar_pyaez(df_parcheado).sort_values(['LAYER', 'CODE']).reset_index(drop=True)
+
+# ============================================================================
+# SECCIÓN 3: LECTURA Y ESCRITURA DE LA SALIDA EXISTENTE
+# ============================================================================
+
+def _es_almacen(ruta):
+    return Path(ruta).is_dir() and (Path(ruta) / almacen_pyaez.METADATOS).exists()
+
+def leer_existente(ruta, formato=None):
+    """
+    Salida existente como DataFrame PyAEZ multicapa tipado
+
+    Acepta un archivo multicapa, una carpeta particionada por capa (ver
+    extractor.guardar_resultados) o un almacén de almacen_pyaez.py.
+    """
+    if _es_almacen(ruta):
+        almacen = almacen_pyaez.AlmacenPyAEZ(ruta)
+        return extractor.combinar_capas(almacen.consultar(almacen.ids))
+    return extractor.tipar_pyaez(extractor.leer_salida(ruta, formato))
+
+def escribir_existente(df_multicapa, ruta, formato=None, **origen):
+    """
+    Reescribe la salida en su mismo formato (archivo, carpeta por capa o almacén)
+
+    origen: metadatos del almacén (huella_bd, huella_reglas); se ignora en archivos
+    """
+    ruta = Path(ruta)
+    if _es_almacen(ruta):
+        almacen_pyaez.escribir_almacen(df_multicapa, ruta, **origen)
+    elif ruta.is_dir():
+        existentes = extractor.archivos_particionados(ruta)
+        extension = existentes[0].suffix.lower() if existentes else '.parquet'
+        for archivo in existentes:
+            archivo.unlink()
+        for capa, df_capa in df_multicapa.groupby('LAYER', sort=False, observed=True):
+            extractor.escribir_salida(df_capa.drop(columns='LAYER').reset_index(drop=True),
+                                      ruta / f"{capa}{extension}", formato)
+    else:
+        extractor.escribir_salida(df_multicapa, ruta, formato)
+
+def escribir_registro(df_cambios, ruta, formato=None):
+    """
+    Escribe el registro de cambios (CSV, Excel, Parquet o Feather)
+
+    anterior/nuevo mezclan números y textos: en Parquet y Feather se guardan como texto.
+    """
+    formato = extractor.detectar_formato(ruta, formato)
+    if formato == 'csv':
+        df_cambios.to_csv(ruta, index=False)
+    elif formato == 'excel':
+        df_cambios.to_excel(ruta, index=False)
+    else:
+        df_cambios = df_cambios.assign(**{columna: df_cambios[columna].map(lambda v: None if v is None else str(v))
+                                          for columna in ('anterior', 'nuevo')})
+        if formato == 'parquet':
+            df_cambios.to_parquet(ruta, index=False)
+        else:
+            df_cambios.to_feather(ruta)
+
+# ============================================================================
+# SECCIÓN 4: ACTUALIZACIÓN DIFERENCIAL
+# ============================================================================
+
+def actualizar_salida(salida, db_nuevo, db_anterior=None, smu_ids=None, nuevos=False, reglas=None,
+                      formato=None, registro=None, verbose=True):
+    """
+    Actualiza una salida PyAEZ existente solo en los SMU afectados por un cambio
+
+    Parámetros:
+    - salida: Archivo multicapa, carpeta particionada por capa o almacén
+      (se lee y, si algo cambió, se reescribe en el mismo lugar)
+    - db_nuevo: HWSD2.db con la que se vuelve a consolidar
+    - db_anterior: HWSD2.db con la que se generó la salida. None = cambio de
+      reglas: se vuelven a consolidar todos los SMU de la salida
+    - smu_ids: SMU a considerar además de los de la salida
+    - nuevos: Agrega los SMU que solo existen en db_nuevo (salidas globales)
+    - reglas: Reglas de validación de la nueva consolidación (ver
+      extractor.validar_registros)
+    - formato: Formato de la salida (None = según extensión)
+    - registro: Archivo donde escribir el registro de cambios (None = no escribir)
+
+    Retorna:
+    - DataFrame del registro de cambios (ver registro_cambios)
+    """
+    df_anterior = leer_existente(salida, formato)
+    presentes = set(df_anterior['LAYER'].astype(str))
+    if presentes - set(extractor.CAPAS):
+        raise ValueError(f"{salida} contiene intervalos de profundidad "
+                         f"({', '.join(sorted(presentes - set(extractor.CAPAS)))}); solo se actualizan "
+                         f"las capas D1-D7 (los intervalos se regeneran con intervalos_pyaez.py)")
+    capas = [capa for capa in extractor.CAPAS if capa in presentes]
+    alcance = pd.Index(df_anterior['CODE'].unique()).union(pd.Index(np.asarray(smu_ids or [], dtype=np.int64)))
+
+    vigente = _es_almacen(salida) and almacen_pyaez.AlmacenPyAEZ(salida).vigente(db_nuevo, reglas)
+    if db_anterior is None and vigente:
+        afectados = []
+        if verbose:
+            print("✓ El almacén ya corresponde a esta base y estas reglas")
+    elif db_anterior is None:
+        afectados = [int(i) for i in alcance]
+        if verbose:
+            print(f"✓ Cambio de reglas (huella {extractor.huella_reglas(reglas)}): "
+                  f"se vuelven a consolidar los {len(afectados)} SMU de la salida")
+    else:
+        cambios = smu_afectados(db_anterior, db_nuevo, None if nuevos else alcance.tolist())
+        afectados = sorted(set(cambios['modificados']) | set(cambios['eliminados'])
+                           | {i for i in cambios['nuevos'] if nuevos or i in alcance})
+        if verbose:
+            print(f"✓ SMU afectados: {len(cambios['modificados'])} modificados, "
+                  f"{len(cambios['nuevos'])} nuevos, {len(cambios['eliminados'])} eliminados")
+            if cambios['referencias']:
+                print(f"  - Tablas de referencia modificadas: {', '.join(cambios['referencias'])}")
+
+    resultados = extractor.extraer_pyaez(db_nuevo, afectados, capas, reglas=reglas) if afectados else {}
+    df_parcial = extractor.combinar_capas(resultados) if resultados else df_anterior.iloc[:0]
+
+    df_cambios = registro_cambios(df_anterior[df_anterior['CODE'].isin(afectados)], df_parcial)
+    if len(df_cambios):
+        origen = {'huella_bd': extractor.huella_bd(db_nuevo), 'huella_reglas': extractor.huella_reglas(reglas)}
+        escribir_existente(parchear(df_anterior, df_parcial, afectados), salida, formato, **origen)
+    if registro is not None:
+        escribir_registro(df_cambios, registro)
+
+    if verbose:
+        if not len(df_cambios):
+            print(f"✓ Sin cambios: {salida}")
+        else:
+            resumen = df_cambios['cambio'].value_counts()
+            variables = df_cambios['variable'].value_counts()
+            print(f"✓ Actualizado: {salida} ({df_cambios['CODE'].nunique()} SMU con cambios)")
+            print("  - Registros: " + ', '.join(f"{n} {cambio}s" for cambio, n in resumen.items() if n))
+            if len(variables):
+                print("  - Variables modificadas: " + ', '.join(f"{v} ({n})" for v, n in variables.items()))
+    return df_cambios
+
+# ============================================================================
+# LÍNEA DE COMANDOS
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Actualiza una salida PyAEZ solo en los SMU afectados por una nueva HWSD2.db o nuevas reglas")
+    parser.add_argument('salida', help="Salida existente: archivo multicapa, carpeta por capa o almacén")
+    parser.add_argument('--db', default='HWSD2.db', help="HWSD2.db nueva (por defecto: HWSD2.db)")
+    parser.add_argument('--anterior', metavar='DB',
+                        help="HWSD2.db con la que se generó la salida (sin ella: cambio de reglas)")
+    parser.add_argument('--ids', type=int, nargs='+', help="HWSD2_SMU_ID a considerar además de los de la salida")
+    parser.add_argument('--nuevos', action='store_true',
+                        help="Agrega los SMU que solo existen en la base nueva (salidas globales)")
+    parser.add_argument('--accion', nargs='+', metavar='REGLA=ACCION', default=[],
+                        help="Cambia la acción de reglas de validación (ver eswatini_pyaez_suelos.py)")
+    parser.add_argument('--formato', choices=extractor.FORMATOS_SALIDA,
+                        help="Formato de la salida (por defecto: según la extensión)")
+    parser.add_argument('--registro', metavar='ARCHIVO', help="Registro de cambios (.csv, .xlsx, .parquet)")
+    parser.add_argument('--silencioso', action='store_true')
+    args = parser.parse_args(argv)
+
+    reglas = None
+    if args.accion:
+        try:
+            reglas = extractor.configurar_reglas(args.accion)
+        except ValueError as error:
+            parser.error(str(error))
+
+    actualizar_salida(args.salida, args.db, args.anterior, args.ids, nuevos=args.nuevos, reglas=reglas,
+                      formato=args.formato, registro=args.registro, verbose=not args.silencioso)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,3 @@
-import sqlite3
-import pandas as pd
-import numpy as np
-
 """
 SCRIPT DE EXTRACCIÓN DE DATOS DE SUELO HWSD2 PARA PyAEZ
 ========================================================
@@ -106,122 +102,634 @@ METODOLOGÍA DE CONSOLIDACIÓN:
 - Variables categóricas: MODA (valor más frecuente)
 - Justificación: Representa comportamiento promedio del tipo de suelo
   cuando existen múltiples perfiles en la base de datos
+
+USO:
+----
+- Línea de comandos:
+    python eswatini_pyaez_suelos.py --db HWSD2.db --ids 7001 18372 --salida salida.xlsx
+- Librería (importar no abre la base de datos ni ejecuta consultas):
+    from eswatini_pyaez_suelos import extraer_pyaez
+    resultados = extraer_pyaez('HWSD2.db', smu_ids=[7001, 18372], capas=['D1', 'D2'])
+    resultados['D1']  # DataFrame PyAEZ de la capa D1
 """
 
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.request import pathname2url
+
+import pandas as pd
+import numpy as np
+
 # IDs de Eswatini (31 tipos de suelo)
-ids_eswatini = [7001, 18372, 27072, 27073, 27074, 27075, 27076, 27077, 27078, 27079,
+IDS_ESWATINI = [7001, 18372, 27072, 27073, 27074, 27075, 27076, 27077, 27078, 27079,
                 27080, 27081, 27082, 27083, 27084, 27085, 27086, 27087, 27088, 27089,
                 28093, 30424, 30803, 30866, 30898, 30975, 30998, 31032, 31044, 31048, 31100]
 
-conn = sqlite3.connect('HWSD2.db')
+# Capas de profundidad HWSD2 (D1-D7: 0-200 cm)
+CAPAS = ['D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7']
+
+SALIDA_POR_DEFECTO = "eswatini_soil_ALL_LAYERS_pyaez.xlsx"
+
+# Variables continuas: PROMEDIO entre perfiles del mismo tipo de suelo
+# (CLAY no es una variable PyAEZ: se usa en la regla textura_arcilla)
+COLUMNAS_PROMEDIO = ['ORG_CARBON', 'PH_WATER', 'TEB', 'CEC_SOIL', 'CEC_CLAY',
+                     'ESP', 'ELEC_COND', 'TCARBON_EQ', 'GYPSUM', 'COARSE', 'CLAY']
+
+# Variables categóricas: MODA entre perfiles del mismo tipo de suelo
+COLUMNAS_MODA = ['TEXTURE_USDA', 'ROOT_DEPTH', 'PHASE1', 'PHASE2', 'ROOTS', 'DRAINAGE']
+
+CLAVES_CONSOLIDACION = ['HWSD2_SMU_ID', 'LAYER']
+
+# Formatos de salida: extensión → formato
+EXTENSIONES_FORMATO = {
+    '.xlsx': 'excel',
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'feather',
+}
+FORMATOS_SALIDA = ['excel', 'csv', 'parquet', 'feather']
+EXTENSION_POR_FORMATO = {'excel': '.xlsx', 'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+# Variables categóricas guardadas como diccionario en Parquet/Feather
+COLUMNAS_DICCIONARIO = ['TXT', 'DRG', 'SPR', 'SPH']
+
+# Filas de HWSD2_LAYERS leídas por bloque en la extracción por bloques
+TAMANO_BLOQUE = 100_000
+
+# OSD: código D_ROOTS → profundidad del obstáculo en cm (punto medio del rango)
+OSD_RANGOS = {
+    0: 0,      # Sin obstáculo
+    1: 90,     # >80 cm → usar 90 (profundo)
+    2: 70,     # 60-80 cm → punto medio 70
+    3: 50,     # 40-60 cm → punto medio 50
+    4: 30,     # 20-40 cm → punto medio 30
+    5: 40,     # 0-80 cm → punto medio 40 (rango amplio)
+    6: 10      # 0-20 cm → punto medio 10 (muy superficial)
+}
+
+# Fases D_PHASE que definen SPH (químicas/profundas) y SPR (físicas/rocosas)
+FASES_SPH = ['Salic', 'Sodic', 'Gelic', 'Yermic', 'Aridic', 'Duric']
+FASES_SPR = ['Stony', 'Lithic', 'Petric', 'Skeletic', 'Rudic', 'Gravelly']
+
+# Versión de las reglas de consolidación (promedios, modas, mapeos, VSP,
+# validaciones). Incrementar al cambiar la lógica; los cambios en las
+# constantes de configuracion_reglas se detectan solos (huella_reglas).
+VERSION_REGLAS = 2
+
+# Columnas del formato PyAEZ multicapa
+COLUMNAS_PYAEZ = ['CODE', 'LAYER', 'TXT', 'OC', 'pH', 'TEB', 'BS', 'CEC_soil', 'CEC_clay', 'RSD',
+                  'SPR', 'SPH', 'OSD', 'DRG', 'ESP', 'EC', 'CCB', 'GYP', 'GRC', 'VSP']
+
+# Esquema tipado de los registros PyAEZ en memoria (ver tipar_pyaez). Los
+# enteros usan el tipo más angosto que admite su rango (VSP es 0/1; BS y ESP
+# son int16 porque con --accion BS_rango=reportar pueden superar 100); las
+# variables de texto son categóricas.
+TIPOS_PYAEZ = {
+    'CODE': 'int32', 'LAYER': 'category', 'TXT': 'category',
+    'OC': 'float64', 'pH': 'float64', 'TEB': 'float64',
+    'BS': 'int16', 'CEC_soil': 'int16', 'CEC_clay': 'int16', 'RSD': 'int16',
+    'SPR': 'category', 'SPH': 'category', 'OSD': 'int16', 'DRG': 'category',
+    'ESP': 'int16', 'EC': 'int16', 'CCB': 'int16', 'GYP': 'float64', 'GRC': 'int16', 'VSP': 'int8',
+}
+
+# Valor PyAEZ de las categorías ausentes (NaN en el esquema tipado):
+# sin fase → 0, sin drenaje → ''
+VACIOS_PYAEZ = {'SPR': 0, 'SPH': 0, 'DRG': ''}
+
+# Promedios de la capa D1 (CLAY > 0) por SMU para el criterio de arcilla de VSP
+COLUMNAS_ARCILLA_VSP = ['ARCILLA_D1', 'CEC_ARCILLA_D1']
+
+# Criterio 2 de VSP: % de arcilla y CEC de la arcilla (cmol/kg) mínimos en D1
+UMBRAL_ARCILLA_VSP = 35
+UMBRAL_CEC_ARCILLA_VSP = 40
+
+# Motores de consolidación: 'pandas' (agrupa en memoria) o 'sql' (agrupa en SQLite)
+MOTORES = ['pandas', 'sql']
+
+# Columnas de HWSD2_LAYERS que usa el extractor (copia reducida de preparar_bd)
+COLUMNAS_CAPAS_PYAEZ = (['ID', 'HWSD2_SMU_ID', 'LAYER', 'TOPDEP', 'BOTDEP']
+                        + COLUMNAS_PROMEDIO + COLUMNAS_MODA)
+
+# PRAGMAs de las conexiones de lectura (ver conectar_solo_lectura)
+PRAGMAS_LECTURA = {
+    'mmap_size': 1 << 30,     # HWSD2.db mapeado en memoria (hasta 1 GiB)
+    'cache_size': -262_144,   # 256 MiB de caché de páginas
+    'temp_store': 'MEMORY',   # tablas temporales de IDs en memoria
+}
+
+# Variable PyAEZ de cada columna consolidada (nombres de reglas y violaciones)
+VARIABLES_PYAEZ = {
+    'ORG_CARBON': 'OC', 'PH_WATER': 'pH', 'TEB': 'TEB', 'BS_calculated': 'BS',
+    'CEC_SOIL': 'CEC_soil', 'CEC_CLAY': 'CEC_clay', 'ROOT_DEPTH': 'RSD', 'ESP': 'ESP',
+    'ELEC_COND': 'EC', 'TCARBON_EQ': 'CCB', 'GYPSUM': 'GYP', 'COARSE': 'GRC', 'CLAY': 'CLAY',
+}
+
+# Acciones de una regla de validación (ver validar_registros):
+# reportar (solo registra), recortar (al rango o límite), imputar (valor
+# por defecto) o rechazar (elimina el registro de la salida)
+ACCIONES_VALIDACION = ['reportar', 'recortar', 'imputar', 'rechazar']
+ACCIONES_POR_TIPO = {
+    'rango': ACCIONES_VALIDACION,
+    'faltante': ['reportar', 'imputar', 'rechazar'],
+    'maximo_columna': ACCIONES_VALIDACION,
+    'textura_arcilla': ['reportar', 'rechazar'],
+}
+
+# % de arcilla admitido por cada clase textural USDA (triángulo textural),
+# con los nombres de D_TEXTURE_USDA en minúsculas
+RANGOS_ARCILLA_TEXTURA = {
+    'clay (heavy)': (60, 100), 'clay': (40, 100), 'silty clay': (40, 60), 'sandy clay': (35, 55),
+    'clay loam': (27, 40), 'silty clay loam': (27, 40), 'sandy clay loam': (20, 35),
+    'loam': (7, 27), 'silt loam': (0, 27), 'silt': (0, 12), 'sandy loam': (0, 20),
+    'loamy sand': (0, 15), 'sand': (0, 10),
+}
+
+# Reglas de validación de formatear_pyaez, evaluadas sobre los registros
+# consolidados de todas las capas a la vez. Las acciones por defecto
+# reproducen los recortes y valores por defecto de las versiones anteriores;
+# las reglas de consistencia solo reportan
+REGLAS_VALIDACION = [
+    {'regla': 'pH_rango', 'tipo': 'rango', 'columna': 'PH_WATER', 'min': 3.0, 'max': 11.0, 'accion': 'recortar'},
+    {'regla': 'ESP_rango', 'tipo': 'rango', 'columna': 'ESP', 'min': 0, 'max': 100, 'accion': 'recortar'},
+    {'regla': 'BS_rango', 'tipo': 'rango', 'columna': 'BS_calculated', 'min': 0, 'max': 100, 'accion': 'recortar'},
+    {'regla': 'pH_faltante', 'tipo': 'faltante', 'columna': 'PH_WATER', 'valor': 7.0, 'accion': 'imputar'},
+    {'regla': 'RSD_faltante', 'tipo': 'faltante', 'columna': 'ROOT_DEPTH', 'valor': 100, 'accion': 'imputar'},
+] + [
+    {'regla': f'{VARIABLES_PYAEZ[columna]}_faltante', 'tipo': 'faltante', 'columna': columna, 'valor': 0,
+     'accion': 'imputar'}
+    for columna in ['ORG_CARBON', 'TEB', 'BS_calculated', 'CEC_SOIL', 'CEC_CLAY', 'ESP',
+                    'ELEC_COND', 'TCARBON_EQ', 'GYPSUM', 'COARSE']
+] + [
+    {'regla': 'TEB_mayor_CEC', 'tipo': 'maximo_columna', 'columna': 'TEB', 'limite': 'CEC_SOIL', 'accion': 'reportar'},
+    {'regla': 'textura_arcilla', 'tipo': 'textura_arcilla', 'columna': 'CLAY', 'tolerancia': 5, 'accion': 'reportar'},
+]
+
+# Logger de la instrumentación por etapa (ver MedidorEtapas)
+LOGGER = logging.getLogger('eswatini_pyaez_suelos')
+
+
+def _tabla_ids(conn, smu_ids, nombre='pyaez_ids'):
+    """
+    Carga los IDs en una tabla temporal y devuelve la subconsulta para IN (...)
 
-print("="*80)
-print("GENERANDO FORMATO PyAEZ PARA ESWATINI")
-print("="*80)
+    Los IDs se enlazan como parámetros (executemany) en lugar de armar un
+    literal IN (7001, 18372, ...): no hay costo de análisis de la consulta ni
+    límite de tamaño, y SQLite resuelve el filtro como un join. Si conn no
+    tenía una transacción abierta, se confirma para no retener bloqueos.
+    """
+    abierta = conn.in_transaction
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {nombre} (HWSD2_SMU_ID INTEGER PRIMARY KEY)")
+    conn.execute(f"DELETE FROM temp.{nombre}")
+    conn.executemany(f"INSERT OR IGNORE INTO temp.{nombre} VALUES (?)", ((int(i),) for i in smu_ids))
+    if not abierta:
+        conn.commit()
+    return f"SELECT HWSD2_SMU_ID FROM temp.{nombre}"
 
 # ============================================================================
 # SECCIÓN 1: CARGA DE TABLAS DE REFERENCIA
 # ============================================================================
-print("\n[1] Cargando tablas de referencia...")
 
-# D_DRAINAGE - Códigos de drenaje
-df_drainage = pd.read_sql_query("SELECT * FROM D_DRAINAGE", conn)
-drainage_map = dict(zip(df_drainage['SYMBOL'], df_drainage['CODE']))
-print(f"✓ Drenaje: {drainage_map}")
+class MapeadorCodigos:
+    """
+    Traduce códigos a valores con búsquedas vectorizadas (sin dict.map/apply)
+
+    Equivale a serie.map(dict(zip(claves, valores))): se resuelve la posición
+    de cada código con un índice hash (pd.Index.get_indexer) y se toma el
+    valor del arreglo. Códigos desconocidos o NaN dan `defecto`.
+    """
 
-# D_PHASE - Fases del suelo
-df_phase = pd.read_sql_query("SELECT * FROM D_PHASE", conn)
-phase_map = dict(zip(df_phase['CODE'], df_phase['VALUE']))
-print(f"✓ Fases: {len(phase_map)} códigos")
+    def __init__(self, claves, valores):
+        claves = pd.Series(list(claves))
+        valores = pd.Series(list(valores), dtype=object)
+        # dict(zip()) conserva la última aparición de una clave repetida
+        unicos = ~claves.duplicated(keep='last').to_numpy()
+        self.indice = pd.Index(claves[unicos])
+        self.valores = valores[unicos].to_numpy()
+
+    def posiciones(self, codigos):
+        """Posición de cada código en la tabla (-1 si no existe)"""
+        return self.indice.get_indexer(pd.Index(codigos))
+
+    def __call__(self, codigos, defecto=np.nan):
+        posiciones = self.posiciones(codigos)
+        resultado = np.where(posiciones >= 0, self.valores.take(posiciones), defecto)
+        if isinstance(codigos, pd.Series):
+            return pd.Series(resultado, index=codigos.index, name=codigos.name)
+        return resultado
+
+    def como_dict(self):
+        return dict(zip(self.indice, self.valores))
+
+class RegistroTablas:
+    """
+    Tablas de referencia D_* de una base HWSD2, cargadas una vez por archivo
+
+    Se obtiene con obtener_registro(conn), que lo memoriza por archivo de base
+    de datos: extracciones sucesivas en el mismo proceso no vuelven a leer las
+    tablas. Acceso:
+    - registro.mapeador('texture')(serie): búsqueda vectorizada código → valor
+    - registro['texture']: dict código → valor (compatibilidad)
+    - registro.tabla('texture'): DataFrame original de D_TEXTURE_USDA
+    - registro.atributos_smu(conn, smu_ids): WRB y criterio vértico por SMU
+    """
 
-# D_ROOTS - Obstáculos para raíces
-df_roots = pd.read_sql_query("SELECT * FROM D_ROOTS", conn)
-roots_map = dict(zip(df_roots['CODE'], df_roots['VALUE']))
-print(f"✓ Obstáculos raíces: {roots_map}")
+    # nombre → (tabla, columna clave, columna valor)
+    TABLAS = {
+        'drainage': ('D_DRAINAGE', 'SYMBOL', 'CODE'),
+        'phase': ('D_PHASE', 'CODE', 'VALUE'),
+        'roots': ('D_ROOTS', 'CODE', 'VALUE'),
+        'texture': ('D_TEXTURE_USDA', 'CODE', 'VALUE'),
+        'wrb4': ('D_WRB4', 'CODE', 'VALUE'),
+        'wrb2': ('D_WRB2', 'CODE', 'Value'),
+    }
 
-# D_TEXTURE_USDA - Texturas
-df_texture = pd.read_sql_query("SELECT * FROM D_TEXTURE_USDA", conn)
-texture_map = dict(zip(df_texture['CODE'], df_texture['VALUE']))
-print(f"✓ Texturas: {len(texture_map)} tipos")
+    def __init__(self, conn):
+        self._tablas = {
+            nombre: pd.read_sql_query(f"SELECT * FROM {tabla}", conn)
+            for nombre, (tabla, _, _) in self.TABLAS.items()
+        }
+        self._mapeadores = {}
+        self._dicts = {}
+        self._fases = {}
+        self._vertic = {}
+        # HWSD2_SMU_ID → (WRB4, WRB2, VERTIC_WRB); None si no está en HWSD2_SMU.
+        # Del menos al más recientemente usado, con a lo sumo MAX_ATRIBUTOS_SMU
+        self._atributos = OrderedDict()
+
+    def tabla(self, nombre):
+        return self._tablas[nombre]
+
+    def mapeador(self, nombre):
+        if nombre not in self._mapeadores:
+            _, clave, valor = self.TABLAS[nombre]
+            df = self._tablas[nombre]
+            self._mapeadores[nombre] = MapeadorCodigos(df[clave], df[valor])
+        return self._mapeadores[nombre]
+
+    def clasificacion_fases(self, fases):
+        """
+        Clasifica cada código de D_PHASE una sola vez (memorizado por lista de fases)
+
+        Retorna:
+        - Arreglo alineado con mapeador('phase').valores: el nombre de la fase
+          si contiene alguno de `fases`, None si no
+        """
+        clave = tuple(fases)
+        if clave not in self._fases:
+            nombres = self.mapeador('phase').valores
+            self._fases[clave] = np.array(
+                [nombre if any(p in str(nombre) for p in fases) else None for nombre in nombres],
+                dtype=object
+            )
+        return self._fases[clave]
+
+    def es_vertic(self, nombre, codigos):
+        """
+        Códigos WRB (nombre = 'wrb4' o 'wrb2') cuya denominación contiene "Vertic"
+
+        El texto se revisa una sola vez por código de la tabla D_*; cada
+        código se resuelve con una búsqueda en arreglos (desconocido = False).
+        """
+        if nombre not in self._vertic:
+            nombres = pd.Series(self.mapeador(nombre).valores, dtype=object)
+            self._vertic[nombre] = nombres.fillna('').astype(str).str.contains('Vertic', case=False).to_numpy()
+        posiciones = self.mapeador(nombre).posiciones(codigos)
+        return np.where(posiciones >= 0, self._vertic[nombre].take(posiciones), False)
+
+    def atributos_smu(self, conn, smu_ids):
+        """
+        WRB4, WRB2 y VERTIC_WRB (criterio 1 de VSP) por SMU, memorizados
+
+        Solo consulta HWSD2_SMU para los SMU que no se pidieron antes a este
+        registro; lo memorizado es un dict por SMU, así que cada bloque cuesta
+        lo mismo sin importar cuántos SMU se consultaron antes. Se conservan
+        los MAX_ATRIBUTOS_SMU SMU usados más recientemente. Los SMU que no
+        están en HWSD2_SMU no aparecen en el resultado.
+        """
+        smu_ids = pd.unique(np.asarray(smu_ids, dtype=np.int64)).tolist()
+        nuevos = [i for i in smu_ids if i not in self._atributos]
+        if nuevos:
+            df_smu = pd.read_sql_query(_consulta_wrb(_tabla_ids(conn, nuevos, 'pyaez_ids_smu')), conn)
+            df_smu = df_smu.drop_duplicates('HWSD2_SMU_ID', keep='last')
+            vertic = self.es_vertic('wrb4', df_smu['WRB4']) | self.es_vertic('wrb2', df_smu['WRB2'])
+            self._atributos.update(dict.fromkeys(nuevos))
+            self._atributos.update(zip(df_smu['HWSD2_SMU_ID'].tolist(),
+                                       zip(df_smu['WRB4'], df_smu['WRB2'], vertic.tolist())))
+
+        atributos = [self._atributos[i] for i in smu_ids]
+        presentes = [i for i, valor in zip(smu_ids, atributos) if valor is not None]
+        columnas = ['WRB4', 'WRB2', 'VERTIC_WRB']
+        df_atributos = pd.DataFrame([valor for valor in atributos if valor is not None], columns=columnas,
+                                    index=pd.Index(presentes, name='HWSD2_SMU_ID'))
+
+        # Los SMU de esta llamada pasan a ser los más recientes; se descartan
+        # los más antiguos (una sola llamada puede superar el límite)
+        for i in smu_ids:
+            self._atributos.move_to_end(i)
+        while len(self._atributos) > MAX_ATRIBUTOS_SMU:
+            self._atributos.popitem(last=False)
+        return df_atributos.astype({'VERTIC_WRB': bool})
+
+    def __getitem__(self, nombre):
+        if nombre not in self._dicts:
+            self._dicts[nombre] = self.mapeador(nombre).como_dict()
+        return self._dicts[nombre]
+
+# Registros memorizados: archivo de base de datos → (huella, RegistroTablas),
+# del menos al más recientemente usado
+_REGISTROS = OrderedDict()
+
+# Archivos de base de datos con registro memorizado a la vez (procesos de
+# larga duración y trabajadores de extraer_regiones no acumulan registros)
+MAX_REGISTROS = 8
+
+# SMU con atributos WRB memorizados por registro (ver atributos_smu): acota la
+# memoria de los procesos que recorren la base completa o muchas regiones
+MAX_ATRIBUTOS_SMU = 200_000
+
+def obtener_registro(conn):
+    """
+    Devuelve el RegistroTablas de la base de datos de conn (memorizado)
+
+    La clave es la ruta del archivo principal; si el archivo cambió (otra
+    huella, ver huella_bd) las tablas se recargan. Se conservan los
+    MAX_REGISTROS archivos usados más recientemente. Las bases en memoria o
+    temporales no se memorizan: no tienen una identidad estable (id(conn) se
+    reutiliza al cerrar la conexión), así que cada llamada carga sus tablas.
+    """
+    archivo = next((ruta for _, nombre, ruta in conn.execute("PRAGMA database_list") if nombre == 'main'), '')
+    if not archivo:
+        return RegistroTablas(conn)
+
+    clave, huella = str(Path(archivo).resolve()), huella_bd(archivo)
+    memorizado = _REGISTROS.get(clave)
+    if memorizado is None or memorizado[0] != huella:
+        memorizado = (huella, RegistroTablas(conn))
+        _REGISTROS[clave] = memorizado
+    _REGISTROS.move_to_end(clave)
+    while len(_REGISTROS) > MAX_REGISTROS:
+        _REGISTROS.popitem(last=False)
+    return memorizado[1]
+
+def cargar_tablas_referencia(conn, verbose=True):
+    """
+    Devuelve las tablas D_* de HWSD2 (ver RegistroTablas), leídas una vez por archivo
+    """
+    if verbose:
+        print("\n[1] Cargando tablas de referencia...")
+
+    tablas = obtener_registro(conn)
+
+    if verbose:
+        print(f"✓ Drenaje: {tablas['drainage']}")
+        print(f"✓ Fases: {len(tablas['phase'])} códigos")
+        print(f"✓ Obstáculos raíces: {tablas['roots']}")
+        print(f"✓ Texturas: {len(tablas['texture'])} tipos")
+
+    return tablas
 
 # ============================================================================
 # SECCIÓN 2: CÁLCULO DE VSP (Vertic Soil Phase)
 # ============================================================================
-print("\n" + "="*80)
-print("[2] CALCULANDO VSP (Vertic Soil Phase)")
-print("="*80)
 
-# Cargar clasificación WRB
-df_smu_wrb = pd.read_sql_query(f"""
-    SELECT HWSD2_SMU_ID, WRB4, WRB2
-    FROM HWSD2_SMU
-    WHERE HWSD2_SMU_ID IN ({','.join(map(str, ids_eswatini))})
-""", conn)
+def arcilla_d1(df_capas):
+    """
+    Criterio de arcilla de VSP a partir de los registros de HWSD2_LAYERS ya leídos
 
-df_wrb4 = pd.read_sql_query("SELECT * FROM D_WRB4", conn)
-df_wrb2 = pd.read_sql_query("SELECT * FROM D_WRB2", conn)
+    Promedia CLAY y CEC_CLAY de la capa D1 con CLAY > 0 por SMU, sin volver a
+    consultar HWSD2_LAYERS.
 
-wrb4_map = dict(zip(df_wrb4['CODE'], df_wrb4['VALUE']))
-wrb2_map = dict(zip(df_wrb2['CODE'], df_wrb2['Value']))
+    Retorna:
+    - DataFrame con HWSD2_SMU_ID y COLUMNAS_ARCILLA_VSP
+    """
+    df_d1 = df_capas[(df_capas['LAYER'] == 'D1') & (df_capas['CLAY'] > 0)]
+    df_arcilla = df_d1.groupby('HWSD2_SMU_ID')[['CLAY', 'CEC_CLAY']].mean()
+    df_arcilla.columns = COLUMNAS_ARCILLA_VSP
+    return df_arcilla.reset_index()
+
+def _consultar_arcilla_d1(conn, smu_ids):
+    return pd.read_sql_query(f"""
+        SELECT
+            HWSD2_SMU_ID,
+            AVG(CLAY) as ARCILLA_D1,
+            AVG(CEC_CLAY) as CEC_ARCILLA_D1
+        FROM HWSD2_LAYERS
+        WHERE HWSD2_SMU_ID IN ({_tabla_ids(conn, smu_ids)})
+          AND LAYER = 'D1'
+          AND CLAY > 0
+        GROUP BY HWSD2_SMU_ID
+    """, conn)
+
+def calcular_vsp(conn, smu_ids, verbose=True, tablas=None, df_arcilla=None):
+    """
+    Calcula VSP (0/1) para cada tipo de suelo
 
-df_smu_wrb['WRB4_NAME'] = df_smu_wrb['WRB4'].map(wrb4_map)
-df_smu_wrb['WRB2_NAME'] = df_smu_wrb['WRB2'].map(wrb2_map)
+    Criterio 1: Clasificación WRB (WRB4 o WRB2) contiene "Vertic"
+    Criterio 2: >35% arcilla + CEC_clay >40 en la capa D1
 
-# Criterio 1: Clasificación WRB contiene "Vertic"
-df_smu_wrb['VERTIC_WRB'] = df_smu_wrb['WRB4_NAME'].fillna('').str.contains('Vertic', case=False, na=False) | \
-                            df_smu_wrb['WRB2_NAME'].fillna('').str.contains('Vertic', case=False, na=False)
+    Parámetros:
+    - tablas: RegistroTablas (por defecto el de conn, ver obtener_registro)
+    - df_arcilla: Promedios de D1 por SMU ya calculados en la lectura de
+      capas (ver arcilla_d1 y obtener_consolidado_sql); si es None se
+      consultan en HWSD2_LAYERS
 
-# Criterio 2: >35% arcilla + CEC_clay >40 (arcillas expansivas tipo montmorillonita)
-df_clay_props = pd.read_sql_query(f"""
-    SELECT 
-        HWSD2_SMU_ID,
-        AVG(CLAY) as avg_clay,
-        AVG(CEC_CLAY) as avg_cec_clay
-    FROM HWSD2_LAYERS
-    WHERE HWSD2_SMU_ID IN ({','.join(map(str, ids_eswatini))})
-      AND LAYER = 'D1'
-      AND CLAY > 0
-    GROUP BY HWSD2_SMU_ID
-""", conn)
+    Retorna:
+    - dict HWSD2_SMU_ID → VSP
+    """
+    tablas = obtener_registro(conn) if tablas is None else tablas
+
+    if verbose:
+        print("\n" + "="*80)
+        print("[3] CALCULANDO VSP (Vertic Soil Phase)")
+        print("="*80)
+
+    # Criterio 1: Clasificación WRB contiene "Vertic" (precalculado por código)
+    df_vsp = tablas.atributos_smu(conn, smu_ids)
+
+    # Criterio 2: >35% arcilla + CEC_clay >40 (arcillas expansivas tipo montmorillonita)
+    if df_arcilla is None:
+        df_arcilla = _consultar_arcilla_d1(conn, smu_ids)
+    df_arcilla = df_arcilla.set_index('HWSD2_SMU_ID')[COLUMNAS_ARCILLA_VSP].reindex(df_vsp.index)
+    vertic_arcilla = ((df_arcilla['ARCILLA_D1'] > UMBRAL_ARCILLA_VSP)
+                      & (df_arcilla['CEC_ARCILLA_D1'] > UMBRAL_CEC_ARCILLA_VSP))
+
+    # Combinar criterios
+    vsp = (df_vsp['VERTIC_WRB'].to_numpy(dtype=bool) | vertic_arcilla.to_numpy(dtype=bool)).astype(int)
+    vsp_map = dict(zip(df_vsp.index, vsp))
+
+    if verbose:
+        print(f"✓ VSP calculado: {len(vsp_map)} suelos")
+        print(f"  - Vérticos (VSP=1): {sum(vsp_map.values())}")
+        print(f"  - No vérticos (VSP=0): {len(vsp_map) - sum(vsp_map.values())}")
+
+        if sum(vsp_map.values()) > 0:
+            vertic_soils = pd.DataFrame({
+                'HWSD2_SMU_ID': df_vsp.index,
+                'WRB4_NAME': tablas.mapeador('wrb4')(df_vsp['WRB4'].to_numpy()),
+                'avg_clay': df_arcilla['ARCILLA_D1'].to_numpy(),
+                'avg_cec_clay': df_arcilla['CEC_ARCILLA_D1'].to_numpy(),
+            })[vsp == 1]
+            print("\nSuelos vérticos identificados:")
+            print(vertic_soils.to_string(index=False))
+
+    return vsp_map
 
-df_clay_props['VERTIC_CLAY'] = (df_clay_props['avg_clay'] > 35) & (df_clay_props['avg_cec_clay'] > 40)
+# ============================================================================
+# SECCIÓN 3: EXTRACCIÓN DE DATOS DE CAPAS
+# ============================================================================
 
-# Combinar criterios
-df_vsp = df_smu_wrb.merge(df_clay_props[['HWSD2_SMU_ID', 'avg_clay', 'avg_cec_clay', 'VERTIC_CLAY']], 
-                          on='HWSD2_SMU_ID', how='left')
+def obtener_capas(conn, smu_ids, verbose=True, detalle=True):
+    """
+    Obtiene todos los registros de HWSD2_LAYERS para los tipos de suelo dados
 
-df_vsp['VSP'] = (df_vsp['VERTIC_WRB'] | df_vsp['VERTIC_CLAY'].fillna(False)).astype(int)
+    detalle=False omite el conteo de registros por capa.
+    """
+    if verbose:
+        print("\n" + "="*80)
+        print("[2] OBTENIENDO DATOS DE HWSD2_LAYERS")
+        print("="*80)
+
+    df_all = pd.read_sql_query(_consulta_capas(_tabla_ids(conn, smu_ids)), conn)
+
+    if verbose:
+        print(f"✓ Total registros: {len(df_all)}")
+        print(f"✓ SMU_IDs únicos: {df_all['HWSD2_SMU_ID'].nunique()}")
+        if detalle:
+            print(f"✓ Capas disponibles:")
+            print(df_all['LAYER'].value_counts().sort_index())
+
+    return df_all
+
+def _consulta_capas(filtro_ids=None):
+    """SELECT de HWSD2_LAYERS ordenado por SMU; filtro_ids: subconsulta de IDs (None = todos)"""
+    filtro = '' if filtro_ids is None else f"WHERE HWSD2_SMU_ID IN ({filtro_ids})"
+    return f"""
+    SELECT *
+    FROM HWSD2_LAYERS
+    {filtro}
+    ORDER BY HWSD2_SMU_ID, ID, TOPDEP
+    """
 
-vsp_map = dict(zip(df_vsp['HWSD2_SMU_ID'], df_vsp['VSP']))
+def _consulta_wrb(filtro_ids):
+    """SELECT de WRB4/WRB2 de HWSD2_SMU; filtro_ids: subconsulta de IDs"""
+    return f"""
+    SELECT HWSD2_SMU_ID, WRB4, WRB2
+    FROM HWSD2_SMU
+    WHERE HWSD2_SMU_ID IN ({filtro_ids})
+    """
 
-print(f"✓ VSP calculado: {len(vsp_map)} suelos")
-print(f"  - Vérticos (VSP=1): {sum(vsp_map.values())}")
-print(f"  - No vérticos (VSP=0): {len(vsp_map) - sum(vsp_map.values())}")
+def _lista_sql_texto(valores):
+    """Convierte una lista de textos en el literal usado por las cláusulas IN (...)"""
+    return ','.join("'{}'".format(str(v).replace("'", "''")) for v in valores)
 
-if sum(vsp_map.values()) > 0:
-    vertic_soils = df_vsp[df_vsp['VSP'] == 1][['HWSD2_SMU_ID', 'WRB4_NAME', 'avg_clay', 'avg_cec_clay']]
-    print("\nSuelos vérticos identificados:")
-    print(vertic_soils.to_string(index=False))
+def obtener_consolidado_sql(conn, smu_ids, capas, verbose=True):
+    """
+    Consolida los perfiles directamente en SQLite (sin traer HWSD2_LAYERS a pandas)
 
-# ============================================================================
-# SECCIÓN 3: EXTRACCIÓN DE DATOS DE CAPAS
-# ============================================================================
-print("\n" + "="*80)
-print("[3] OBTENIENDO DATOS DE HWSD2_LAYERS")
-print("="*80)
-
-query = """
-SELECT *
-FROM HWSD2_LAYERS
-WHERE HWSD2_SMU_ID IN ({})
-ORDER BY HWSD2_SMU_ID, ID, TOPDEP
-""".format(','.join(map(str, ids_eswatini)))
-
-df_all = pd.read_sql_query(query, conn)
-print(f"✓ Total registros: {len(df_all)}")
-print(f"✓ SMU_IDs únicos: {df_all['HWSD2_SMU_ID'].nunique()}")
-print(f"✓ Capas disponibles:")
-print(df_all['LAYER'].value_counts().sort_index())
+    Aplica en SQL la misma lógica que consolidar_perfiles:
+    - Filtro de validez ORG_CARBON > 0
+    - AVG para COLUMNAS_PROMEDIO
+    - Moda para COLUMNAS_MODA con ROW_NUMBER() sobre los conteos por valor
+      (más frecuente primero, menor valor en empate, NULL ignorado)
+    - COLUMNAS_ARCILLA_VSP (promedios de D1 con CLAY > 0 por SMU, ver
+      calcular_vsp) en la misma consulta, sin otra lectura de HWSD2_LAYERS
+
+    Requiere SQLite >= 3.25 (funciones de ventana). AVG no suma igual que
+    pandas: ver comparar_motores.
+
+    Retorna:
+    - DataFrame con una fila por (HWSD2_SMU_ID, LAYER), mismas columnas que
+      consolidar_perfiles más COLUMNAS_ARCILLA_VSP
+    """
+    if verbose:
+        print("\n" + "="*80)
+        print("[2] CONSOLIDANDO HWSD2_LAYERS EN SQLITE")
+        print("="*80)
+
+    df_consolidated = pd.read_sql_query(_consulta_consolidado(_tabla_ids(conn, smu_ids), capas), conn)
+
+    if verbose:
+        print(f"✓ Registros consolidados: {len(df_consolidated)}")
+        print(f"✓ SMU_IDs únicos: {df_consolidated['HWSD2_SMU_ID'].nunique()}")
+
+    return df_consolidated
+
+def _consulta_consolidado(filtro_ids, capas):
+    """Consulta de obtener_consolidado_sql; filtro_ids: subconsulta de IDs"""
+    columnas = COLUMNAS_PROMEDIO + COLUMNAS_MODA
+
+    # filas se usa dos veces: SQLite la materializa y lee HWSD2_LAYERS una sola vez
+    ctes = [f"""filas AS (
+        SELECT HWSD2_SMU_ID, LAYER, {', '.join(columnas)}
+        FROM HWSD2_LAYERS
+        WHERE HWSD2_SMU_ID IN ({filtro_ids})
+          AND LAYER IN ({_lista_sql_texto(list(dict.fromkeys(list(capas) + ['D1'])))})
+    )""", f"""validos AS (
+        SELECT HWSD2_SMU_ID, LAYER, {', '.join(columnas)}
+        FROM filas
+        WHERE LAYER IN ({_lista_sql_texto(capas)})
+          AND ORG_CARBON > 0
+    )""", """arcilla AS (
+        SELECT HWSD2_SMU_ID, AVG(CLAY) AS ARCILLA_D1, AVG(CEC_CLAY) AS CEC_ARCILLA_D1
+        FROM filas
+        WHERE LAYER = 'D1' AND CLAY > 0
+        GROUP BY HWSD2_SMU_ID
+    )""", f"""promedios AS (
+        SELECT HWSD2_SMU_ID, LAYER,
+               {', '.join(f'AVG({c}) AS {c}' for c in COLUMNAS_PROMEDIO)}
+        FROM validos
+        GROUP BY HWSD2_SMU_ID, LAYER
+    )"""]
+
+    # Una moda por columna (la más frecuente; empate → el menor valor). Se
+    # apilan en una sola CTE agregada: unidas con LEFT JOIN una a una, SQLite
+    # no indexa las subconsultas con ventana y el cruce es cuadrático
+    subconsultas = ' UNION ALL '.join(f"""
+            SELECT HWSD2_SMU_ID, LAYER, {i} AS columna, valor
+            FROM (
+                SELECT HWSD2_SMU_ID, LAYER, {c} AS valor,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY HWSD2_SMU_ID, LAYER
+                           ORDER BY COUNT(*) DESC, {c}
+                       ) AS rn
+                FROM validos
+                WHERE {c} IS NOT NULL
+                GROUP BY HWSD2_SMU_ID, LAYER, {c}
+            )
+            WHERE rn = 1""" for i, c in enumerate(COLUMNAS_MODA))
+    ctes.append(f"""modas AS (
+        SELECT HWSD2_SMU_ID, LAYER,
+               {', '.join(f'MAX(CASE WHEN columna = {i} THEN valor END) AS {c}'
+                          for i, c in enumerate(COLUMNAS_MODA))}
+        FROM ({subconsultas}
+        )
+        GROUP BY HWSD2_SMU_ID, LAYER
+    )""")
+
+    return f"""
+    WITH {', '.join(ctes)}
+    SELECT promedios.HWSD2_SMU_ID, promedios.LAYER,
+           {', '.join(f'promedios.{c}' for c in COLUMNAS_PROMEDIO)},
+           {', '.join(f'modas.{c}' for c in COLUMNAS_MODA)},
+           {', '.join(f'arcilla.{c}' for c in COLUMNAS_ARCILLA_VSP)}
+    FROM promedios
+    LEFT JOIN modas USING (HWSD2_SMU_ID, LAYER)
+    LEFT JOIN arcilla USING (HWSD2_SMU_ID)
+    ORDER BY promedios.HWSD2_SMU_ID, promedios.LAYER
+    """
 
 # ============================================================================
 # SECCIÓN 4: FUNCIÓN DE PROCESAMIENTO POR CAPA
@@ -231,43 +739,35 @@ def convertir_osd_a_cm(osd_code):
     """
     Convierte código OSD a valor numérico en cm (punto medio del rango)
     Referencia: D_ROOTS tabla HWSD2
+
+    Versión escalar de referencia; formatear_pyaez usa mapear_osd.
     """
-    osd_ranges = {
-        0: 0,      # Sin obstáculo
-        1: 90,     # >80 cm → usar 90 (profundo)
-        2: 70,     # 60-80 cm → punto medio 70
-        3: 50,     # 40-60 cm → punto medio 50
-        4: 30,     # 20-40 cm → punto medio 30
-        5: 40,     # 0-80 cm → punto medio 40 (rango amplio)
-        6: 10      # 0-20 cm → punto medio 10 (muy superficial)
-    }
-    
     try:
         code = int(osd_code)
-        return osd_ranges.get(code, 0)
+        return OSD_RANGOS.get(code, 0)
     except (ValueError, TypeError):
         return 0
 
 def clasificar_sph(phase1, phase2, phase_map):
     """
     SPH (Soil Phase High/Deep): Fases químicas o profundas
-    
+
     Fundamento: Limitaciones químicas o climáticas que afectan desarrollo del cultivo
     - Salic: Acumulación de sales solubles
     - Sodic: Alto contenido de sodio intercambiable
     - Gelic: Permafrost o congelamiento estacional
     - Aridic: Condiciones de aridez extrema
     - Yermic: Costra superficial en climas áridos
-    
+
     Prioridad: Busca en ambas fases (PHASE1 y PHASE2)
+
+    Versión escalar de referencia; formatear_pyaez usa clasificar_fases.
     """
-    sph_phases = ['Salic', 'Sodic', 'Gelic', 'Yermic', 'Aridic', 'Duric']
-    
     for phase_code in [phase1, phase2]:
         if pd.notna(phase_code):
             try:
                 phase_name = phase_map.get(int(phase_code), '')
-                if any(p in str(phase_name) for p in sph_phases):
+                if any(p in str(phase_name) for p in FASES_SPH):
                     return phase_name
             except (ValueError, TypeError):
                 pass
@@ -276,161 +776,354 @@ def clasificar_sph(phase1, phase2, phase_map):
 def clasificar_spr(phase1, phase2, phase_map):
     """
     SPR (Soil Phase Rocky): Fases físicas superficiales
-    
+
     Fundamento: Limitaciones físicas que afectan laborabilidad y desarrollo radicular
     - Stony: Fragmentos rocosos en superficie (15-40%)
     - Lithic: Roca continua cerca de superficie (<50cm)
     - Petric: Horizonte cementado (hardpan)
     - Skeletic: Alto contenido de gravas/piedras (>40%)
     - Rudic: Fragmentos gruesos muy abundantes
-    
+
     Prioridad: PHASE1 primero (fase dominante >15% área)
+
+    Versión escalar de referencia; formatear_pyaez usa clasificar_fases.
     """
-    spr_phases = ['Stony', 'Lithic', 'Petric', 'Skeletic', 'Rudic', 'Gravelly']
-    
     for phase_code in [phase1, phase2]:
         if pd.notna(phase_code):
             try:
                 phase_name = phase_map.get(int(phase_code), '')
-                if any(p in str(phase_name) for p in spr_phases):
+                if any(p in str(phase_name) for p in FASES_SPR):
                     return phase_name
             except (ValueError, TypeError):
                 pass
     return 0
 
-def generar_pyaez_por_capa(df, layer_name):
+def _es_texto(serie):
+    """Máscara de valores str (los numéricos y NaN/None quedan en False)"""
+    if pd.api.types.is_numeric_dtype(serie):
+        return np.zeros(len(serie), dtype=bool)
+    if pd.api.types.is_string_dtype(serie) and pd.api.types.infer_dtype(serie, skipna=True) in ('string', 'empty'):
+        return serie.notna().to_numpy()
+    # Columna object mixta: único caso que revisa valor por valor
+    return np.fromiter((isinstance(v, str) for v in serie), dtype=bool, count=len(serie))
+
+def _codigos_enteros(serie):
     """
-    Genera formato PyAEZ para una capa específica
-    
-    Parámetros:
-    - df: DataFrame con datos de HWSD2_LAYERS
-    - layer_name: Nombre de capa (D1-D7)
-    
+    Equivalente vectorizado de int(codigo) para búsquedas en tablas de códigos
+
+    Trunca los números como int(); los textos solo se aceptan si int() los
+    acepta (dígitos con signo opcional). Devuelve float con NaN donde int()
+    fallaría (NaN, None, textos no enteros, infinitos).
+    """
+    serie = pd.Series(serie)
+    if pd.api.types.is_numeric_dtype(serie):
+        valores = serie.to_numpy(dtype=float, na_value=np.nan)
+    else:
+        texto = _es_texto(serie)
+        valores = pd.to_numeric(serie.where(~texto), errors='coerce').to_numpy(dtype=float, na_value=np.nan, copy=True)
+        if texto.any():
+            textos = serie[texto].astype(str)
+            enteros = textos.str.fullmatch(r'\s*[+-]?\d+\s*').to_numpy(dtype=bool)
+            valores[np.flatnonzero(texto)[enteros]] = pd.to_numeric(textos[enteros]).to_numpy(dtype=float)
+
+    valores = np.trunc(valores)
+    valores[~np.isfinite(valores)] = np.nan
+    return valores
+
+# Mapeador de OSD_RANGOS memorizado: (copia de OSD_RANGOS, MapeadorCodigos)
+_MAPEADOR_OSD = (None, None)
+
+def _mapeador_osd():
+    """MapeadorCodigos de OSD_RANGOS; solo se reconstruye si OSD_RANGOS cambió"""
+    global _MAPEADOR_OSD
+    rangos, mapeador = _MAPEADOR_OSD
+    if rangos != OSD_RANGOS:
+        rangos = dict(OSD_RANGOS)
+        mapeador = MapeadorCodigos(rangos.keys(), rangos.values())
+        _MAPEADOR_OSD = (rangos, mapeador)
+    return mapeador
+
+def mapear_osd(roots):
+    """
+    OSD vectorizado: código D_ROOTS → cm según OSD_RANGOS (0 si no es válido)
+
+    Equivale a roots.apply(convertir_osd_a_cm).
+    """
+    return pd.Series(_mapeador_osd()(_codigos_enteros(roots), defecto=0), index=roots.index).astype(int)
+
+def mapear_drenaje(drainage, tablas):
+    """
+    DRG vectorizado: textos se conservan, códigos numéricos se buscan en D_DRAINAGE
+
+    Equivale a la regla escalar original: NaN → '', texto → el mismo texto,
+    número → drainage_map.get(int(valor), ''), cualquier otro valor → ''.
+    """
+    texto = _es_texto(drainage)
+    valores = tablas.mapeador('drainage')(_codigos_enteros(drainage.where(~texto)), defecto='')
+    valores = np.where(texto, drainage.to_numpy(dtype=object), valores)
+    return pd.Series(valores, index=drainage.index, dtype=object)
+
+def clasificar_fases(phase1, phase2, tablas, fases):
+    """
+    SPH/SPR vectorizado: nombre de la primera fase (PHASE1, luego PHASE2) que
+    contiene alguno de los nombres de `fases`, o 0 si ninguna
+
+    La clasificación se hace una sola vez por código de D_PHASE
+    (RegistroTablas.clasificacion_fases) y cada registro se resuelve con
+    búsquedas en arreglos. Equivale a clasificar_sph/clasificar_spr.
+    """
+    mapeador = tablas.mapeador('phase')
+    clasificacion = tablas.clasificacion_fases(fases)
+    resultado = np.zeros(len(phase1), dtype=object)
+    if len(clasificacion) == 0:
+        return pd.Series(resultado, index=phase1.index)
+
+    # PHASE2 primero y PHASE1 encima: PHASE1 tiene prioridad
+    for serie in (phase2, phase1):
+        posiciones = mapeador.posiciones(_codigos_enteros(serie))
+        encontrado = np.where(posiciones >= 0, clasificacion.take(posiciones), None)
+        hay_fase = np.not_equal(encontrado, None)
+        resultado[hay_fase] = encontrado[hay_fase]
+
+    return pd.Series(resultado, index=phase1.index)
+
+def _moda_por_grupo(df, claves, columna, pesos=None):
+    """
+    Moda vectorizada de una columna por grupo (equivale a series.mode()[0])
+
+    Cuenta las combinaciones (claves, valor) ignorando NaN y se queda con el
+    valor más frecuente; en empate gana el menor valor, igual que
+    Series.mode(), que devuelve las modas ordenadas. Los grupos sin ningún
+    valor quedan fuera del resultado (NaN al reindexar). Con pesos (nombre
+    de columna) gana el valor de mayor peso total en lugar del más frecuente.
+    """
+    grupos = df.groupby(claves + [columna], sort=False)
+    if pesos is None:
+        conteos = grupos.size().reset_index(name='_n')
+    else:
+        conteos = grupos[pesos].sum().reset_index(name='_n')
+    conteos = conteos.sort_values(
+        claves + ['_n', columna],
+        ascending=[True] * len(claves) + [False, True],
+        kind='mergesort'
+    )
+    return conteos.drop_duplicates(claves).set_index(claves)[columna]
+
+def consolidar_perfiles(df_valid, claves=CLAVES_CONSOLIDACION):
+    """
+    Consolida múltiples perfiles del mismo tipo de suelo en una sola pasada
+
+    Agrupa por (HWSD2_SMU_ID, LAYER) todas las capas a la vez: promedio para
+    COLUMNAS_PROMEDIO y moda vectorizada para COLUMNAS_MODA.
+
     Retorna:
-    - DataFrame en formato PyAEZ
-    """
-    print(f"\n{'='*80}")
-    print(f"[4.{layer_name}] PROCESANDO CAPA {layer_name}")
-    print(f"{'='*80}")
-    
-    df_layer = df[df['LAYER'] == layer_name].copy()
-    print(f"✓ Registros en {layer_name}: {len(df_layer)}")
-    
-    # Filtrar registros válidos (ORG_CARBON > 0 indica dato real)
-    df_valid = df_layer[df_layer['ORG_CARBON'] > 0].copy()
-    print(f"✓ Registros válidos: {len(df_valid)}")
-    
-    if len(df_valid) == 0:
-        print(f"⚠️  No hay datos válidos para {layer_name}")
-        return None
-    
-    # ========================================================================
-    # CONSOLIDACIÓN: Promediar múltiples perfiles del mismo tipo de suelo
-    # ========================================================================
-    print(f"✓ Consolidando múltiples perfiles...")
-    
-    def get_mode_or_first(series):
-        """Obtiene moda (valor más frecuente) o primer valor"""
-        mode = series.mode()
-        return mode[0] if len(mode) > 0 else series.iloc[0]
-    
-    # Agregación por tipo de suelo
-    df_consolidated = df_valid.groupby('HWSD2_SMU_ID').agg({
-        'TEXTURE_USDA': get_mode_or_first,
-        'ORG_CARBON': 'mean',
-        'PH_WATER': 'mean',
-        'TEB': 'mean',
-        'CEC_SOIL': 'mean',
-        'CEC_CLAY': 'mean',
-        'ROOT_DEPTH': get_mode_or_first,
-        'PHASE1': get_mode_or_first,
-        'PHASE2': get_mode_or_first,
-        'ROOTS': get_mode_or_first,
-        'DRAINAGE': get_mode_or_first,
-        'ESP': 'mean',
-        'ELEC_COND': 'mean',
-        'TCARBON_EQ': 'mean',
-        'GYPSUM': 'mean',
-        'COARSE': 'mean'
-    }).reset_index()
-    
-    print(f"✓ Tipos de suelo consolidados: {len(df_consolidated)}")
-    
+    - DataFrame con una fila por tipo de suelo y capa
+    """
+    df_consolidated = df_valid.groupby(claves)[COLUMNAS_PROMEDIO].mean()
+
+    for columna in COLUMNAS_MODA:
+        df_consolidated[columna] = _moda_por_grupo(df_valid, claves, columna).reindex(df_consolidated.index)
+
+    return df_consolidated.reset_index()
+
+def consolidar_ponderado(df_valid, pesos, claves=CLAVES_CONSOLIDACION):
+    """
+    Variante de consolidar_perfiles con un peso por registro
+
+    pesos es la columna de df_valid con el peso de cada registro (p. ej. cm
+    de espesor dentro de un intervalo de profundidad). Promedio ponderado
+    para COLUMNAS_PROMEDIO, donde los NaN no suman peso, y moda ponderada
+    para COLUMNAS_MODA: el valor con mayor peso total. Con pesos iguales
+    dentro de cada grupo el resultado es idéntico (bit a bit) al de
+    consolidar_perfiles.
+
+    Retorna:
+    - DataFrame con una fila por grupo de claves
+    """
+    grupos = [df_valid[clave] for clave in claves]
+    # Pesos relativos al mayor de su grupo: con pesos iguales valen 1.0 y
+    # las sumas son las mismas (y en el mismo orden) que las de la media de
+    # consolidar_perfiles, sin diferencias de redondeo en la salida
+    peso = df_valid[pesos].groupby(grupos).transform('max')
+    peso = (df_valid[pesos] / peso).to_numpy(dtype=float)[:, None]
+    valores = df_valid[COLUMNAS_PROMEDIO].to_numpy(dtype=float)
+    con_dato = ~np.isnan(valores)
+
+    # Los NaN quedan fuera de ambas sumas (no suman peso ni valor)
+    sumas = pd.DataFrame(valores * peso, columns=COLUMNAS_PROMEDIO, index=df_valid.index)
+    pesos_con_dato = pd.DataFrame(np.where(con_dato, peso, np.nan), columns=COLUMNAS_PROMEDIO, index=df_valid.index)
+    df_consolidated = sumas.groupby(grupos).sum() / pesos_con_dato.groupby(grupos).sum()
+
+    for columna in COLUMNAS_MODA:
+        df_consolidated[columna] = _moda_por_grupo(df_valid, claves, columna, pesos).reindex(df_consolidated.index)
+
+    return df_consolidated.reset_index()
+
+def _texto_categoria(valor):
+    """Valor de una variable de texto como str (los códigos numéricos como '14', no '14.0')"""
+    if isinstance(valor, str):
+        return valor
+    if float(valor).is_integer():
+        return str(int(valor))
+    return str(valor)
+
+def _a_categoria(serie, vacio=None):
+    """
+    Convierte una columna de texto (object mixta o categórica) en categórica de str
+
+    Solo recorre los valores distintos (pd.factorize); vacio (0 → '0', '')
+    se convierte en NaN, el faltante único del esquema tipado.
+    """
+    codigos, unicos = pd.factorize(serie)
+    valores = [_texto_categoria(v) for v in unicos]
+    vacio = None if vacio is None else _texto_categoria(vacio)
+    categorias = sorted({v for v in valores if v != vacio})
+    posicion = {v: i for i, v in enumerate(categorias)}
+    traduccion = np.array([posicion.get(v, -1) for v in valores] + [-1], dtype=np.int32)
+    return pd.Categorical.from_codes(traduccion[codigos], categories=categorias)
+
+def tipar_pyaez(df_pyaez):
+    """
+    Convierte un DataFrame PyAEZ al esquema tipado TIPOS_PYAEZ
+
+    TXT, DRG, SPR, SPH y LAYER pasan a categóricas de str con NaN como único
+    faltante (SPR/SPH sin fase y DRG sin drenaje, ver VACIOS_PYAEZ); los
+    enteros usan el tipo más angosto de su rango, y los valores fuera de ese
+    rango se saturan en su mínimo o máximo en lugar de desbordarse. Acepta
+    registros ya tipados, leídos de un archivo de salida o de la caché.
+    exportar_pyaez hace la conversión inversa.
+    """
+    df_pyaez = df_pyaez.copy()
+    for columna, tipo in TIPOS_PYAEZ.items():
+        if columna not in df_pyaez.columns:
+            continue
+        if tipo == 'category':
+            df_pyaez[columna] = _a_categoria(df_pyaez[columna], VACIOS_PYAEZ.get(columna))
+        elif tipo.startswith('int'):
+            limites = np.iinfo(tipo)
+            df_pyaez[columna] = df_pyaez[columna].clip(limites.min, limites.max).astype(tipo)
+        else:
+            df_pyaez[columna] = df_pyaez[columna].astype(tipo)
+    return df_pyaez
+
+def exportar_pyaez(df_pyaez):
+    """
+    Adaptador de exportación: valores PyAEZ originales a partir del esquema tipado
+
+    SPR/SPH vuelven a 0 sin fase, DRG a '' sin drenaje, los códigos de
+    textura sin nombre a número, y los enteros a int64. Es el formato que se
+    escribe en Excel/CSV y en la caché.
+    """
+    df_pyaez = tipar_pyaez(df_pyaez)
+    for columna, tipo in TIPOS_PYAEZ.items():
+        if columna not in df_pyaez.columns:
+            continue
+        if tipo == 'category':
+            serie = df_pyaez[columna]
+            categorias = list(serie.cat.categories)
+            if columna == 'TXT':
+                categorias = [float(v) if v.lstrip('+-').isdigit() else v for v in categorias]
+            valores = np.array(categorias + [VACIOS_PYAEZ.get(columna, np.nan)], dtype=object)
+            df_pyaez[columna] = valores[serie.cat.codes.to_numpy()]
+        elif tipo.startswith('int'):
+            df_pyaez[columna] = df_pyaez[columna].astype(np.int64)
+    return df_pyaez
+
+def concatenar_pyaez(dfs):
+    """
+    pd.concat de DataFrames PyAEZ tipados que conserva las columnas categóricas
+
+    pd.concat convierte a object las categóricas con categorías distintas:
+    antes de unir se reemplazan por la unión ordenada de las categorías.
+    """
+    dfs = list(dfs)
+    unificadas = {}
+    for columna in dfs[0].columns:
+        tipos = [df[columna].dtype for df in dfs if columna in df.columns]
+        if not all(isinstance(tipo, pd.CategoricalDtype) for tipo in tipos):
+            continue
+        if any(not tipo.categories.equals(tipos[0].categories) for tipo in tipos):
+            unificadas[columna] = sorted(set().union(*(tipo.categories for tipo in tipos)))
+
+    if unificadas:
+        dfs = [df.assign(**{columna: df[columna].cat.set_categories(categorias)
+                            for columna, categorias in unificadas.items() if columna in df.columns})
+               for df in dfs]
+    return pd.concat(dfs, ignore_index=True)
+
+def formatear_pyaez(df_consolidated, tablas, vsp_map, reglas=None, violaciones=None):
+    """
+    Convierte registros consolidados al formato PyAEZ (19 variables)
+
+    Conserva la columna LAYER si está presente en df_consolidated. Retorna
+    el esquema tipado (ver tipar_pyaez).
+
+    Los rangos, faltantes y consistencia se resuelven con validar_registros
+    (reglas: lista de reglas, por defecto REGLAS_VALIDACION). Si violaciones
+    es una lista, se le agrega la tabla de violaciones de estos registros.
+    """
+    df_consolidated = df_consolidated.copy()
+
     # ========================================================================
     # MAPEO DE VARIABLES CATEGÓRICAS
     # ========================================================================
-    
+
     # TXT: Textura USDA
-    df_consolidated['TXT'] = df_consolidated['TEXTURE_USDA'].map(texture_map).fillna(df_consolidated['TEXTURE_USDA'])
-    
+    df_consolidated['TXT'] = tablas.mapeador('texture')(df_consolidated['TEXTURE_USDA']).fillna(df_consolidated['TEXTURE_USDA'])
+
     # DRG: Drenaje (maneja códigos numéricos y texto)
-    def map_drainage(val):
-        if pd.isna(val):
-            return ''
-        if isinstance(val, str):
-            return val
-        try:
-            return drainage_map.get(int(val), '')
-        except (ValueError, TypeError):
-            return ''
-    
-    df_consolidated['DRG'] = df_consolidated['DRAINAGE'].apply(map_drainage)
-    
+    df_consolidated['DRG'] = mapear_drenaje(df_consolidated['DRAINAGE'], tablas)
+
     # SPH y SPR: Fases del suelo
-    df_consolidated['SPH'] = df_consolidated.apply(
-        lambda row: clasificar_sph(row['PHASE1'], row['PHASE2'], phase_map), 
-        axis=1
-    )
-    
-    df_consolidated['SPR'] = df_consolidated.apply(
-        lambda row: clasificar_spr(row['PHASE1'], row['PHASE2'], phase_map), 
-        axis=1
-    )
-    
+    df_consolidated['SPH'] = clasificar_fases(df_consolidated['PHASE1'], df_consolidated['PHASE2'], tablas, FASES_SPH)
+    df_consolidated['SPR'] = clasificar_fases(df_consolidated['PHASE1'], df_consolidated['PHASE2'], tablas, FASES_SPR)
+
     # OSD: Obstáculo a raíces
-    df_consolidated['OSD'] = df_consolidated['ROOTS'].apply(convertir_osd_a_cm)
-    
+    df_consolidated['OSD'] = mapear_osd(df_consolidated['ROOTS'])
+
     # VSP: Fase vértica
     df_consolidated['VSP'] = df_consolidated['HWSD2_SMU_ID'].map(vsp_map).fillna(0).astype(int)
-    
+
     # ========================================================================
     # CÁLCULO DE BS (Base Saturation)
     # ========================================================================
     # Fundamento: BS = (TEB / CEC_soil) × 100
     # NO se debe promediar BS directamente, sino recalcular desde TEB/CEC
-    
+
     df_consolidated['BS_calculated'] = (
         (df_consolidated['TEB'] / df_consolidated['CEC_SOIL']) * 100
-    ).fillna(0)
-    
-    # Validar rango 0-100%
-    df_consolidated['BS_calculated'] = df_consolidated['BS_calculated'].clip(0, 100)
-    
+    )
+
     # ========================================================================
-    # VALIDACIÓN DE RANGOS (Agregar controles de calidad)
+    # VALIDACIÓN: RANGOS, FALTANTES Y CONSISTENCIA (ver REGLAS_VALIDACION)
     # ========================================================================
-    
-    # pH debe estar entre 3.0 y 11.0
-    df_consolidated['PH_WATER'] = df_consolidated['PH_WATER'].clip(3.0, 11.0)
-    
-    # ESP debe estar entre 0 y 100
-    df_consolidated['ESP'] = df_consolidated['ESP'].clip(0, 100)
-    
+    # BS 0-100%, pH 3.0-11.0, ESP 0-100 y valores por defecto de faltantes
+
+    df_consolidated, df_violaciones = validar_registros(df_consolidated, reglas)
+    if violaciones is not None:
+        violaciones.append(df_violaciones)
+
     # ========================================================================
     # CREACIÓN DEL DATAFRAME FINAL PyAEZ
     # ========================================================================
-    
+
     def safe_int(series, default=0):
-        """Convierte a entero manejando NaN"""
+        """
+        Convierte a entero manejando NaN e infinitos
+
+        Los valores no finitos (BS con CEC_soil = 0 cuando BS_rango solo
+        reporta) se tratan como faltantes y reciben default.
+        """
+        series = series.where(np.isfinite(series.to_numpy(dtype=float)))
         return series.fillna(default).round(0).astype(int)
-    
+
     df_pyaez = pd.DataFrame({
         'CODE': df_consolidated['HWSD2_SMU_ID'],
         'TXT': df_consolidated['TXT'],
         'OC': df_consolidated['ORG_CARBON'].fillna(0).round(3),
         'pH': df_consolidated['PH_WATER'].fillna(7.0).round(1),
         'TEB': df_consolidated['TEB'].fillna(0).round(1),
-        'BS': safe_int(df_consolidated['BS_calculated'], 0),  
+        'BS': safe_int(df_consolidated['BS_calculated'], 0),
         'CEC_soil': safe_int(df_consolidated['CEC_SOIL'], 0),
         'CEC_clay': safe_int(df_consolidated['CEC_CLAY'], 0),
         'RSD': safe_int(df_consolidated['ROOT_DEPTH'], 100),
@@ -445,94 +1138,1585 @@ def generar_pyaez_por_capa(df, layer_name):
         'GRC': safe_int(df_consolidated['COARSE'], 0),
         'VSP': df_consolidated['VSP'].astype(int)
     })
-    
-    df_pyaez = df_pyaez.sort_values('CODE').reset_index(drop=True)
-    
+
+    if 'LAYER' in df_consolidated.columns:
+        df_pyaez.insert(1, 'LAYER', df_consolidated['LAYER'])
+
+    return tipar_pyaez(df_pyaez)
+
+def _vista_previa(df_pyaez, layer_name, detalle=True):
     print(f"\n✓ Capa {layer_name} procesada: {len(df_pyaez)} tipos de suelo")
-    print(f"\nPrimeras 3 filas:")
-    print(df_pyaez.head(3).to_string(index=False))
-    
-    return df_pyaez
+    if detalle:
+        print(f"\nPrimeras 3 filas:")
+        print(exportar_pyaez(df_pyaez.head(3)).to_string(index=False))
+
+def generar_pyaez_por_capa(df, layer_name, tablas, vsp_map, verbose=True):
+    """
+    Genera formato PyAEZ para una capa específica
+
+    Parámetros:
+    - df: DataFrame con datos de HWSD2_LAYERS
+    - layer_name: Nombre de capa (D1-D7)
+    - tablas: Tablas de referencia (ver cargar_tablas_referencia)
+    - vsp_map: dict HWSD2_SMU_ID → VSP (ver calcular_vsp)
+    - verbose: Imprime el progreso y una vista previa de la capa
+
+    Retorna:
+    - DataFrame en formato PyAEZ (None si la capa no tiene datos válidos)
+    """
+    return procesar_capas(df, [layer_name], tablas, vsp_map, verbose=verbose).get(layer_name)
 
 # ============================================================================
 # SECCIÓN 5: PROCESAMIENTO DE TODAS LAS CAPAS
 # ============================================================================
-print("\n" + "="*80)
-print("[5] GENERANDO ARCHIVOS POR CAPA")
-print("="*80)
 
-resultados = {}
-capas = ['D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7']
+def procesar_capas(df_all, capas, tablas, vsp_map, verbose=True, detalle=True, reglas=None, violaciones=None):
+    """
+    Consolida todas las capas solicitadas en una sola pasada
+
+    Filtra las capas y los registros válidos (ORG_CARBON > 0), agrupa por
+    (HWSD2_SMU_ID, LAYER) y separa el resultado por capa. detalle=False
+    omite la vista previa de cada capa; reglas y violaciones se pasan a
+    formatear_pyaez.
+
+    Retorna:
+    - dict capa → DataFrame PyAEZ (solo capas con datos válidos)
+    """
+    if verbose:
+        print("\n" + "="*80)
+        print("[4] CONSOLIDANDO CAPAS " + ", ".join(capas))
+        print("="*80)
+
+    df_capas = df_all[df_all['LAYER'].isin(capas)]
+
+    # Filtrar registros válidos (ORG_CARBON > 0 indica dato real)
+    df_valid = df_capas[df_capas['ORG_CARBON'] > 0]
+
+    if verbose:
+        registros = df_capas['LAYER'].value_counts()
+        validos = df_valid['LAYER'].value_counts()
+        for capa in capas:
+            print(f"✓ {capa}: {registros.get(capa, 0)} registros, {validos.get(capa, 0)} válidos")
+
+    # ========================================================================
+    # CONSOLIDACIÓN: Promediar múltiples perfiles del mismo tipo de suelo
+    # ========================================================================
+    df_consolidated = consolidar_perfiles(df_valid)
+
+    df_pyaez_all = formatear_pyaez(df_consolidated, tablas, vsp_map, reglas=reglas, violaciones=violaciones)
+    return separar_por_capa(df_pyaez_all, capas, verbose=verbose, detalle=detalle)
+
+def separar_por_capa(df_pyaez_all, capas, verbose=True, detalle=True):
+    """
+    Separa el DataFrame PyAEZ de todas las capas en un dict capa → DataFrame
+
+    Cada capa queda ordenada por CODE y sin la columna LAYER. detalle=False
+    omite la vista previa de cada capa.
+    """
+    resultados = {}
+    for capa, df_pyaez in df_pyaez_all.groupby('LAYER', sort=False, observed=True):
+        resultados[capa] = df_pyaez.drop(columns='LAYER').sort_values('CODE').reset_index(drop=True)
 
-for capa in capas:
-    df_pyaez = generar_pyaez_por_capa(df_all, capa)
-    if df_pyaez is not None:
-        resultados[capa] = df_pyaez
+    resultados = {capa: resultados[capa] for capa in capas if capa in resultados}
+
+    if verbose:
+        for capa in capas:
+            if capa in resultados:
+                _vista_previa(resultados[capa], capa, detalle)
+            else:
+                print(f"\n⚠️  No hay datos válidos para {capa}")
+
+    return resultados
 
 # ============================================================================
 # SECCIÓN 6: CREAR ARCHIVO CONSOLIDADO MULTICAPA
 # ============================================================================
-print("\n" + "="*80)
-print("[6] CREANDO ARCHIVO CONSOLIDADO MULTICAPA")
-print("="*80)
 
-dfs_con_layer = []
-for capa, df in resultados.items():
-    df_temp = df.copy()
-    df_temp.insert(1, 'LAYER', capa)
-    dfs_con_layer.append(df_temp)
+def combinar_capas(resultados):
+    """
+    Une los DataFrames por capa en una sola tabla con la columna LAYER
+    """
+    if not resultados:
+        raise ValueError("No hay datos válidos para ninguna capa de los IDs solicitados")
+
+    capas = sorted(resultados)
+    dfs_con_layer = []
+    for capa, df in resultados.items():
+        df_temp = df.copy()
+        df_temp.insert(1, 'LAYER', pd.Categorical.from_codes(np.full(len(df), capas.index(capa)), categories=capas))
+        dfs_con_layer.append(df_temp)
 
-df_multicapa = pd.concat(dfs_con_layer, ignore_index=True)
+    return concatenar_pyaez(dfs_con_layer)
 
-# Guardar archivo final
-output_filename = "eswatini_soil_ALL_LAYERS_pyaez.xlsx"
-df_multicapa.to_excel(output_filename, index=False)
+def detectar_formato(ruta, formato=None):
+    """
+    Resuelve el formato de salida ('excel', 'csv', 'parquet', 'feather')
+
+    Si formato es None se deduce de la extensión de la ruta.
+    """
+    if formato is None:
+        extension = Path(ruta).suffix.lower()
+        if extension not in EXTENSIONES_FORMATO:
+            raise ValueError(f"No se reconoce el formato de {ruta!r} "
+                             f"(extensiones: {', '.join(EXTENSIONES_FORMATO)})")
+        return EXTENSIONES_FORMATO[extension]
+    if formato not in FORMATOS_SALIDA:
+        raise ValueError(f"Formato desconocido: {formato!r} (opciones: {', '.join(FORMATOS_SALIDA)})")
+    return formato
+
+def _preparar_columnar(df):
+    """
+    Adapta un DataFrame PyAEZ a formatos columnares (Parquet/Feather)
+
+    Parte del esquema tipado (enteros angostos, COLUMNAS_DICCIONARIO y LAYER
+    categóricas, codificadas como diccionario en el archivo) y conserva los
+    valores de texto de PyAEZ para las categorías ausentes ('0' = sin fase,
+    '' = sin drenaje).
+    """
+    df = tipar_pyaez(df)
+    for columna, vacio in VACIOS_PYAEZ.items():
+        if columna in df.columns:
+            vacio = _texto_categoria(vacio)
+            df[columna] = df[columna].cat.add_categories([vacio]).fillna(vacio)
+    return df
+
+def escribir_salida(df, ruta, formato=None):
+    """
+    Escribe un DataFrame PyAEZ en Excel, CSV, Parquet o Feather (Arrow IPC)
+
+    Excel y CSV reciben los valores PyAEZ originales (ver exportar_pyaez).
+    Parquet y Feather requieren pyarrow.
+    """
+    formato = detectar_formato(ruta, formato)
+    if formato == 'excel':
+        exportar_pyaez(df).to_excel(ruta, index=False)
+    elif formato == 'csv':
+        exportar_pyaez(df).to_csv(ruta, index=False)
+    elif formato == 'parquet':
+        _preparar_columnar(df).to_parquet(ruta, index=False)
+    else:
+        _preparar_columnar(df).to_feather(ruta)
+
+def archivos_particionados(directorio, formato=None):
+    """
+    Archivos de una carpeta particionada por capa (ver guardar_resultados)
+
+    Todos los archivos con extensión de salida reconocida (solo los de
+    formato, si se indica); el nombre sin extensión es la capa o el
+    intervalo (D1, 0-30, 0-RSD, ...).
+    """
+    archivos = [archivo for archivo in sorted(Path(directorio).iterdir())
+                if archivo.is_file() and archivo.suffix.lower() in EXTENSIONES_FORMATO]
+    if formato is not None:
+        archivos = [archivo for archivo in archivos if detectar_formato(archivo) == detectar_formato(None, formato)]
+    return archivos
+
+def leer_salida(ruta, formato=None):
+    """
+    Lee un archivo (o carpeta particionada por capa) generado por escribir_salida
+
+    En una carpeta, cada archivo es una capa o intervalo y su nombre sin
+    extensión pasa a la columna LAYER.
+    """
+    ruta = Path(ruta)
+    if ruta.is_dir():
+        dfs = []
+        for archivo in archivos_particionados(ruta, formato):
+            df = leer_salida(archivo, formato)
+            if 'LAYER' not in df.columns:
+                df.insert(1, 'LAYER', archivo.stem)
+            dfs.append(df)
+        if not dfs:
+            raise ValueError(f"No hay archivos de salida en {ruta}")
+        return pd.concat(dfs, ignore_index=True)
+
+    formato = detectar_formato(ruta, formato)
+    if formato == 'excel':
+        return pd.read_excel(ruta)
+    if formato == 'csv':
+        return pd.read_csv(ruta)
+    if formato == 'parquet':
+        return pd.read_parquet(ruta)
+    return pd.read_feather(ruta)
+
+def guardar_resultados(resultados, ruta, formato=None, particionar_por_capa=False, verbose=True):
+    """
+    Guarda los resultados por capa en un archivo multicapa o particionados
+
+    Parámetros:
+    - resultados: dict capa → DataFrame PyAEZ (ver procesar_capas)
+    - ruta: Archivo de salida; con particionar_por_capa, carpeta que recibe
+      un archivo por capa o intervalo (D1.parquet, 0-30.parquet, ...)
+    - formato: 'excel', 'csv', 'parquet' o 'feather' (None = según extensión;
+      con particionar_por_capa por defecto 'parquet')
+    """
+    if not particionar_por_capa:
+        guardar_multicapa(combinar_capas(resultados), ruta, formato=formato, verbose=verbose)
+        return
+
+    formato = formato or 'parquet'
+    directorio = Path(ruta)
+    directorio.mkdir(parents=True, exist_ok=True)
+    for capa, df_pyaez in resultados.items():
+        archivo = directorio / f"{capa}{EXTENSION_POR_FORMATO[formato]}"
+        escribir_salida(df_pyaez, archivo, formato)
+        if verbose:
+            print(f"✓ Guardado: {archivo} ({len(df_pyaez)} registros)")
+
+def guardar_multicapa(df_multicapa, output_filename, formato=None, verbose=True):
+    """
+    Guarda el archivo consolidado multicapa (formato según extensión o parámetro)
+    """
+    if verbose:
+        print("\n" + "="*80)
+        print("[6] CREANDO ARCHIVO CONSOLIDADO MULTICAPA")
+        print("="*80)
+
+    escribir_salida(df_multicapa, output_filename, formato)
 
-print(f"✓ Guardado: {output_filename}")
-print(f"  - {len(df_multicapa)} registros totales")
-print(f"  - {df_multicapa['CODE'].nunique()} tipos de suelo únicos")
-print(f"  - {df_multicapa['LAYER'].nunique()} capas de profundidad")
+    if verbose:
+        print(f"✓ Guardado: {output_filename}")
+        print(f"  - {len(df_multicapa)} registros totales")
+        print(f"  - {df_multicapa['CODE'].nunique()} tipos de suelo únicos")
+        print(f"  - {df_multicapa['LAYER'].nunique()} capas de profundidad")
+
+class EscritorBloques:
+    """
+    Escribe DataFrames PyAEZ bloque a bloque en un único archivo CSV o Parquet
+
+    Parquet mantiene un esquema fijo para todos los bloques, con
+    COLUMNAS_DICCIONARIO codificadas como diccionario en cada row group.
+    Excel y Feather no admiten escritura incremental.
+    """
+
+    def __init__(self, ruta, formato=None):
+        self.ruta = ruta
+        self.formato = detectar_formato(ruta, formato)
+        if self.formato not in ('csv', 'parquet'):
+            raise ValueError(f"La escritura por bloques admite CSV o Parquet, no {self.formato!r}")
+        self.registros = 0
+        self._escritor = None
+        self._esquema = None
+
+    def escribir(self, df):
+        if self.formato == 'csv':
+            primero = self.registros == 0
+            exportar_pyaez(df).to_csv(self.ruta, mode='w' if primero else 'a', header=primero, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            tabla = pa.Table.from_pandas(_preparar_columnar(df), preserve_index=False)
+            if self._escritor is None:
+                self._esquema = pa.schema([
+                    pa.field(campo.name, pa.dictionary(pa.int32(), pa.string()))
+                    if pa.types.is_dictionary(campo.type) else campo
+                    for campo in tabla.schema
+                ])
+                self._escritor = pq.ParquetWriter(self.ruta, self._esquema)
+            self._escritor.write_table(tabla.cast(self._esquema))
+        self.registros += len(df)
+
+    def cerrar(self):
+        if self._escritor is not None:
+            self._escritor.close()
+            self._escritor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
 
 # ============================================================================
 # SECCIÓN 7: ESTADÍSTICAS Y VALIDACIÓN
 # ============================================================================
-print("\n" + "="*80)
-print("[7] ESTADÍSTICAS DE VALIDACIÓN")
-print("="*80)
 
-print(f"\nDistribución de registros por capa:")
-print(df_multicapa['LAYER'].value_counts().sort_index())
+def verificar_reglas(reglas):
+    """
+    Revisa una lista de reglas de validación (ver REGLAS_VALIDACION)
+
+    Lanza ValueError si una regla no tiene nombre, tiene un tipo desconocido
+    o una acción que su tipo no admite.
+    """
+    nombres = set()
+    for regla in reglas:
+        nombre, tipo, accion = regla.get('regla'), regla.get('tipo'), regla.get('accion')
+        if not nombre or nombre in nombres:
+            raise ValueError(f"Regla sin nombre o repetida: {regla!r}")
+        if tipo not in ACCIONES_POR_TIPO:
+            raise ValueError(f"Regla {nombre}: tipo desconocido {tipo!r} (opciones: {', '.join(ACCIONES_POR_TIPO)})")
+        if accion not in ACCIONES_POR_TIPO[tipo]:
+            raise ValueError(f"Regla {nombre}: acción {accion!r} no válida para {tipo} "
+                             f"(opciones: {', '.join(ACCIONES_POR_TIPO[tipo])})")
+        nombres.add(nombre)
+
+def configurar_reglas(acciones, reglas=None):
+    """
+    Copia de las reglas con las acciones cambiadas
+
+    acciones: dict nombre de regla → acción, o textos 'regla=accion'
+    (--accion). Lanza ValueError si la regla no existe o la acción no es
+    válida para su tipo.
+    """
+    reglas = REGLAS_VALIDACION if reglas is None else reglas
+    if not isinstance(acciones, dict):
+        acciones = dict(texto.split('=', 1) for texto in acciones)
+    desconocidas = set(acciones) - {regla['regla'] for regla in reglas}
+    if desconocidas:
+        raise ValueError(f"Reglas desconocidas: {', '.join(sorted(desconocidas))}")
+
+    reglas = [dict(regla, accion=acciones.get(regla['regla'], regla['accion'])) for regla in reglas]
+    verificar_reglas(reglas)
+    return reglas
+
+def _mascara_regla(regla, valores, df):
+    """Máscara de registros que violan la regla, evaluada sobre los valores sin corregir"""
+    tipo = regla['tipo']
+    if tipo == 'rango':
+        return (valores < regla['min']) | (valores > regla['max'])
+    if tipo == 'faltante':
+        return np.isnan(valores)
+    if tipo == 'maximo_columna':
+        return valores > pd.to_numeric(df[regla['limite']], errors='coerce').to_numpy(dtype=float)
+    # textura_arcilla: % de arcilla fuera del rango de la clase textural
+    # (con tolerancia); sin arcilla (NaN o -9) o clase desconocida no se evalúa.
+    # Las clases se comparan sin espacios ni mayúsculas ('Clay (heavy)' = 'clay(heavy)')
+    texturas = df['TXT'].astype(str).str.lower().str.replace(r'\s+', '', regex=True)
+    rangos = {''.join(t.split()): r for t, r in RANGOS_ARCILLA_TEXTURA.items()}
+    minimo = texturas.map({t: r[0] for t, r in rangos.items()}).to_numpy(dtype=float)
+    maximo = texturas.map({t: r[1] for t, r in rangos.items()}).to_numpy(dtype=float)
+    tolerancia = regla.get('tolerancia', 0)
+    return (valores >= 0) & ((valores < minimo - tolerancia) | (valores > maximo + tolerancia))
+
+def validar_registros(df_consolidated, reglas=None):
+    """
+    Aplica las reglas de validación a los registros consolidados de todas las capas
+
+    Cada regla se evalúa como una máscara vectorizada sobre los valores sin
+    corregir, de modo que el orden de las reglas no cambia qué se reporta.
+    Luego se aplica su acción en el orden de la lista: recortar (al rango o
+    al límite), imputar ('valor' de la regla; en rangos, NaN si no tiene),
+    rechazar (el registro se elimina) o reportar.
+
+    Retorna:
+    - (DataFrame corregido, DataFrame de violaciones con una fila por
+      registro y regla: CODE, LAYER, regla, variable, valor original y acción)
+    """
+    reglas = REGLAS_VALIDACION if reglas is None else reglas
+    verificar_reglas(reglas)
+
+    df = df_consolidated.copy()
+    columnas = {regla['columna'] for regla in reglas}
+    originales = {columna: pd.to_numeric(df[columna], errors='coerce').to_numpy(dtype=float)
+                  for columna in columnas}
+    mascaras = [_mascara_regla(regla, originales[regla['columna']], df) for regla in reglas]
+
+    rechazados = np.zeros(len(df), dtype=bool)
+    for regla, mascara in zip(reglas, mascaras):
+        accion, columna = regla['accion'], regla['columna']
+        if accion == 'reportar' or not mascara.any():
+            continue
+        if accion == 'rechazar':
+            rechazados |= mascara
+        elif accion == 'recortar' and regla['tipo'] == 'rango':
+            df[columna] = df[columna].clip(regla['min'], regla['max'])
+        elif accion == 'recortar':
+            df[columna] = df[columna].where(~mascara, df[regla['limite']])
+        else:
+            df[columna] = df[columna].where(~mascara, regla.get('valor', np.nan))
+
+    # Tabla de violaciones: solo los registros marcados, en formato largo
+    capas = df['LAYER'].to_numpy(dtype=object) if 'LAYER' in df.columns else np.full(len(df), None, dtype=object)
+    codigos = df['HWSD2_SMU_ID'].to_numpy()
+    partes = []
+    for regla, mascara in zip(reglas, mascaras):
+        filas = np.flatnonzero(mascara)
+        if len(filas) == 0:
+            continue
+        partes.append(pd.DataFrame({
+            'CODE': codigos[filas],
+            'LAYER': capas[filas],
+            'regla': regla['regla'],
+            'variable': VARIABLES_PYAEZ.get(regla['columna'], regla['columna']),
+            'valor': originales[regla['columna']][filas],
+            'accion': regla['accion'],
+        }))
+
+    df_violaciones = tabla_violaciones(partes)
+    if rechazados.any():
+        df = df[~rechazados]
+    return df, df_violaciones
+
+def tabla_violaciones(partes):
+    """
+    Une tablas de violaciones (validar_registros, formatear_pyaez(violaciones=...))
+
+    Columnas compactas: CODE int32, LAYER/regla/variable/accion categóricas
+    y valor float64; ordenada por CODE, LAYER y regla.
+    """
+    partes = [parte for parte in partes if len(parte) > 0]
+    if not partes:
+        df = pd.DataFrame({'CODE': pd.Series(dtype=np.int32), 'LAYER': pd.Series(dtype=object),
+                           'regla': pd.Series(dtype=object), 'variable': pd.Series(dtype=object),
+                           'valor': pd.Series(dtype=float), 'accion': pd.Series(dtype=object)})
+    else:
+        df = pd.concat(partes, ignore_index=True)
+    df = df.astype({'CODE': np.int32, 'valor': float})
+    for columna in ['LAYER', 'regla', 'variable', 'accion']:
+        df[columna] = df[columna].astype('category')
+    return df.sort_values(['CODE', 'LAYER', 'regla'], kind='mergesort').reset_index(drop=True)
+
+def resumir_violaciones(df_violaciones):
+    """Registros y SMU afectados por regla y acción"""
+    return (df_violaciones.groupby(['regla', 'accion'], observed=True)
+            .agg(registros=('CODE', 'size'), smu=('CODE', 'nunique'))
+            .reset_index()
+            .sort_values('registros', ascending=False, kind='mergesort')
+            .reset_index(drop=True))
+
+def imprimir_estadisticas(df_multicapa, detalle=True, df_violaciones=None):
+    """
+    Imprime distribución por capa, rangos de variables clave y limitaciones
+
+    detalle=False imprime solo los rangos y las limitaciones, sin los
+    conteos por capa, textura y drenaje. Con df_violaciones (tabla_violaciones)
+    agrega los registros y SMU afectados por cada regla.
+    """
+    print("\n" + "="*80)
+    print("[7] ESTADÍSTICAS DE VALIDACIÓN")
+    print("="*80)
 
-print(f"\nRangos de variables clave (todas las capas):")
-print(f"  - pH: {df_multicapa['pH'].min():.1f} - {df_multicapa['pH'].max():.1f}")
-print(f"  - BS: {df_multicapa['BS'].min()}% - {df_multicapa['BS'].max()}%")
-print(f"  - OC: {df_multicapa['OC'].min():.3f}% - {df_multicapa['OC'].max():.3f}%")
-print(f"  - CEC_soil: {df_multicapa['CEC_soil'].min()} - {df_multicapa['CEC_soil'].max()} cmol/kg")
-print(f"  - ESP: {df_multicapa['ESP'].min()}% - {df_multicapa['ESP'].max()}%")
+    if detalle:
+        print(f"\nDistribución de registros por capa:")
+        print(df_multicapa['LAYER'].value_counts().sort_index())
 
-print(f"\nTexturas presentes:")
-print(df_multicapa['TXT'].value_counts())
+    print(f"\nRangos de variables clave (todas las capas):")
+    print(f"  - pH: {df_multicapa['pH'].min():.1f} - {df_multicapa['pH'].max():.1f}")
+    print(f"  - BS: {df_multicapa['BS'].min()}% - {df_multicapa['BS'].max()}%")
+    print(f"  - OC: {df_multicapa['OC'].min():.3f}% - {df_multicapa['OC'].max():.3f}%")
+    print(f"  - CEC_soil: {df_multicapa['CEC_soil'].min()} - {df_multicapa['CEC_soil'].max()} cmol/kg")
+    print(f"  - ESP: {df_multicapa['ESP'].min()}% - {df_multicapa['ESP'].max()}%")
 
-print(f"\nDrenaje:")
-print(df_multicapa['DRG'].value_counts())
+    df_multicapa = exportar_pyaez(df_multicapa)
 
-print(f"\nSuelos con limitaciones:")
-print(f"  - SPR (rocosos): {(df_multicapa['SPR'] != 0).sum()} registros")
-print(f"  - SPH (químicos): {(df_multicapa['SPH'] != 0).sum()} registros")
-print(f"  - VSP (vérticos): {(df_multicapa['VSP'] == 1).sum()} registros")
+    if detalle:
+        print(f"\nTexturas presentes:")
+        print(df_multicapa['TXT'].value_counts())
+
+        print(f"\nDrenaje:")
+        print(df_multicapa['DRG'].value_counts())
+
+    print(f"\nSuelos con limitaciones:")
+    print(f"  - SPR (rocosos): {(df_multicapa['SPR'] != 0).sum()} registros")
+    print(f"  - SPH (químicos): {(df_multicapa['SPH'] != 0).sum()} registros")
+    print(f"  - VSP (vérticos): {(df_multicapa['VSP'] == 1).sum()} registros")
+
+    if df_violaciones is not None:
+        print(f"\nReglas de validación ({len(df_violaciones)} violaciones):")
+        for fila in resumir_violaciones(df_violaciones).itertuples(index=False):
+            print(f"  - {fila.regla} ({fila.accion}): {fila.registros} registros, {fila.smu} SMU")
+
+# ============================================================================
+# SECCIÓN 8: EXTRACCIÓN POR BLOQUES (MEMORIA ACOTADA)
+# ============================================================================
+
+def iterar_bloques_capas(conn, smu_ids=None, tamano_bloque=TAMANO_BLOQUE):
+    """
+    Itera HWSD2_LAYERS ordenado por HWSD2_SMU_ID en bloques de ~tamano_bloque filas
+
+    Lee con pd.read_sql_query(..., chunksize=) y retiene las filas del último
+    SMU de cada bloque hasta el bloque siguiente, de modo que ningún tipo de
+    suelo queda repartido entre dos bloques.
+
+    Parámetros:
+    - smu_ids: Lista de HWSD2_SMU_ID (None = toda la base de datos)
+
+    Retorna:
+    - Generador de DataFrames con todas las filas de un conjunto de SMU
+    """
+    query = _consulta_capas(None if smu_ids is None else _tabla_ids(conn, smu_ids, 'pyaez_ids_bloques'))
+
+    pendiente = None
+    for bloque in pd.read_sql_query(query, conn, chunksize=tamano_bloque):
+        if pendiente is not None:
+            bloque = pd.concat([pendiente, bloque], ignore_index=True)
+        ultimo = bloque['HWSD2_SMU_ID'].iloc[-1]
+        completo = (bloque['HWSD2_SMU_ID'] != ultimo).to_numpy()
+        pendiente = bloque[~completo]
+        if completo.any():
+            yield bloque[completo]
+
+    if pendiente is not None and len(pendiente) > 0:
+        yield pendiente
+
+def iterar_pyaez_por_bloques(conn, smu_ids=None, capas=None, tamano_bloque=TAMANO_BLOQUE, reglas=None,
+                             violaciones=None):
+    """
+    Consolida HWSD2_LAYERS bloque a bloque con la misma lógica que procesar_capas
+
+    El pico de memoria depende de tamano_bloque y no del número de SMU.
+
+    Retorna:
+    - Generador de DataFrames PyAEZ multicapa (con LAYER), ordenados por
+      LAYER y CODE dentro de cada bloque
+    """
+    capas = CAPAS if capas is None else list(capas)
+    tablas = cargar_tablas_referencia(conn, verbose=False)
+
+    for df_valid, vsp_map in _leer_bloques_validos(conn, smu_ids, capas, tamano_bloque, tablas):
+        yield _formatear_bloque(consolidar_perfiles(df_valid), tablas, vsp_map, reglas, violaciones)
+
+def _leer_bloques_validos(conn, smu_ids, capas, tamano_bloque, tablas):
+    """Parte SQLite de un bloque: registros válidos de las capas y su VSP"""
+    for df_bloque in iterar_bloques_capas(conn, smu_ids, tamano_bloque):
+        df_valid = df_bloque[df_bloque['LAYER'].isin(capas) & (df_bloque['ORG_CARBON'] > 0)]
+        if len(df_valid) == 0:
+            continue
+
+        vsp_map = calcular_vsp(conn, df_valid['HWSD2_SMU_ID'].unique(), verbose=False, tablas=tablas,
+                               df_arcilla=arcilla_d1(df_bloque))
+        yield df_valid, vsp_map
+
+def _formatear_bloque(df_consolidated, tablas, vsp_map, reglas=None, violaciones=None):
+    """Formato PyAEZ de un bloque consolidado (consolidar_perfiles), ordenado por LAYER y CODE"""
+    df_pyaez = formatear_pyaez(df_consolidated, tablas, vsp_map, reglas=reglas, violaciones=violaciones)
+    return df_pyaez.sort_values(['LAYER', 'CODE']).reset_index(drop=True)
+
+def extraer_pyaez_por_bloques(db, output, smu_ids=None, capas=None, tamano_bloque=TAMANO_BLOQUE,
+                              formato=None, verbose=False, medidor=None, reglas=None, violaciones=None):
+    """
+    Extracción con memoria acotada: escribe cada bloque consolidado en el archivo de salida
+
+    Parámetros:
+    - db: Ruta a HWSD2.db o conexión sqlite3 abierta
+    - output: Archivo CSV o Parquet multicapa (se sobrescribe y se completa por bloques)
+    - smu_ids: Lista de HWSD2_SMU_ID (None = toda la base de datos)
+    - capas: Lista de capas a procesar (por defecto CAPAS, D1-D7)
+    - tamano_bloque: Filas de HWSD2_LAYERS leídas por bloque
+    - formato: 'csv' o 'parquet' (None = según extensión)
+    - medidor: MedidorEtapas opcional; registra las tablas de referencia,
+      una etapa por parte del procesamiento con la suma de todos los bloques
+      (lectura, con VSP; consolidacion; formato; escritura) y el total como
+      etapa 'bloques'
+    - reglas, violaciones: ver formatear_pyaez (una tabla de violaciones por bloque)
+
+    Retorna:
+    - Número de registros PyAEZ escritos
+    """
+    capas = CAPAS if capas is None else list(capas)
+    escritor = EscritorBloques(output, formato)
+    medidor = MedidorEtapas() if medidor is None else medidor
+
+    # Tiempo y filas de salida de cada parte, sumados sobre todos los bloques
+    segundos = dict.fromkeys(['lectura', 'consolidacion', 'formato', 'escritura'], 0.0)
+    filas = dict.fromkeys(segundos, 0)
+
+    conn = conectar_solo_lectura(db) if not isinstance(db, sqlite3.Connection) else db
+    try:
+        with escritor, medidor.etapa('bloques', tamano_bloque=tamano_bloque) as etapa:
+            with medidor.etapa('tablas'):
+                tablas = cargar_tablas_referencia(conn, verbose=False)
+            lector = _leer_bloques_validos(conn, smu_ids, capas, tamano_bloque, tablas)
+            i = 0
+            while True:
+                inicio = time.perf_counter()
+                siguiente = next(lector, None)
+                segundos['lectura'] += time.perf_counter() - inicio
+                if siguiente is None:
+                    break
+                df_valid, vsp_map = siguiente
+                filas['lectura'] += len(df_valid)
+
+                inicio = time.perf_counter()
+                df_consolidated = consolidar_perfiles(df_valid)
+                segundos['consolidacion'] += time.perf_counter() - inicio
+                filas['consolidacion'] += len(df_consolidated)
+
+                inicio = time.perf_counter()
+                df_pyaez = _formatear_bloque(df_consolidated, tablas, vsp_map, reglas, violaciones)
+                segundos['formato'] += time.perf_counter() - inicio
+                filas['formato'] += len(df_pyaez)
+
+                inicio = time.perf_counter()
+                escritor.escribir(df_pyaez)
+                segundos['escritura'] += time.perf_counter() - inicio
+                filas['escritura'] += len(df_pyaez)
+
+                i += 1
+                etapa.update(bloques=i, filas_salida=escritor.registros)
+                if verbose:
+                    print(f"✓ Bloque {i}: {len(df_pyaez)} registros "
+                          f"(SMU {df_pyaez['CODE'].min()}-{df_pyaez['CODE'].max()})")
+
+            # Cada parte recibe las filas de salida de la anterior
+            entrada = None
+            for nombre in segundos:
+                medidor.registrar(nombre, segundos[nombre], filas_entrada=entrada, filas_salida=filas[nombre],
+                                  bloques=i)
+                entrada = filas[nombre]
+    finally:
+        if conn is not db:
+            conn.close()
+
+    if verbose:
+        print(f"✓ Guardado: {output} ({escritor.registros} registros)")
+
+    return escritor.registros
+
+# Fin de la cola de un hilo de la extracción canalizada
+_FIN = object()
+
+def _poner(cola, elemento, detener):
+    """cola.put que se rinde si otro hilo de la canalización falló"""
+    while not detener.is_set():
+        try:
+            cola.put(elemento, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def extraer_pyaez_canalizado(db_path, output, smu_ids=None, capas=None, tamano_bloque=TAMANO_BLOQUE,
+                             formato=None, trabajadores=2, profundidad=4, verbose=False, medidor=None,
+                             reglas=None, violaciones=None):
+    """
+    Extracción por bloques con lectura, consolidación y escritura en paralelo
+
+    Misma salida que extraer_pyaez_por_bloques, en tres etapas simultáneas:
+    - un hilo productor con su propia conexión de solo lectura lee los
+      bloques de HWSD2_LAYERS y su VSP (SQLite libera el GIL mientras lee)
+    - `trabajadores` hilos consolidan y formatean los bloques
+    - el hilo que llama escribe los bloques terminados, en el orden de lectura
+
+    Las colas son acotadas y a lo sumo profundidad + trabajadores bloques
+    están en memoria a la vez: si la escritura o la consolidación se atrasan,
+    el productor espera. El tiempo total se acerca al de la etapa más lenta
+    en lugar de la suma de las tres.
+
+    Parámetros:
+    - db_path: Ruta a HWSD2.db (el productor abre su propia conexión)
+    - trabajadores: Hilos de consolidación
+    - profundidad: Bloques leídos que pueden esperar consolidación
+    - Resto: ver extraer_pyaez_por_bloques; medidor registra una etapa
+      'canalizado' con el tiempo ocupado de cada etapa
+
+    Retorna:
+    - Número de registros PyAEZ escritos
+    """
+    capas = CAPAS if capas is None else list(capas)
+    medidor = MedidorEtapas() if medidor is None else medidor
+    escritor = EscritorBloques(output, formato)
+
+    bloques = queue.Queue(maxsize=profundidad)
+    terminados = queue.Queue(maxsize=profundidad)
+    # Un cupo por bloque leído y no escrito: acota también los bloques que
+    # esperan en el escritor a que termine uno anterior
+    cupos = threading.BoundedSemaphore(profundidad + trabajadores)
+    detener = threading.Event()
+    errores = []
+    ocupado = {'lectura': 0.0, 'consolidacion': 0.0, 'formato': 0.0, 'escritura': 0.0}
+    candado = threading.Lock()
+
+    def sumar(etapa, inicio):
+        with candado:
+            ocupado[etapa] += time.perf_counter() - inicio
+
+    def productor():
+        try:
+            conn = conectar_solo_lectura(db_path)
+            try:
+                tablas = cargar_tablas_referencia(conn, verbose=False)
+                lector = _leer_bloques_validos(conn, smu_ids, capas, tamano_bloque, tablas)
+                indice = 0
+                while not detener.is_set():
+                    while not cupos.acquire(timeout=0.1):
+                        if detener.is_set():
+                            return
+                    inicio = time.perf_counter()
+                    siguiente = next(lector, None)
+                    sumar('lectura', inicio)
+                    if siguiente is None:
+                        cupos.release()
+                        break
+                    if not _poner(bloques, (indice, tablas) + siguiente, detener):
+                        return
+                    indice += 1
+            finally:
+                conn.close()
+        except BaseException as error:
+            errores.append(error)
+            detener.set()
+        finally:
+            for _ in range(trabajadores):
+                _poner(bloques, _FIN, detener)
+
+    def consolidador():
+        try:
+            while not detener.is_set():
+                try:
+                    elemento = bloques.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if elemento is _FIN:
+                    break
+                indice, tablas, df_valid, vsp_map = elemento
+                inicio = time.perf_counter()
+                df_consolidated = consolidar_perfiles(df_valid)
+                sumar('consolidacion', inicio)
+                inicio = time.perf_counter()
+                df_pyaez = _formatear_bloque(df_consolidated, tablas, vsp_map, reglas, violaciones)
+                sumar('formato', inicio)
+                if not _poner(terminados, (indice, df_pyaez), detener):
+                    return
+        except BaseException as error:
+            errores.append(error)
+            detener.set()
+        finally:
+            _poner(terminados, _FIN, detener)
+
+    hilos = [threading.Thread(target=productor, name='pyaez-lectura', daemon=True)]
+    hilos += [threading.Thread(target=consolidador, name=f'pyaez-consolidacion-{i}', daemon=True)
+              for i in range(trabajadores)]
+
+    with medidor.etapa('canalizado', tamano_bloque=tamano_bloque, trabajadores=trabajadores) as etapa:
+        try:
+            with escritor:
+                for hilo in hilos:
+                    hilo.start()
+
+                # Escritor: reordena los bloques terminados según el orden de lectura
+                pendientes, siguiente, activos = {}, 0, trabajadores
+                while activos and not detener.is_set():
+                    try:
+                        elemento = terminados.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if elemento is _FIN:
+                        activos -= 1
+                        continue
+                    indice, df_pyaez = elemento
+                    pendientes[indice] = df_pyaez
+                    while siguiente in pendientes:
+                        df_pyaez = pendientes.pop(siguiente)
+                        inicio = time.perf_counter()
+                        escritor.escribir(df_pyaez)
+                        sumar('escritura', inicio)
+                        cupos.release()
+                        if verbose:
+                            print(f"✓ Bloque {siguiente + 1}: {len(df_pyaez)} registros "
+                                  f"(SMU {df_pyaez['CODE'].min()}-{df_pyaez['CODE'].max()})")
+                        siguiente += 1
+        except BaseException:
+            detener.set()
+            raise
+        finally:
+            for hilo in hilos:
+                hilo.join()
+
+        if errores:
+            raise errores[0]
+        etapa.update(bloques=siguiente, filas_salida=escritor.registros,
+                     **{f'{nombre}_segundos': round(segundos, 6) for nombre, segundos in ocupado.items()})
+
+    if verbose:
+        print(f"✓ Guardado: {output} ({escritor.registros} registros)")
+        print(f"  - Tiempo ocupado: lectura {ocupado['lectura']:.2f} s, consolidación "
+              f"{ocupado['consolidacion']:.2f} s y formato {ocupado['formato']:.2f} s ({trabajadores} hilos), "
+              f"escritura {ocupado['escritura']:.2f} s")
+
+    return escritor.registros
+
+# ============================================================================
+# SECCIÓN 9: EXTRACCIÓN PARALELA DE MÚLTIPLES REGIONES
+# ============================================================================
 
-conn.close()
+# Conexión de solo lectura (y caché opcional) propias de cada proceso trabajador
+_conexion_trabajador = None
+_cache_trabajador = None
 
-print("\n" + "="*80)
-print("✓ PROCESO COMPLETADO EXITOSAMENTE")
-print("="*80)
-print(f"""
+def uri_solo_lectura(db_path):
+    """URI file: de solo lectura e inmutable de una base (también para ATTACH)"""
+    return f"file:{pathname2url(str(Path(db_path).resolve()))}?mode=ro&immutable=1"
+
+def conectar_solo_lectura(db_path):
+    """
+    Abre HWSD2.db en modo solo lectura e inmutable (URI mode=ro&immutable=1)
+
+    HWSD2 es una publicación estática: con immutable=1 SQLite no usa bloqueos
+    ni comprueba cambios, y varios procesos pueden leer el archivo a la vez.
+    Aplica PRAGMAS_LECTURA. No se usa PRAGMA query_only: mode=ro ya impide
+    escribir en HWSD2.db, y query_only bloquearía también las tablas
+    temporales de IDs (ver _tabla_ids).
+    """
+    conn = sqlite3.connect(uri_solo_lectura(db_path), uri=True)
+    for pragma, valor in PRAGMAS_LECTURA.items():
+        conn.execute(f"PRAGMA {pragma} = {valor}")
+    return conn
+
+def _iniciar_trabajador(db_path, directorio_cache, motor):
+    global _conexion_trabajador, _cache_trabajador
+    _conexion_trabajador = conectar_solo_lectura(db_path)
+    if directorio_cache is not None:
+        _cache_trabajador = CachePyAEZ(directorio_cache, db_path, motor=motor)
+
+def _extraer_region(nombre, smu_ids, capas, output, motor, formato, reglas):
+    medidor = MedidorEtapas()
+    violaciones = []
+    resultados = extraer_pyaez(_conexion_trabajador, smu_ids, capas, output=output, motor=motor,
+                               formato=formato, cache=_cache_trabajador, medidor=medidor,
+                               reglas=reglas, violaciones=violaciones)
+    return nombre, sum(len(df) for df in resultados.values()), tabla_violaciones(violaciones), medidor.etapas
+
+def extraer_regiones(db_path, regiones, directorio_salida='.', capas=None, motor='pandas',
+                     formato='excel', max_workers=None, directorio_cache=None, verbose=False,
+                     medidor=None, reglas=None, violaciones=None):
+    """
+    Extrae varias regiones en paralelo, un archivo PyAEZ por región
+
+    Cada proceso del pool abre una única conexión de solo lectura a HWSD2.db
+    (ver conectar_solo_lectura) y la reutiliza para todas sus regiones.
+
+    Parámetros:
+    - db_path: Ruta a HWSD2.db
+    - regiones: dict nombre → lista de HWSD2_SMU_ID (como IDS_ESWATINI)
+    - directorio_salida: Carpeta de los archivos <nombre>_soil_ALL_LAYERS_pyaez.<ext>
+    - formato: 'excel', 'csv', 'parquet' o 'feather'
+    - max_workers: Procesos del pool (por defecto os.cpu_count())
+    - directorio_cache: Carpeta de la caché persistente (ver CachePyAEZ), compartida
+      por todos los procesos
+    - medidor: MedidorEtapas opcional; registra una etapa 'regiones' con el
+      total y las etapas de extraer_pyaez de cada proceso, con su 'region'
+      (el pico de memoria de esas etapas es el del proceso que la extrajo)
+    - reglas, violaciones: Ver extraer_pyaez; a violaciones se agrega la
+      tabla de violaciones de cada región
+
+    Retorna:
+    - dict nombre → ruta del archivo generado
+    """
+    directorio_salida = Path(directorio_salida)
+    directorio_salida.mkdir(parents=True, exist_ok=True)
+    extension = EXTENSION_POR_FORMATO[detectar_formato(None, formato)]
+    salidas = {nombre: directorio_salida / f"{nombre}_soil_ALL_LAYERS_pyaez{extension}" for nombre in regiones}
+
+    medidor = MedidorEtapas() if medidor is None else medidor
+    with medidor.etapa('regiones', filas_entrada=sum(len(ids) for ids in regiones.values()),
+                       regiones=len(regiones)) as etapa:
+        etapa['filas_salida'] = 0
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                 initializer=_iniciar_trabajador,
+                                 initargs=(str(db_path), directorio_cache, motor)) as pool:
+            futuros = [
+                pool.submit(_extraer_region, nombre, list(smu_ids), capas, str(salidas[nombre]), motor,
+                            formato, reglas)
+                for nombre, smu_ids in regiones.items()
+            ]
+            for futuro in as_completed(futuros):
+                nombre, registros, df_violaciones, etapas = futuro.result()
+                etapa['filas_salida'] += registros
+                medidor.etapas.extend({**etapa_region, 'region': nombre} for etapa_region in etapas)
+                if violaciones is not None:
+                    violaciones.append(df_violaciones)
+                if verbose:
+                    print(f"✓ {nombre}: {registros} registros → {salidas[nombre]}")
+
+    return salidas
+
+# ============================================================================
+# SECCIÓN 10: CACHÉ PERSISTENTE DE RESULTADOS CONSOLIDADOS
+# ============================================================================
+
+def huella_bd(db_path, contenido=False):
+    """
+    Huella de la base de datos: tamaño + fecha de modificación, o SHA-256
+
+    Parámetros:
+    - contenido: Calcula el SHA-256 del archivo completo (lento en HWSD2.db,
+      pero no depende de la fecha de copia del archivo)
+    """
+    ruta = Path(db_path)
+    if not contenido:
+        info = ruta.stat()
+        return f"{info.st_size}-{info.st_mtime_ns}"
+
+    sha = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def configuracion_reglas(reglas=None):
+    """
+    Constantes que definen la consolidación: versión, columnas, mapeos, VSP y validaciones
+
+    reglas: Reglas de validación (None = REGLAS_VALIDACION)
+    """
+    return {
+        'version': VERSION_REGLAS,
+        'promedio': COLUMNAS_PROMEDIO,
+        'moda': COLUMNAS_MODA,
+        'osd': {str(codigo): cm for codigo, cm in OSD_RANGOS.items()},
+        'fases_sph': FASES_SPH,
+        'fases_spr': FASES_SPR,
+        'vsp': [UMBRAL_ARCILLA_VSP, UMBRAL_CEC_ARCILLA_VSP],
+        'arcilla_textura': RANGOS_ARCILLA_TEXTURA,
+        'validacion': REGLAS_VALIDACION if reglas is None else reglas,
+    }
+
+def huella_reglas(reglas=None):
+    """
+    Huella de configuracion_reglas (SHA-256 abreviado)
+
+    Cambia con cualquier umbral, mapeo o acción de validación, sin tener que
+    incrementar VERSION_REGLAS.
+    """
+    texto = json.dumps(configuracion_reglas(reglas), sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode()).hexdigest()[:16]
+
+class CachePyAEZ:
+    """
+    Caché en disco de registros PyAEZ consolidados por (SMU, capa)
+
+    Cada combinación de huella de HWSD2.db, de las reglas (huella_reglas) y
+    de motor usa su propio archivo SQLite (pyaez_<clave>.sqlite) dentro del
+    directorio de caché: un cambio en la base de datos o en las reglas nunca
+    reutiliza resultados viejos, y los registros de un motor no se sirven al
+    otro (ver comparar_motores). Registra también los (SMU, capa) consultados sin datos válidos,
+    para no volver a consultarlos.
+    """
+
+    def __init__(self, directorio, db_path, contenido=False, motor='pandas'):
+        if motor not in MOTORES:
+            raise ValueError(f"Motor desconocido: {motor!r} (opciones: {', '.join(MOTORES)})")
+        self.motor = motor
+        clave = hashlib.sha256(f"{huella_bd(db_path, contenido)}|{huella_reglas()}|{motor}".encode()).hexdigest()[:16]
+        directorio = Path(directorio)
+        directorio.mkdir(parents=True, exist_ok=True)
+        self.ruta = directorio / f"pyaez_{clave}.sqlite"
+
+        # Columnas sin tipo declarado: SQLite conserva enteros y textos
+        # mezclados (SPR/SPH = 0 o nombre de fase) sin convertirlos
+        columnas = ', '.join(COLUMNAS_PYAEZ[2:])
+        self._conn = sqlite3.connect(self.ruta, timeout=60)
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS registros (
+                CODE INTEGER, LAYER TEXT, {columnas},
+                PRIMARY KEY (CODE, LAYER)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS procesados (
+                CODE INTEGER, LAYER TEXT,
+                PRIMARY KEY (CODE, LAYER)
+            ) WITHOUT ROWID;
+            CREATE TEMP TABLE IF NOT EXISTS consulta_ids (CODE INTEGER PRIMARY KEY);
+        """)
+
+    def obtener(self, smu_ids, capas):
+        """
+        Busca en caché los SMU solicitados
+
+        Retorna:
+        - (DataFrame multicapa con los registros en caché, lista de SMU que
+          falta consultar porque alguna de las capas no está en caché)
+        """
+        smu_ids = list(dict.fromkeys(int(i) for i in smu_ids))
+
+        # La escritura en consulta_ids abre una transacción: se cierra al
+        # terminar la lectura para no retener el bloqueo compartido, que
+        # impediría guardar a los demás procesos de extraer_regiones
+        with self._conn:
+            self._conn.execute("DELETE FROM consulta_ids")
+            self._conn.executemany("INSERT INTO consulta_ids VALUES (?)", [(i,) for i in smu_ids])
+
+            completos = {
+                code for code, n in self._conn.execute(f"""
+                    SELECT p.CODE, COUNT(*)
+                    FROM procesados p JOIN consulta_ids c ON p.CODE = c.CODE
+                    WHERE p.LAYER IN ({_lista_sql_texto(capas)})
+                    GROUP BY p.CODE
+                """) if n == len(capas)
+            }
+            faltantes = [i for i in smu_ids if i not in completos]
+
+            df_cache = pd.read_sql_query(f"""
+                SELECT r.*
+                FROM registros r JOIN consulta_ids c ON r.CODE = c.CODE
+                WHERE r.LAYER IN ({_lista_sql_texto(capas)})
+            """, self._conn)
+        df_cache = df_cache[df_cache['CODE'].isin(completos)]
+
+        return tipar_pyaez(df_cache).reset_index(drop=True), faltantes
+
+    def guardar(self, df_multicapa, smu_ids, capas):
+        """
+        Guarda los registros consolidados y marca (smu_ids × capas) como procesados
+
+        Los registros se guardan con los valores PyAEZ de exportar_pyaez.
+        """
+        df = exportar_pyaez(df_multicapa[COLUMNAS_PYAEZ]).astype(object)
+        filas = df.where(df.notna(), None).itertuples(index=False, name=None)
+        marcadores = ', '.join('?' * len(COLUMNAS_PYAEZ))
+
+        with self._conn:
+            self._conn.executemany(f"INSERT OR REPLACE INTO registros VALUES ({marcadores})", filas)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO procesados VALUES (?, ?)",
+                [(int(i), capa) for i in smu_ids for capa in capas]
+            )
+
+    def cerrar(self):
+        self._conn.close()
+
+# ============================================================================
+# SECCIÓN 11: PREPARACIÓN DE HWSD2.db (ÍNDICES Y COPIA REDUCIDA)
+# ============================================================================
+
+# Índices que crea preparar_bd: nombre → (tabla, columnas)
+INDICES_PYAEZ = {
+    # Búsqueda por SMU y orden de obtener_capas (HWSD2_SMU_ID, ID, TOPDEP) sin ordenar
+    'idx_pyaez_capas': ('HWSD2_LAYERS', ['HWSD2_SMU_ID', 'ID', 'TOPDEP']),
+    'idx_pyaez_smu': ('HWSD2_SMU', ['HWSD2_SMU_ID']),
+}
+
+# Índice cubriente opcional del motor 'sql': la consolidación se resuelve
+# solo con el índice, sin leer las filas de HWSD2_LAYERS
+INDICE_CUBRIENTE = ('idx_pyaez_consolidacion', 'HWSD2_LAYERS',
+                    ['HWSD2_SMU_ID', 'LAYER'] + COLUMNAS_PROMEDIO + COLUMNAS_MODA)
+
+def preparar_bd(db_path, destino=None, cubriente=False, verbose=True):
+    """
+    Prepara HWSD2.db para las consultas del extractor
+
+    Sin destino, crea INDICES_PYAEZ (y el índice cubriente si cubriente=True)
+    en la misma base y ejecuta ANALYZE. Con destino, genera una copia reducida:
+    HWSD2_LAYERS solo con COLUMNAS_CAPAS_PYAEZ, agrupada físicamente por SMU
+    (WITHOUT ROWID, clave HWSD2_SMU_ID, ID), HWSD2_SMU solo con WRB4/WRB2, y las
+    tablas D_* de RegistroTablas. La copia se usa igual que HWSD2.db (--db).
+
+    Modificar HWSD2.db cambia su huella: la caché persistente se regenera.
+
+    Retorna:
+    - Ruta de la base preparada
+    """
+    if destino is None:
+        conn = sqlite3.connect(db_path)
+        try:
+            indices = [(nombre, tabla, columnas) for nombre, (tabla, columnas) in INDICES_PYAEZ.items()]
+            if cubriente:
+                indices.append(INDICE_CUBRIENTE)
+            for nombre, tabla, columnas in indices:
+                if verbose:
+                    print(f"✓ Índice {nombre} ON {tabla} ({', '.join(columnas)})")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {nombre} ON {tabla} ({', '.join(columnas)})")
+            conn.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+        return Path(db_path)
+
+    destino = Path(destino)
+    if destino.exists():
+        destino.unlink()
+    conn = sqlite3.connect(destino)
+    try:
+        conn.execute("ATTACH DATABASE ? AS origen",
+                     (f"file:{pathname2url(str(Path(db_path).resolve()))}?mode=ro",))
+        tipos = {fila[1]: fila[2] for fila in conn.execute("PRAGMA origen.table_info(HWSD2_LAYERS)")}
+        columnas = ', '.join(COLUMNAS_CAPAS_PYAEZ)
+        definiciones = ', '.join(f"{c} {tipos.get(c, '')}".strip() for c in COLUMNAS_CAPAS_PYAEZ)
+
+        conn.executescript(f"""
+            CREATE TABLE HWSD2_LAYERS ({definiciones}, PRIMARY KEY (HWSD2_SMU_ID, ID)) WITHOUT ROWID;
+            INSERT INTO HWSD2_LAYERS SELECT {columnas} FROM origen.HWSD2_LAYERS ORDER BY HWSD2_SMU_ID, ID;
+            CREATE TABLE HWSD2_SMU AS SELECT HWSD2_SMU_ID, WRB4, WRB2 FROM origen.HWSD2_SMU;
+            CREATE INDEX idx_pyaez_smu ON HWSD2_SMU (HWSD2_SMU_ID);
+        """)
+        for tabla, _, _ in RegistroTablas.TABLAS.values():
+            conn.execute(f"CREATE TABLE {tabla} AS SELECT * FROM origen.{tabla}")
+        conn.commit()
+        conn.execute("DETACH DATABASE origen")
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+    if verbose:
+        tamano_origen, tamano_destino = Path(db_path).stat().st_size, destino.stat().st_size
+        print(f"✓ Copia reducida: {destino} ({tamano_destino / 1e6:.1f} MB, "
+              f"origen {tamano_origen / 1e6:.1f} MB)")
+    return destino
+
+def plan_consulta(conn, query):
+    """Líneas de EXPLAIN QUERY PLAN de una consulta"""
+    return [fila[-1] for fila in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+
+def diagnosticar_bd(db, smu_ids=None, capas=None):
+    """
+    Asesor de índices: planes de las consultas del extractor y recomendaciones
+
+    Revisa con EXPLAIN QUERY PLAN la lectura de capas (obtener_capas), la
+    consolidación en SQLite (obtener_consolidado_sql) y la consulta de WRB
+    por SMU. Un recorrido completo de HWSD2_LAYERS o HWSD2_SMU (SCAN sin
+    índice) o un ordenamiento temporal indican que falta preparar_bd.
+
+    Retorna:
+    - dict con 'indices' (índices de HWSD2_LAYERS/HWSD2_SMU), 'planes'
+      (consulta → líneas del plan) y 'recomendaciones' (vacía si el acceso
+      ya es óptimo)
+    """
+    smu_ids = IDS_ESWATINI if smu_ids is None else list(smu_ids)
+    capas = CAPAS if capas is None else list(capas)
+
+    conn = conectar_solo_lectura(db) if not isinstance(db, sqlite3.Connection) else db
+    try:
+        filtro = _tabla_ids(conn, smu_ids)
+        indices = {
+            tabla: [fila[1] for fila in conn.execute(f"PRAGMA index_list({tabla})")]
+            for tabla in ('HWSD2_LAYERS', 'HWSD2_SMU')
+        }
+        planes = {
+            'capas': plan_consulta(conn, _consulta_capas(filtro)),
+            'consolidado': plan_consulta(conn, _consulta_consolidado(filtro, capas)),
+            'smu': plan_consulta(conn, _consulta_wrb(filtro)),
+        }
+    finally:
+        if conn is not db:
+            conn.close()
+
+    recomendaciones = []
+    for consulta, plan in planes.items():
+        for linea in plan:
+            if linea.startswith('SCAN HWSD2_LAYERS') or linea.startswith('SCAN HWSD2_SMU'):
+                recomendaciones.append(f"{consulta}: recorrido completo ({linea}); ejecutar preparar_bd")
+            elif linea.startswith('SCAN') and linea.endswith('LEFT-JOIN'):
+                recomendaciones.append(f"{consulta}: cruce sin índice ({linea}); "
+                                       f"cada fila recorre la tabla unida completa")
+            elif consulta == 'capas' and 'TEMP B-TREE FOR ORDER BY' in linea:
+                recomendaciones.append(f"{consulta}: ordenamiento temporal ({linea}); "
+                                       f"falta un índice (HWSD2_SMU_ID, ID, TOPDEP)")
+
+    return {'indices': indices, 'planes': planes, 'recomendaciones': recomendaciones}
+
+# ============================================================================
+# SECCIÓN 12: INSTRUMENTACIÓN POR ETAPA
+# ============================================================================
+
+def memoria_pico_mb():
+    """Pico de memoria residente (RSS) del proceso en MB; None si no se puede medir"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    return round(pico / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+class MedidorEtapas:
+    """
+    Tiempo, filas y pico de memoria de cada etapa de una extracción
+
+    Cada etapa terminada se registra en self.etapas y se emite por LOGGER
+    (nivel INFO), de modo que basta configurar logging para seguir una
+    ejecución en lote. reporte() y guardar() generan el reporte JSON.
+
+    Uso:
+        medidor = MedidorEtapas(db='HWSD2.db')
+        with medidor.etapa('consulta', filas_entrada=len(smu_ids)) as etapa:
+            df_all = obtener_capas(conn, smu_ids)
+            etapa['filas_salida'] = len(df_all)
+        medidor.guardar('reporte.json')
+
+    El pico de memoria es el del proceso hasta el final de la etapa
+    (getrusage): crece de forma monótona, así que rss_pico_incremento_mb
+    indica qué etapa lo elevó.
+    """
+
+    def __init__(self, **contexto):
+        self.contexto = contexto
+        self.etapas = []
+        self._inicio = time.perf_counter()
+        self._fecha = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    @contextmanager
+    def etapa(self, nombre, filas_entrada=None, **detalle):
+        """
+        Mide el bloque with como una etapa; el dict entregado acepta
+        filas_salida y cualquier otro detalle de la etapa
+        """
+        registro = {'etapa': nombre, 'filas_entrada': filas_entrada, 'filas_salida': None, **detalle}
+        rss_inicio = memoria_pico_mb()
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro['segundos'] = round(time.perf_counter() - inicio, 6)
+            registro['rss_pico_mb'] = memoria_pico_mb()
+            registro['rss_pico_incremento_mb'] = (
+                None if rss_inicio is None else round(registro['rss_pico_mb'] - rss_inicio, 1))
+            self._agregar(registro)
+
+    def registrar(self, nombre, segundos, filas_entrada=None, filas_salida=None, **detalle):
+        """
+        Registra una etapa medida por partes (p. ej. la suma de todos los
+        bloques); el pico de memoria es el del proceso al registrarla
+        """
+        self._agregar({'etapa': nombre, 'filas_entrada': filas_entrada, 'filas_salida': filas_salida,
+                       **detalle, 'segundos': round(segundos, 6), 'rss_pico_mb': memoria_pico_mb(),
+                       'rss_pico_incremento_mb': None})
+
+    def _agregar(self, registro):
+        self.etapas.append(registro)
+        LOGGER.info("etapa=%s segundos=%.3f filas_entrada=%s filas_salida=%s rss_pico_mb=%s",
+                    registro['etapa'], registro['segundos'], registro['filas_entrada'],
+                    registro['filas_salida'], registro['rss_pico_mb'])
+
+    def reporte(self):
+        """Reporte de la ejecución como dict serializable a JSON"""
+        return {
+            'inicio': self._fecha,
+            'segundos_total': round(time.perf_counter() - self._inicio, 6),
+            'rss_pico_mb': memoria_pico_mb(),
+            'version_reglas': VERSION_REGLAS,
+            'contexto': self.contexto,
+            'etapas': self.etapas,
+        }
+
+    def guardar(self, ruta):
+        """Escribe el reporte JSON en ruta"""
+        with open(ruta, 'w', encoding='utf-8') as f:
+            json.dump(self.reporte(), f, indent=2, ensure_ascii=False, default=str)
+        return ruta
+
+# ============================================================================
+# PUNTO DE ENTRADA DE LIBRERÍA
+# ============================================================================
+
+def extraer_pyaez(db, smu_ids=None, capas=None, output=None, motor='pandas', formato=None,
+                  particionar_por_capa=False, cache=None, verbose=False, detalle=True, medidor=None,
+                  reglas=None, violaciones=None):
+    """
+    Extrae los datos de suelo en formato PyAEZ para un conjunto de SMU
+
+    Parámetros:
+    - db: Ruta a HWSD2.db o conexión sqlite3 abierta (se reutiliza sin cerrarla)
+    - smu_ids: Lista de HWSD2_SMU_ID (por defecto IDS_ESWATINI)
+    - capas: Lista de capas a procesar (por defecto CAPAS, D1-D7)
+    - output: Ruta del archivo multicapa a generar (None = no escribir archivo)
+    - formato: 'excel', 'csv', 'parquet' o 'feather' (None = según extensión de output)
+    - particionar_por_capa: Escribe un archivo por capa dentro de la carpeta output
+    - motor: 'pandas' (consolida en memoria) o 'sql' (consolida en SQLite y
+      solo transfiere una fila por tipo de suelo y capa; ver comparar_motores)
+    - cache: CachePyAEZ opcional; solo se consultan y consolidan los SMU que
+      no están en caché, y los nuevos resultados se agregan a ella
+    - verbose: Imprime el progreso de cada sección
+    - detalle: Con verbose, imprime también las vistas previas y los conteos
+      por capa (False para registros de ejecuciones en lote)
+    - medidor: MedidorEtapas opcional que registra tiempo, filas y memoria
+      de cada etapa (las etapas se emiten por LOGGER también sin medidor)
+    - reglas: Reglas de validación (por defecto REGLAS_VALIDACION; ver
+      configurar_reglas). No se combina con cache: la caché guarda los
+      registros validados con las reglas por defecto
+    - violaciones: Lista opcional a la que se agrega la tabla de violaciones
+      de los SMU consolidados en esta llamada (ver tabla_violaciones)
+
+    Retorna:
+    - dict capa → DataFrame PyAEZ tipado (solo capas con datos válidos; ver
+      tipar_pyaez, y exportar_pyaez para los valores PyAEZ originales)
+    """
+    smu_ids = IDS_ESWATINI if smu_ids is None else list(smu_ids)
+    capas = CAPAS if capas is None else list(capas)
+    if motor not in MOTORES:
+        raise ValueError(f"Motor desconocido: {motor!r} (opciones: {', '.join(MOTORES)})")
+    medidor = MedidorEtapas() if medidor is None else medidor
+    if reglas is not None and cache is not None:
+        raise ValueError("La caché guarda registros validados con REGLAS_VALIDACION: no se combina con reglas")
+    if cache is not None and cache.motor != motor:
+        raise ValueError(f"La caché guarda registros del motor {cache.motor!r}, no de {motor!r}")
+
+    df_cache = None
+    if cache is not None:
+        with medidor.etapa('cache', filas_entrada=len(smu_ids)) as etapa:
+            df_cache, faltantes = cache.obtener(smu_ids, capas)
+            etapa.update(filas_salida=len(df_cache), smu_faltantes=len(faltantes))
+        if verbose:
+            print(f"✓ Caché: {len(set(smu_ids)) - len(faltantes)} SMU reutilizados, {len(faltantes)} por consultar")
+        smu_ids = faltantes
+
+    resultados = {}
+    if smu_ids:
+        conn = conectar_solo_lectura(db) if not isinstance(db, sqlite3.Connection) else db
+        try:
+            with medidor.etapa('tablas'):
+                tablas = cargar_tablas_referencia(conn, verbose=verbose)
+            # VSP usa los promedios de D1 de la misma lectura de HWSD2_LAYERS
+            with medidor.etapa('consulta', filas_entrada=len(smu_ids), motor=motor) as etapa:
+                if motor == 'sql':
+                    df_consolidated = obtener_consolidado_sql(conn, smu_ids, capas, verbose=verbose)
+                    df_arcilla = df_consolidated[['HWSD2_SMU_ID'] + COLUMNAS_ARCILLA_VSP].drop_duplicates('HWSD2_SMU_ID')
+                    filas_consulta = len(df_consolidated)
+                else:
+                    df_all = obtener_capas(conn, smu_ids, verbose=verbose, detalle=detalle)
+                    df_arcilla = arcilla_d1(df_all)
+                    filas_consulta = len(df_all)
+                etapa['filas_salida'] = filas_consulta
+            with medidor.etapa('vsp', filas_entrada=len(smu_ids)) as etapa:
+                vsp_map = calcular_vsp(conn, smu_ids, verbose=verbose, tablas=tablas, df_arcilla=df_arcilla)
+                etapa.update(filas_salida=len(vsp_map), smu_vertic=int(sum(vsp_map.values())))
+        finally:
+            if conn is not db:
+                conn.close()
+
+        # Todas las capas se consolidan en una sola pasada: la etapa informa
+        # los registros de salida de cada capa
+        with medidor.etapa('consolidacion', filas_entrada=filas_consulta) as etapa:
+            if motor == 'sql':
+                df_pyaez_all = formatear_pyaez(df_consolidated, tablas, vsp_map, reglas=reglas,
+                                               violaciones=violaciones)
+                resultados = separar_por_capa(df_pyaez_all, capas, verbose=verbose, detalle=detalle)
+            else:
+                resultados = procesar_capas(df_all, capas, tablas, vsp_map, verbose=verbose, detalle=detalle,
+                                            reglas=reglas, violaciones=violaciones)
+            etapa.update(filas_salida=sum(len(df) for df in resultados.values()),
+                         filas_por_capa={capa: len(df) for capa, df in resultados.items()})
+
+        if cache is not None:
+            with medidor.etapa('cache_guardado') as etapa:
+                df_nuevo = combinar_capas(resultados) if resultados else pd.DataFrame(columns=COLUMNAS_PYAEZ)
+                cache.guardar(df_nuevo, smu_ids, capas)
+                etapa['filas_salida'] = len(df_nuevo)
+
+    if df_cache is not None and len(df_cache) > 0:
+        with medidor.etapa('combinacion_cache', filas_entrada=len(df_cache)) as etapa:
+            partes = [df_cache] + ([combinar_capas(resultados)] if resultados else [])
+            resultados = separar_por_capa(concatenar_pyaez(partes), capas, verbose=False)
+            etapa['filas_salida'] = sum(len(df) for df in resultados.values())
+
+    if output is not None:
+        with medidor.etapa('escritura', filas_entrada=sum(len(df) for df in resultados.values())) as etapa:
+            guardar_resultados(resultados, output, formato=formato,
+                               particionar_por_capa=particionar_por_capa, verbose=verbose)
+            etapa['filas_salida'] = etapa['filas_entrada']
+
+    return resultados
+
+def comparar_motores(db, smu_ids=None, capas=None):
+    """
+    Compara la salida PyAEZ final de los motores 'pandas' y 'sql'
+
+    Extrae los mismos SMU con ambos motores y compara celda a celda los
+    valores exportados (exportar_pyaez, ya redondeados y tipados), que son los
+    que se escriben en los archivos. Los motores no son intercambiables bit a
+    bit: pandas promedia con suma compensada (Kahan) en el orden de las filas
+    y SQLite (< 3.43) con suma simple, así que un promedio que cae justo en la
+    mitad del redondeo (p. ej. OC = 3.1995) puede quedar en 3.2 con un motor
+    y en 3.199 con el otro. Las modas, VSP y los textos coinciden.
+
+    Retorna:
+    - DataFrame con las celdas distintas (CODE, LAYER, variable, pandas,
+      sql), incluidos los registros que solo produce uno de los motores;
+      vacío si ambas salidas son idénticas
+    """
+    conn = conectar_solo_lectura(db) if not isinstance(db, sqlite3.Connection) else db
+    try:
+        salidas = [
+            exportar_pyaez(combinar_capas(extraer_pyaez(conn, smu_ids, capas, motor=motor)))
+            .astype({'LAYER': str}).set_index(['CODE', 'LAYER']).sort_index()
+            for motor in MOTORES
+        ]
+    finally:
+        if conn is not db:
+            conn.close()
+    df_pandas, df_sql = salidas[0].align(salidas[1], join='outer')
+
+    diferencias = []
+    for variable in COLUMNAS_PYAEZ[2:]:
+        a, b = df_pandas[variable].astype(object), df_sql[variable].astype(object)
+        distintos = ~((a == b) | (a.isna() & b.isna()))
+        for (code, layer), valor_a, valor_b in zip(a[distintos].index, a[distintos], b[distintos]):
+            diferencias.append((code, layer, variable, valor_a, valor_b))
+
+    return pd.DataFrame(diferencias, columns=['CODE', 'LAYER', 'variable', 'pandas', 'sql'])
+
+# ============================================================================
+# LÍNEA DE COMANDOS
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extrae datos de suelo de HWSD2.db en formato PyAEZ (capas D1-D7)")
+    parser.add_argument('--db', default='HWSD2.db',
+                        help="Base de datos SQLite HWSD v2.0 (por defecto: HWSD2.db)")
+    parser.add_argument('--ids', type=int, nargs='+', default=IDS_ESWATINI,
+                        help="HWSD2_SMU_ID a extraer (por defecto: 31 tipos de suelo de Eswatini)")
+    parser.add_argument('--capas', nargs='+', default=CAPAS, choices=CAPAS,
+                        help="Capas de profundidad a procesar (por defecto: D1-D7)")
+    parser.add_argument('--motor', default='pandas', choices=MOTORES,
+                        help="Dónde consolidar los perfiles: en memoria con pandas o dentro de SQLite")
+    parser.add_argument('--todos', action='store_true',
+                        help="Extrae todos los SMU de la base de datos (ignora --ids; requiere --bloque)")
+    parser.add_argument('--bloque', type=int, metavar='FILAS',
+                        help="Extracción por bloques de FILAS registros con memoria acotada (salida CSV o Parquet)")
+    parser.add_argument('--hilos', type=int, metavar='N',
+                        help="Con --bloque, consolida con N hilos mientras otro lee y el principal escribe")
+    parser.add_argument('--regiones', metavar='JSON',
+                        help="Archivo JSON {nombre: [HWSD2_SMU_ID, ...]}: extrae cada región en paralelo "
+                             "(--salida es la carpeta de destino)")
+    parser.add_argument('--procesos', type=int,
+                        help="Procesos para --regiones (por defecto: número de CPUs)")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="Carpeta de caché persistente: solo se consultan los SMU no procesados antes")
+    parser.add_argument('--salida', default=SALIDA_POR_DEFECTO,
+                        help=f"Archivo de salida (por defecto: {SALIDA_POR_DEFECTO})")
+    parser.add_argument('--formato', choices=FORMATOS_SALIDA,
+                        help="Formato de salida (por defecto: según la extensión de --salida)")
+    parser.add_argument('--por-capa', action='store_true',
+                        help="Escribe un archivo por capa en la carpeta --salida (por defecto Parquet)")
+    parser.add_argument('--silencioso', action='store_true',
+                        help="No imprime el progreso ni las estadísticas de validación")
+    parser.add_argument('--breve', action='store_true',
+                        help="Imprime el progreso sin vistas previas ni conteos por valor")
+    parser.add_argument('--reporte', metavar='JSON',
+                        help="Escribe un reporte JSON con tiempo, filas y pico de memoria por etapa")
+    parser.add_argument('--log', metavar='NIVEL', choices=['DEBUG', 'INFO', 'WARNING'],
+                        help="Emite las etapas por logging en stderr con este nivel (p. ej. INFO)")
+    parser.add_argument('--violaciones', metavar='ARCHIVO',
+                        help="Escribe la tabla de violaciones de las reglas de validación (CSV, Parquet, ...)")
+    parser.add_argument('--accion', nargs='+', metavar='REGLA=ACCION', default=[],
+                        help=f"Cambia la acción de una regla de REGLAS_VALIDACION "
+                             f"({', '.join(ACCIONES_VALIDACION)}), p. ej. pH_rango=rechazar")
+    parser.add_argument('--preparar', nargs='?', const='', metavar='DESTINO',
+                        help="Crea los índices del extractor en --db y ejecuta ANALYZE; con DESTINO "
+                             "genera en su lugar una copia reducida de --db con solo lo necesario")
+    parser.add_argument('--cubriente', action='store_true',
+                        help="Con --preparar, añade un índice cubriente para --motor sql")
+    parser.add_argument('--diagnosticar', action='store_true',
+                        help="Muestra los planes de consulta sobre --db y los índices recomendados")
+    args = parser.parse_args(argv)
+    verbose = not args.silencioso
+    detalle = not args.breve
+
+    if args.log:
+        logging.basicConfig(level=args.log, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    reglas = None
+    if args.accion:
+        try:
+            reglas = configurar_reglas(args.accion)
+        except ValueError as error:
+            parser.error(str(error))
+        if args.cache:
+            parser.error("--accion no se combina con --cache")
+    violaciones = [] if args.violaciones else None
+
+    if args.preparar is not None:
+        preparar_bd(args.db, args.preparar or None, cubriente=args.cubriente, verbose=verbose)
+        return
+
+    if args.diagnosticar:
+        diagnostico = diagnosticar_bd(args.db, args.ids, args.capas)
+        for tabla, indices in diagnostico['indices'].items():
+            print(f"{tabla}: {', '.join(indices) if indices else 'sin índices'}")
+        for consulta, plan in diagnostico['planes'].items():
+            print(f"\n[{consulta}]")
+            for linea in plan:
+                print(f"  {linea}")
+        print()
+        for recomendacion in diagnostico['recomendaciones'] or ["✓ Acceso por índice en todas las consultas"]:
+            print(f"- {recomendacion}")
+        return
+
+    if args.todos and args.bloque is None:
+        parser.error("--todos requiere --bloque")
+    if args.hilos is not None and (args.bloque is None or args.hilos < 1):
+        parser.error("--hilos requiere --bloque y al menos 1 hilo")
+
+    if args.regiones is not None:
+        if args.bloque is not None or args.todos or args.por_capa:
+            parser.error("--regiones no se combina con --bloque, --todos ni --por-capa")
+        with open(args.regiones, encoding='utf-8') as f:
+            regiones = json.load(f)
+        directorio = '.' if args.salida == SALIDA_POR_DEFECTO else args.salida
+        medidor = MedidorEtapas(db=str(args.db), motor=args.motor, capas=args.capas,
+                                regiones=len(regiones))
+        extraer_regiones(args.db, regiones, directorio, args.capas, motor=args.motor,
+                         formato=args.formato or 'excel', max_workers=args.procesos,
+                         directorio_cache=args.cache, verbose=verbose, medidor=medidor,
+                         reglas=reglas, violaciones=violaciones)
+        if args.violaciones:
+            escribir_salida(tabla_violaciones(violaciones), args.violaciones)
+        if args.reporte:
+            medidor.guardar(args.reporte)
+        return
+
+    medidor = MedidorEtapas(db=str(args.db), motor=args.motor, capas=args.capas,
+                            smu=None if args.todos else len(args.ids))
+
+    if args.bloque is not None:
+        smu_ids = None if args.todos else args.ids
+        if args.hilos:
+            extraer_pyaez_canalizado(args.db, args.salida, smu_ids, args.capas, tamano_bloque=args.bloque,
+                                     formato=args.formato, trabajadores=args.hilos, verbose=verbose,
+                                     medidor=medidor, reglas=reglas, violaciones=violaciones)
+        else:
+            extraer_pyaez_por_bloques(args.db, args.salida, smu_ids, args.capas,
+                                      tamano_bloque=args.bloque, formato=args.formato, verbose=verbose,
+                                      medidor=medidor, reglas=reglas, violaciones=violaciones)
+        if args.violaciones:
+            escribir_salida(tabla_violaciones(violaciones), args.violaciones)
+        if args.reporte:
+            medidor.guardar(args.reporte)
+        return
+
+    if verbose:
+        print("="*80)
+        print("GENERANDO FORMATO PyAEZ PARA ESWATINI")
+        print("="*80)
+
+    cache = CachePyAEZ(args.cache, args.db, motor=args.motor) if args.cache else None
+    try:
+        resultados = extraer_pyaez(args.db, args.ids, args.capas, motor=args.motor, cache=cache,
+                                   verbose=verbose, detalle=detalle, medidor=medidor, reglas=reglas,
+                                   violaciones=violaciones)
+    finally:
+        if cache is not None:
+            cache.cerrar()
+    if not resultados:
+        parser.error(f"No hay datos válidos para ninguna capa de los IDs solicitados ({len(args.ids)} SMU)")
+    with medidor.etapa('combinacion', filas_entrada=sum(len(df) for df in resultados.values())) as etapa:
+        df_multicapa = combinar_capas(resultados)
+        etapa['filas_salida'] = len(df_multicapa)
+    with medidor.etapa('escritura', filas_entrada=len(df_multicapa)) as etapa:
+        if args.por_capa:
+            guardar_resultados(resultados, args.salida, formato=args.formato,
+                               particionar_por_capa=True, verbose=verbose)
+            formato = args.formato or 'parquet'
+        else:
+            guardar_multicapa(df_multicapa, args.salida, formato=args.formato, verbose=verbose)
+            formato = detectar_formato(args.salida, args.formato)
+        etapa.update(filas_salida=len(df_multicapa), formato=formato)
+
+    df_violaciones = None
+    if args.violaciones:
+        df_violaciones = tabla_violaciones(violaciones)
+        escribir_salida(df_violaciones, args.violaciones)
+
+    if args.reporte:
+        medidor.guardar(args.reporte)
+
+    if not verbose:
+        return
+
+    imprimir_estadisticas(df_multicapa, detalle=detalle, df_violaciones=df_violaciones)
+
+    print("\n" + "="*80)
+    print("✓ PROCESO COMPLETADO EXITOSAMENTE")
+    print("="*80)
+    print(f"""
 
 ARCHIVO GENERADO:
 -----------------
-{output_filename}
-  - Formato: Excel (.xlsx)
-  - Estructura: Todas las capas D1-D7 en un solo archivo
+{args.salida}
+  - Formato: {formato} ({EXTENSION_POR_FORMATO[formato]})
+  - Estructura: {'Un archivo por capa' if args.por_capa else 'Todas las capas D1-D7 en un solo archivo'}
   - Columnas: 19 variables PyAEZ + LAYER identifier
   - Compatible con PyAEZ para análisis agroecológico
 
@@ -543,4 +2727,8 @@ REFERENCIAS APLICADAS:
 - USDA Soil Texture Classification
 - FAO Agro-Ecological Zones Guidelines (1996)
 - PyAEZ Technical Documentation
-""")
\ No newline at end of file
+""")
+
+
+if __name__ == '__main__':
+    main()
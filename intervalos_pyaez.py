@@ -0,0 +1,228 @@
+"""
+INTERVALOS DE PROFUNDIDAD: AGREGADOS PyAEZ PONDERADOS POR ESPESOR
+=================================================================
+
+El extractor (eswatini_pyaez_suelos.py) consolida cada capa D1-D7 de HWSD2
+por separado. Para un intervalo de profundidad (0-30 cm, 30-100 cm o la zona
+radicular hasta ROOT_DEPTH) no basta con promediar capas: cada capa debe
+pesar según los cm que aporta al intervalo. Este módulo:
+
+1. Lee HWSD2_LAYERS una sola vez (los mismos registros que obtener_capas)
+2. Calcula, para todos los registros e intervalos a la vez, el espesor de
+   cada registro dentro de cada intervalo a partir de TOPDEP/BOTDEP
+3. Consolida por (HWSD2_SMU_ID, intervalo) en una sola pasada: promedio
+   ponderado por espesor de las variables continuas y moda ponderada de las
+   categóricas (consolidar_ponderado)
+4. Aplica las mismas reglas PyAEZ que las capas (formatear_pyaez): BS se
+   recalcula desde TEB/CEC_soil ya agregados, nunca se promedia
+
+Agregar intervalos no repite la lectura ni la consolidación por intervalo:
+todos comparten una sola agrupación vectorizada.
+
+INTERVALOS:
+-----------
+    '0-30'      de 0 a 30 cm
+    '30-100'    de 30 a 100 cm
+    '0-RSD'     de 0 cm hasta ROOT_DEPTH de cada perfil (zona radicular)
+
+USO:
+----
+    python intervalos_pyaez.py --db HWSD2.db --intervalos 0-30 30-100 0-RSD
+    python intervalos_pyaez.py --db HWSD2.db --capas D1 D2 --salida suelos.xlsx   (capas e intervalos)
+"""
+
+import argparse
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import eswatini_pyaez_suelos as extractor
+
+# Base de intervalo que sigue la profundidad radicular de cada perfil
+RAIZ = 'RSD'
+
+# Profundidad radicular (cm) de los perfiles sin ROOT_DEPTH, la misma que
+# usa formatear_pyaez para RSD
+RSD_POR_DEFECTO = 100
+
+INTERVALOS_POR_DEFECTO = ['0-30', '30-100', '0-RSD']
+
+SALIDA_POR_DEFECTO = "eswatini_soil_INTERVALOS_pyaez.xlsx"
+
+# ============================================================================
+# SECCIÓN 1: DEFINICIÓN DE INTERVALOS
+# ============================================================================
+
+def parsear_intervalo(texto):
+    """
+    Convierte 'TOPE-BASE' en (tope, base) en cm; BASE puede ser RAIZ ('RSD')
+
+    '0-30' → (0.0, 30.0); '0-RSD' → (0.0, 'RSD')
+    """
+    tope, separador, base = str(texto).partition('-')
+    try:
+        tope = float(tope)
+        base = RAIZ if base.strip().upper() == RAIZ else float(base)
+    except ValueError:
+        raise ValueError(f"Intervalo inválido: {texto!r} (formato TOPE-BASE en cm, p. ej. 0-30 o 0-{RAIZ})")
+    if not separador or tope < 0 or (base != RAIZ and base <= tope):
+        raise ValueError(f"Intervalo inválido: {texto!r} (se requiere 0 <= TOPE < BASE)")
+    return tope, base
+
+def normalizar_intervalos(intervalos=None):
+    """
+    dict nombre → (tope, base) a partir de una lista de textos 'TOPE-BASE'
+    o de un dict ya armado (None = INTERVALOS_POR_DEFECTO)
+    """
+    if intervalos is None:
+        intervalos = INTERVALOS_POR_DEFECTO
+    if isinstance(intervalos, dict):
+        return {str(nombre): (float(tope), base if base == RAIZ else float(base))
+                for nombre, (tope, base) in intervalos.items()}
+    return {str(texto): parsear_intervalo(texto) for texto in intervalos}
+
+# ============================================================================
+# SECCIÓN 2: ESPESORES Y AGREGACIÓN PONDERADA
+# ============================================================================
+
+def espesores_en_intervalos(df_capas, intervalos):
+    """
+    Matriz (registros × intervalos) de cm de cada registro dentro de cada intervalo
+
+    Solape de [TOPDEP, BOTDEP] con [tope, base]; en los intervalos hasta RAIZ
+    la base es el ROOT_DEPTH del propio registro (RSD_POR_DEFECTO sin dato).
+    Registros sin TOPDEP/BOTDEP aportan 0 cm.
+    """
+    tope_capa = pd.to_numeric(df_capas['TOPDEP'], errors='coerce').to_numpy(dtype=float)
+    base_capa = pd.to_numeric(df_capas['BOTDEP'], errors='coerce').to_numpy(dtype=float)
+    raiz = (pd.to_numeric(df_capas['ROOT_DEPTH'], errors='coerce')
+            .fillna(RSD_POR_DEFECTO).to_numpy(dtype=float))
+
+    topes = np.array([tope for tope, _ in intervalos.values()], dtype=float)
+    bases = np.column_stack([raiz if base == RAIZ else np.full(len(df_capas), base)
+                             for _, base in intervalos.values()]) if intervalos else np.empty((len(df_capas), 0))
+
+    espesores = np.minimum(base_capa[:, None], bases) - np.maximum(tope_capa[:, None], topes)
+    return np.nan_to_num(np.clip(espesores, 0, None), nan=0.0)
+
+def agregar_intervalos(df_all, intervalos=None):
+    """
+    Consolida los registros de HWSD2_LAYERS por (HWSD2_SMU_ID, intervalo)
+
+    Usa los registros válidos (ORG_CARBON > 0), igual que las capas. Cada
+    registro pesa los cm que aporta al intervalo; los perfiles de un mismo
+    SMU se combinan con el mismo peso por cm. Todos los intervalos se
+    consolidan en una sola agrupación (consolidar_ponderado).
+
+    Retorna:
+    - DataFrame consolidado con LAYER = nombre del intervalo, listo para
+      formatear_pyaez
+    """
+    intervalos = normalizar_intervalos(intervalos)
+    df_valid = df_all[df_all['ORG_CARBON'] > 0]
+
+    espesores = espesores_en_intervalos(df_valid, intervalos)
+    filas, columnas = np.nonzero(espesores > 0)
+
+    # Formato largo: un registro por (registro de capa, intervalo que toca)
+    df_largo = df_valid.iloc[filas][['HWSD2_SMU_ID'] + extractor.COLUMNAS_PROMEDIO + extractor.COLUMNAS_MODA]
+    df_largo = df_largo.reset_index(drop=True).assign(
+        LAYER=np.array(list(intervalos), dtype=object)[columnas],
+        _espesor=espesores[filas, columnas],
+    )
+    return extractor.consolidar_ponderado(df_largo, '_espesor')
+
+# ============================================================================
+# SECCIÓN 3: EXTRACCIÓN
+# ============================================================================
+
+def extraer_intervalos(db, smu_ids=None, intervalos=None, capas=None, output=None, formato=None,
+                       verbose=False, reglas=None, violaciones=None):
+    """
+    Extrae los agregados PyAEZ por intervalo de profundidad
+
+    Parámetros:
+    - db: Ruta a HWSD2.db o conexión sqlite3 abierta (se reutiliza sin cerrarla)
+    - smu_ids: Lista de HWSD2_SMU_ID (por defecto IDS_ESWATINI)
+    - intervalos: Lista de textos 'TOPE-BASE' o dict nombre → (tope, base)
+      (por defecto INTERVALOS_POR_DEFECTO)
+    - capas: Capas D1-D7 que se consolidan además de los intervalos, con la
+      misma lectura de HWSD2_LAYERS (None = solo intervalos)
+    - output: Ruta del archivo multicapa a generar (None = no escribir archivo)
+    - formato: 'excel', 'csv', 'parquet' o 'feather' (None = según extensión de output)
+    - verbose: Imprime el progreso de cada sección
+    - reglas, violaciones: Reglas de validación y lista de tablas de
+      violaciones (ver extractor.formatear_pyaez)
+
+    Retorna:
+    - dict intervalo (y capa) → DataFrame PyAEZ tipado; la columna LAYER de
+      combinar_capas lleva el nombre del intervalo
+    """
+    smu_ids = extractor.IDS_ESWATINI if smu_ids is None else list(smu_ids)
+    intervalos = normalizar_intervalos(intervalos)
+
+    conn = extractor.conectar_solo_lectura(db) if not isinstance(db, sqlite3.Connection) else db
+    try:
+        tablas = extractor.cargar_tablas_referencia(conn, verbose=verbose)
+        df_all = extractor.obtener_capas(conn, smu_ids, verbose=verbose)
+        vsp_map = extractor.calcular_vsp(conn, smu_ids, verbose=verbose, tablas=tablas,
+                                         df_arcilla=extractor.arcilla_d1(df_all))
+    finally:
+        if conn is not db:
+            conn.close()
+
+    resultados = {}
+    if capas:
+        resultados.update(extractor.procesar_capas(df_all, list(capas), tablas, vsp_map, verbose=verbose,
+                                                   reglas=reglas, violaciones=violaciones))
+
+    if verbose:
+        print("\n" + "="*80)
+        print("[5] AGREGANDO INTERVALOS " + ", ".join(intervalos))
+        print("="*80)
+
+    df_consolidated = agregar_intervalos(df_all, intervalos)
+    df_pyaez_all = extractor.formatear_pyaez(df_consolidated, tablas, vsp_map, reglas=reglas,
+                                             violaciones=violaciones)
+    resultados.update(extractor.separar_por_capa(df_pyaez_all, list(intervalos), verbose=verbose))
+
+    if output is not None:
+        extractor.guardar_multicapa(extractor.combinar_capas(resultados), output, formato=formato,
+                                    verbose=verbose)
+
+    return resultados
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Agregados PyAEZ ponderados por espesor sobre intervalos de profundidad de HWSD2")
+    parser.add_argument('--db', default='HWSD2.db', help="Base de datos SQLite HWSD v2.0 (por defecto: HWSD2.db)")
+    parser.add_argument('--ids', type=int, nargs='+', default=extractor.IDS_ESWATINI,
+                        help="HWSD2_SMU_ID a extraer (por defecto: 31 tipos de suelo de Eswatini)")
+    parser.add_argument('--intervalos', nargs='+', default=INTERVALOS_POR_DEFECTO, metavar='TOPE-BASE',
+                        help=f"Intervalos en cm; BASE {RAIZ} = hasta ROOT_DEPTH "
+                             f"(por defecto: {' '.join(INTERVALOS_POR_DEFECTO)})")
+    parser.add_argument('--capas', nargs='+', choices=extractor.CAPAS,
+                        help="Capas D1-D7 a incluir también en la salida (por defecto: ninguna)")
+    parser.add_argument('--salida', default=SALIDA_POR_DEFECTO,
+                        help=f"Archivo de salida (por defecto: {SALIDA_POR_DEFECTO})")
+    parser.add_argument('--formato', choices=extractor.FORMATOS_SALIDA,
+                        help="Formato de salida (por defecto: según la extensión de --salida)")
+    parser.add_argument('--silencioso', action='store_true')
+    args = parser.parse_args(argv)
+
+    try:
+        intervalos = normalizar_intervalos(args.intervalos)
+    except ValueError as error:
+        parser.error(str(error))
+
+    try:
+        extraer_intervalos(args.db, args.ids, intervalos, capas=args.capas, output=args.salida,
+                           formato=args.formato, verbose=not args.silencioso)
+    except ValueError as error:
+        parser.error(str(error))
+
+
+if __name__ == '__main__':
+    main()
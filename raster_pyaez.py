@@ -0,0 +1,358 @@
+"""
+MODO RASTER: GRILLAS DE SUELO PyAEZ A PARTIR DEL RASTER DE SMU DE HWSD2
+========================================================================
+
+El extractor (eswatini_pyaez_suelos.py) genera una tabla por CODE
+(HWSD2_SMU_ID). PyAEZ necesita una grilla por variable y capa, así que este
+módulo une el raster de SMU de HWSD2 con los registros consolidados:
+
+1. Lee el raster de SMU por bloques de filas (.npy o GeoTIFF)
+2. Descubre los HWSD2_SMU_ID presentes en el raster (sin listas fijas)
+3. Extrae esos SMU con extraer_pyaez
+4. Construye un índice denso ID → fila y lo aplica a cada bloque del raster
+5. Escribe una grilla .npy por capa y variable, mapeada en memoria: el raster
+   y las grillas nunca se cargan completos en RAM
+
+SALIDA:
+-------
+    <directorio>/metadatos.json     forma, variables, nodata, leyendas, perfil GeoTIFF
+    <directorio>/D1/OC.npy          float32, NaN = sin dato
+    <directorio>/D1/BS.npy          int16, -9 = sin dato
+    <directorio>/D1/TXT.npy         uint8, código de leyenda (0 = sin dato; uint16
+                                    si la leyenda tiene más de 255 valores)
+    ...
+
+Las variables de texto (TXT, SPR, SPH, DRG) se guardan como códigos enteros;
+metadatos.json['leyendas'] traduce cada código a su valor PyAEZ.
+
+USO:
+----
+    python raster_pyaez.py hwsd2_smu.npy --db HWSD2.db --salida grillas/
+    python raster_pyaez.py HWSD2.tif --db HWSD2.db --salida grillas/   (requiere rasterio)
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import eswatini_pyaez_suelos as extractor
+
+# Filas del raster leídas y escritas por bloque
+FILAS_POR_BLOQUE = 1024
+
+# Variables PyAEZ por tipo de grilla
+VARIABLES_REALES = ['OC', 'pH', 'TEB', 'GYP']
+VARIABLES_ENTERAS = ['BS', 'CEC_soil', 'CEC_clay', 'RSD', 'OSD', 'ESP', 'EC', 'CCB', 'GRC', 'VSP']
+VARIABLES_CATEGORICAS = ['TXT', 'SPR', 'SPH', 'DRG']
+
+# Tipo y valor sin dato de cada tipo de grilla; las categóricas pasan a
+# TIPO_GRILLA_AMPLIA si su leyenda no cabe en TIPO_GRILLA (ver _tipo_grilla)
+TIPO_GRILLA = {'real': np.float32, 'entera': np.int16, 'categorica': np.uint8}
+TIPO_GRILLA_AMPLIA = np.uint16
+NODATA_GRILLA = {'real': np.nan, 'entera': -9, 'categorica': 0}
+
+METADATOS = 'metadatos.json'
+
+def _tipo_variable(variable):
+    if variable in VARIABLES_REALES:
+        return 'real'
+    if variable in VARIABLES_ENTERAS:
+        return 'entera'
+    return 'categorica'
+
+def _tipo_grilla(variable, leyendas):
+    """
+    dtype de la grilla de una variable
+
+    Los códigos de leyenda van de 1 a len(leyenda) (0 = sin dato): una
+    leyenda de más de 255 valores usa TIPO_GRILLA_AMPLIA en lugar de
+    desbordar uint8. Lanza ValueError si tampoco cabe ahí.
+    """
+    tipo = _tipo_variable(variable)
+    if tipo != 'categorica':
+        return TIPO_GRILLA[tipo]
+    for dtype in (TIPO_GRILLA[tipo], TIPO_GRILLA_AMPLIA):
+        if len(leyendas[variable]) <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f"La leyenda de {variable} tiene {len(leyendas[variable])} valores "
+                     f"(máximo {np.iinfo(TIPO_GRILLA_AMPLIA).max})")
+
+# ============================================================================
+# SECCIÓN 1: LECTURA DEL RASTER DE SMU
+# ============================================================================
+
+class RasterSMU:
+    """
+    Raster de HWSD2_SMU_ID leído por bloques de filas
+
+    Acepta un .npy (abierto con mmap_mode='r') o un GeoTIFF/BIL (requiere
+    rasterio, que se lee por ventanas). nodata: valor sin SMU; por defecto el
+    del GeoTIFF, o ninguno para .npy.
+    """
+
+    def __init__(self, ruta, nodata=None):
+        self.ruta = Path(ruta)
+        self.perfil = None
+        if self.ruta.suffix.lower() == '.npy':
+            self._datos = np.load(self.ruta, mmap_mode='r')
+            if self._datos.ndim != 2:
+                raise ValueError(f"{self.ruta} no es un raster 2D (forma {self._datos.shape})")
+            self._dataset = None
+            self.forma = self._datos.shape
+        else:
+            import rasterio
+
+            self._dataset = rasterio.open(self.ruta)
+            self.forma = (self._dataset.height, self._dataset.width)
+            self.perfil = {
+                'crs': self._dataset.crs.to_string() if self._dataset.crs else None,
+                'transform': list(self._dataset.transform)[:6],
+            }
+            if nodata is None:
+                nodata = self._dataset.nodata
+        self.nodata = nodata
+
+    def bloque(self, fila_inicio, fila_fin, columnas=None):
+        """Filas [fila_inicio, fila_fin) (y opcionalmente columnas (inicio, fin)) como ndarray"""
+        col_inicio, col_fin = columnas if columnas is not None else (0, self.forma[1])
+        if self._dataset is None:
+            return np.asarray(self._datos[fila_inicio:fila_fin, col_inicio:col_fin])
+
+        from rasterio.windows import Window
+
+        ventana = Window(col_inicio, fila_inicio, col_fin - col_inicio, fila_fin - fila_inicio)
+        return self._dataset.read(1, window=ventana)
+
+    def bloques(self, filas_por_bloque=FILAS_POR_BLOQUE):
+        """Genera (fila_inicio, fila_fin, bloque) recorriendo todo el raster"""
+        for inicio in range(0, self.forma[0], filas_por_bloque):
+            fin = min(inicio + filas_por_bloque, self.forma[0])
+            yield inicio, fin, self.bloque(inicio, fin)
+
+    def validos(self, bloque):
+        """Máscara de píxeles con SMU (excluye nodata y NaN)"""
+        mascara = np.ones(bloque.shape, dtype=bool)
+        if np.issubdtype(bloque.dtype, np.floating):
+            mascara &= ~np.isnan(bloque)
+        if self.nodata is not None:
+            mascara &= bloque != self.nodata
+        return mascara
+
+    def cerrar(self):
+        if self._dataset is not None:
+            self._dataset.close()
+            self._dataset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+def descubrir_ids(raster, filas_por_bloque=FILAS_POR_BLOQUE):
+    """
+    HWSD2_SMU_ID presentes en el raster (ordenados, sin nodata)
+
+    Une los np.unique de cada bloque, así que la memoria depende del bloque y
+    del número de SMU distintos, no del tamaño del raster.
+    """
+    ids = np.empty(0, dtype=np.int64)
+    for _, _, bloque in raster.bloques(filas_por_bloque):
+        ids = np.union1d(ids, np.unique(bloque[raster.validos(bloque)]).astype(np.int64))
+    return ids
+
+# ============================================================================
+# SECCIÓN 2: ÍNDICE DENSO ID → FILA
+# ============================================================================
+
+class IndiceDenso:
+    """
+    Traduce HWSD2_SMU_ID a posiciones de una tabla con un arreglo denso
+
+    posiciones[id] es la fila del SMU en la tabla (ids en el orden dado), o
+    len(ids) si el SMU no tiene registros: esa última posición de cada
+    tabla de valores guarda el nodata.
+    """
+
+    def __init__(self, ids):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        tamano = int(self.ids.max()) + 1 if len(self.ids) else 0
+        self.ausente = len(self.ids)
+        self.posiciones = np.full(tamano, self.ausente, dtype=np.int64)
+        self.posiciones[self.ids] = np.arange(len(self.ids))
+
+    def __call__(self, bloque, validos):
+        """Fila de cada píxel de un bloque del raster (ausente fuera del índice)"""
+        codigos = bloque.astype(np.int64, copy=False)
+        dentro = validos & (codigos >= 0) & (codigos < len(self.posiciones))
+        filas = np.full(bloque.shape, self.ausente, dtype=np.int64)
+        filas[dentro] = self.posiciones[codigos[dentro]]
+        return filas
+
+def construir_leyendas(df_multicapa):
+    """
+    Código entero de cada valor de las variables de texto
+
+    Retorna dict variable → lista de valores; el código de un valor es su
+    posición + 1 (0 queda reservado para sin dato).
+    """
+    leyendas = {}
+    for variable in VARIABLES_CATEGORICAS:
+        valores = df_multicapa[variable].dropna().astype(str).unique()
+        leyendas[variable] = sorted(valores)
+    return leyendas
+
+def tablas_valores(df_pyaez, indice, variables, leyendas):
+    """
+    Tablas de valores de una capa alineadas con indice (más la fila nodata)
+
+    Retorna dict variable → ndarray de longitud len(indice.ids) + 1
+    """
+    filas = pd.Index(df_pyaez['CODE']).get_indexer(indice.ids)
+    presentes = filas >= 0
+
+    tablas = {}
+    for variable in variables:
+        tipo = _tipo_variable(variable)
+        valores = np.full(len(indice.ids) + 1, NODATA_GRILLA[tipo], dtype=_tipo_grilla(variable, leyendas))
+        columna = df_pyaez[variable].to_numpy()[filas[presentes]]
+        if tipo == 'categorica':
+            codigos = {valor: codigo for codigo, valor in enumerate(leyendas[variable], start=1)}
+            columna = pd.Series(columna).astype(str).map(codigos).fillna(0).to_numpy()
+        valores[:-1][presentes] = columna
+        tablas[variable] = valores
+    return tablas
+
+# ============================================================================
+# SECCIÓN 3: GRILLAS MAPEADAS EN MEMORIA
+# ============================================================================
+
+def rasterizar_pyaez(raster, db, directorio, capas=None, variables=None, nodata=None, motor='pandas',
+                     cache=None, filas_por_bloque=FILAS_POR_BLOQUE, verbose=True):
+    """
+    Genera grillas PyAEZ por capa y variable a partir del raster de SMU
+
+    Parámetros:
+    - raster: Ruta al raster de HWSD2_SMU_ID (.npy o GeoTIFF) o RasterSMU abierto
+    - db: Ruta a HWSD2.db o conexión sqlite3 abierta
+    - directorio: Carpeta de salida (una subcarpeta por capa)
+    - capas: Capas a generar (por defecto CAPAS, D1-D7)
+    - variables: Variables PyAEZ a generar (por defecto las 18 salvo CODE/LAYER)
+    - nodata: Valor sin SMU del raster (por defecto el del GeoTIFF)
+    - motor, cache: Ver extractor.extraer_pyaez
+    - filas_por_bloque: Filas del raster procesadas a la vez (memoria acotada)
+
+    Retorna:
+    - dict de metadatos (también guardado en metadatos.json)
+    """
+    capas = extractor.CAPAS if capas is None else list(capas)
+    variables = [v for v in extractor.COLUMNAS_PYAEZ if v not in ('CODE', 'LAYER')] \
+        if variables is None else list(variables)
+    directorio = Path(directorio)
+
+    raster = RasterSMU(raster, nodata) if not isinstance(raster, RasterSMU) else raster
+    try:
+        ids = descubrir_ids(raster, filas_por_bloque)
+        if verbose:
+            print(f"✓ Raster {raster.forma[0]}x{raster.forma[1]}: {len(ids)} HWSD2_SMU_ID distintos")
+
+        resultados = extractor.extraer_pyaez(db, ids.tolist(), capas, motor=motor, cache=cache,
+                                             verbose=False)
+        capas = [capa for capa in capas if capa in resultados]
+        resultados = {capa: extractor.exportar_pyaez(df) for capa, df in resultados.items()}
+        if not capas:
+            raise ValueError("Ningún SMU del raster tiene datos válidos en las capas solicitadas")
+
+        indice = IndiceDenso(ids)
+        leyendas = construir_leyendas(extractor.combinar_capas(resultados))
+        tablas = {capa: tablas_valores(resultados[capa], indice, variables, leyendas) for capa in capas}
+
+        grillas = {}
+        for capa in capas:
+            (directorio / capa).mkdir(parents=True, exist_ok=True)
+            for variable in variables:
+                grillas[capa, variable] = np.lib.format.open_memmap(
+                    directorio / capa / f"{variable}.npy", mode='w+',
+                    dtype=_tipo_grilla(variable, leyendas), shape=raster.forma)
+
+        for inicio, fin, bloque in raster.bloques(filas_por_bloque):
+            filas = indice(bloque, raster.validos(bloque))
+            for (capa, variable), grilla in grillas.items():
+                grilla[inicio:fin] = tablas[capa][variable][filas]
+
+        for grilla in grillas.values():
+            grilla.flush()
+        del grillas
+    finally:
+        raster.cerrar()
+
+    metadatos = {
+        'forma': list(raster.forma),
+        'capas': capas,
+        'variables': {variable: _tipo_variable(variable) for variable in variables},
+        'nodata': {tipo: None if tipo == 'real' else valor for tipo, valor in NODATA_GRILLA.items()},
+        'leyendas': {v: l for v, l in leyendas.items() if v in variables},
+        'smu': len(ids),
+        'perfil': raster.perfil,
+    }
+    with open(directorio / METADATOS, 'w', encoding='utf-8') as f:
+        json.dump(metadatos, f, indent=2, ensure_ascii=False)
+
+    if verbose:
+        print(f"✓ Guardado: {directorio} ({len(capas)} capas x {len(variables)} variables)")
+    return metadatos
+
+def leer_grilla(directorio, capa, variable, decodificar=False):
+    """
+    Abre una grilla generada por rasterizar_pyaez (mapeada en memoria, solo lectura)
+
+    Con decodificar=True, las variables de texto se devuelven como arreglo
+    de objetos con el valor de la leyenda (None = sin dato); esto sí carga la
+    grilla completa en memoria.
+    """
+    directorio = Path(directorio)
+    grilla = np.load(directorio / capa / f"{variable}.npy", mmap_mode='r')
+    if not decodificar or variable not in VARIABLES_CATEGORICAS:
+        return grilla
+
+    with open(directorio / METADATOS, encoding='utf-8') as f:
+        leyenda = json.load(f)['leyendas'][variable]
+    return np.array([None] + leyenda, dtype=object)[grilla]
+
+# ============================================================================
+# LÍNEA DE COMANDOS
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Genera grillas de suelo PyAEZ (.npy por capa y variable) desde el raster de SMU de HWSD2")
+    parser.add_argument('raster', help="Raster de HWSD2_SMU_ID (.npy o GeoTIFF; GeoTIFF requiere rasterio)")
+    parser.add_argument('--db', default='HWSD2.db', help="Base de datos SQLite HWSD v2.0 (por defecto: HWSD2.db)")
+    parser.add_argument('--salida', default='grillas_pyaez', help="Carpeta de salida (por defecto: grillas_pyaez)")
+    parser.add_argument('--capas', nargs='+', default=extractor.CAPAS, choices=extractor.CAPAS)
+    parser.add_argument('--variables', nargs='+', help="Variables PyAEZ a generar (por defecto: todas)")
+    parser.add_argument('--nodata', type=float, help="Valor sin SMU del raster (por defecto: el del GeoTIFF)")
+    parser.add_argument('--motor', default='pandas', choices=extractor.MOTORES)
+    parser.add_argument('--cache', metavar='DIR', help="Carpeta de caché persistente (ver eswatini_pyaez_suelos.py)")
+    parser.add_argument('--bloque', type=int, default=FILAS_POR_BLOQUE, metavar='FILAS',
+                        help=f"Filas del raster por bloque (por defecto: {FILAS_POR_BLOQUE})")
+    parser.add_argument('--silencioso', action='store_true')
+    args = parser.parse_args(argv)
+
+    cache = extractor.CachePyAEZ(args.cache, args.db, motor=args.motor) if args.cache else None
+    try:
+        rasterizar_pyaez(args.raster, args.db, args.salida, args.capas, args.variables, args.nodata,
+                         motor=args.motor, cache=cache, filas_por_bloque=args.bloque,
+                         verbose=not args.silencioso)
+    except ValueError as error:
+        parser.error(str(error))
+    finally:
+        if cache is not None:
+            cache.cerrar()
+
+
+if __name__ == '__main__':
+    main()
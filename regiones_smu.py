@@ -0,0 +1,349 @@
+"""
+RESOLUCIÓN DE REGIONES: HWSD2_SMU_ID POR BBOX, POLÍGONO O VENTANA DE PÍXELES
+============================================================================
+
+Reemplaza las listas de IDs mantenidas a mano (como IDS_ESWATINI) y las
+consultas SQL manuales: dada un área de interés sobre el raster de SMU de
+HWSD2, devuelve los HWSD2_SMU_ID que contiene.
+
+El raster se indexa una sola vez en teselas de N×N píxeles, guardando los
+IDs distintos de cada tesela (índice CSR: desplazamientos + ids). Una
+consulta une los IDs de las teselas completamente cubiertas sin leer el
+raster, y solo lee los píxeles de las teselas del borde, así que resolver
+una región toma milisegundos.
+
+USO:
+----
+    python regiones_smu.py indexar HWSD2.tif --salida indice_smu.npz
+    python regiones_smu.py resolver indice_smu.npz areas.json --salida regiones.json
+    python eswatini_pyaez_suelos.py --regiones regiones.json --salida salidas/
+
+areas.json: {nombre: {"bbox": [xmin, ymin, xmax, ymax]}
+                   | {"poligono": [[x, y], ...]}  (o geometría GeoJSON Polygon/MultiPolygon)
+                   | {"ventana": [fila_inicio, fila_fin, col_inicio, col_fin]}}
+"""
+
+import argparse
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+
+import eswatini_pyaez_suelos as extractor
+from raster_pyaez import RasterSMU
+
+# Lado de las teselas del índice (píxeles)
+TAMANO_TESELA = 256
+
+# ============================================================================
+# SECCIÓN 1: ÍNDICE DE IDS POR TESELA
+# ============================================================================
+
+class IndiceRegiones:
+    """
+    Índice espacial de HWSD2_SMU_ID por tesela del raster de SMU
+
+    Parámetros:
+    - forma: (filas, columnas) del raster
+    - tamano_tesela: Lado de las teselas en píxeles
+    - desplazamientos: ids de la tesela k = ids[desplazamientos[k]:desplazamientos[k + 1]]
+      (teselas numeradas por filas)
+    - ids: IDs distintos de cada tesela, concatenados y ordenados por tesela
+    - transform: Geotransformación (a, b, c, d, e, f) de rasterio/GDAL:
+      x = a·col + b·fila + c, y = d·col + e·fila + f (None = solo píxeles)
+    - raster: Ruta del raster indexado, leído para las teselas del borde
+    - nodata: Valor sin SMU del raster
+    """
+
+    def __init__(self, forma, tamano_tesela, desplazamientos, ids, transform=None, raster=None, nodata=None):
+        self.forma = tuple(int(n) for n in forma)
+        self.tamano_tesela = int(tamano_tesela)
+        self.teselas = (math.ceil(self.forma[0] / self.tamano_tesela),
+                        math.ceil(self.forma[1] / self.tamano_tesela))
+        self.desplazamientos = np.asarray(desplazamientos, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.transform = None if transform is None else tuple(float(v) for v in transform)
+        self.raster = None if raster is None else Path(raster)
+        self.nodata = nodata
+        self._lector = None
+
+    @classmethod
+    def construir(cls, raster, tamano_tesela=TAMANO_TESELA, transform=None, nodata=None):
+        """
+        Indexa un raster de SMU (.npy o GeoTIFF), una franja de teselas a la vez
+
+        transform: Geotransformación del raster (por defecto la del GeoTIFF;
+        necesaria para consultas por bbox/polígono sobre un .npy)
+        """
+        lector = RasterSMU(raster, nodata) if not isinstance(raster, RasterSMU) else raster
+        try:
+            if transform is None and lector.perfil is not None:
+                transform = lector.perfil['transform']
+
+            conteos = []
+            partes = []
+            for _, _, franja in lector.bloques(tamano_tesela):
+                validos = lector.validos(franja)
+                for inicio in range(0, lector.forma[1], tamano_tesela):
+                    columnas = slice(inicio, inicio + tamano_tesela)
+                    ids = np.unique(franja[:, columnas][validos[:, columnas]]).astype(np.int64)
+                    conteos.append(len(ids))
+                    partes.append(ids)
+        finally:
+            lector.cerrar()
+
+        desplazamientos = np.concatenate([[0], np.cumsum(conteos)])
+        ids = np.concatenate(partes) if partes else np.empty(0, dtype=np.int64)
+        return cls(lector.forma, tamano_tesela, desplazamientos, ids, transform, lector.ruta, lector.nodata)
+
+    def guardar(self, ruta):
+        np.savez(
+            ruta,
+            forma=np.array(self.forma),
+            tamano_tesela=self.tamano_tesela,
+            desplazamientos=self.desplazamientos,
+            ids=self.ids,
+            transform=np.array(self.transform if self.transform is not None else [], dtype=float),
+            raster=str(self.raster.resolve()) if self.raster is not None else '',
+            nodata=np.array([] if self.nodata is None else [self.nodata], dtype=float),
+        )
+
+    @classmethod
+    def cargar(cls, ruta, raster=None):
+        """Carga un índice guardado; raster reemplaza la ruta del raster indexado"""
+        with np.load(ruta) as datos:
+            transform = datos['transform'].tolist() or None
+            nodata = datos['nodata'].tolist()
+            return cls(datos['forma'], int(datos['tamano_tesela']), datos['desplazamientos'], datos['ids'],
+                       transform, raster or (str(datos['raster']) or None), nodata[0] if nodata else None)
+
+    def ids_tesela(self, fila_tesela, col_tesela):
+        k = fila_tesela * self.teselas[1] + col_tesela
+        return self.ids[self.desplazamientos[k]:self.desplazamientos[k + 1]]
+
+    def todos(self):
+        """Todos los HWSD2_SMU_ID del raster"""
+        return np.unique(self.ids)
+
+    def _leer(self, fila_inicio, fila_fin, col_inicio, col_fin):
+        if self.raster is None:
+            raise ValueError("El índice no conoce el raster: use exacto=False o IndiceRegiones.cargar(..., raster=)")
+        if self._lector is None:
+            self._lector = RasterSMU(self.raster, self.nodata)
+        bloque = self._lector.bloque(fila_inicio, fila_fin, (col_inicio, col_fin))
+        return bloque, self._lector.validos(bloque)
+
+    def cerrar(self):
+        if self._lector is not None:
+            self._lector.cerrar()
+            self._lector = None
+
+    # ========================================================================
+    # CONSULTAS
+    # ========================================================================
+
+    def _rango_teselas(self, fila_inicio, fila_fin, col_inicio, col_fin):
+        t = self.tamano_tesela
+        for fila_t in range(fila_inicio // t, (fila_fin - 1) // t + 1):
+            for col_t in range(col_inicio // t, (col_fin - 1) // t + 1):
+                yield fila_t, col_t, (fila_t * t, min((fila_t + 1) * t, self.forma[0]),
+                                      col_t * t, min((col_t + 1) * t, self.forma[1]))
+
+    def _recortar(self, fila_inicio, fila_fin, col_inicio, col_fin):
+        return (max(int(fila_inicio), 0), min(int(fila_fin), self.forma[0]),
+                max(int(col_inicio), 0), min(int(col_fin), self.forma[1]))
+
+    def por_ventana(self, fila_inicio, fila_fin, col_inicio, col_fin, exacto=True):
+        """
+        IDs dentro de la ventana de píxeles [fila_inicio, fila_fin) × [col_inicio, col_fin)
+
+        Con exacto=False no se lee el raster: las teselas del borde aportan
+        todos sus IDs (superconjunto de la respuesta exacta).
+        """
+        f0, f1, c0, c1 = self._recortar(fila_inicio, fila_fin, col_inicio, col_fin)
+        if f0 >= f1 or c0 >= c1:
+            return np.empty(0, dtype=np.int64)
+
+        partes = []
+        for fila_t, col_t, (tf0, tf1, tc0, tc1) in self._rango_teselas(f0, f1, c0, c1):
+            cubierta = f0 <= tf0 and tf1 <= f1 and c0 <= tc0 and tc1 <= c1
+            if cubierta or not exacto:
+                partes.append(self.ids_tesela(fila_t, col_t))
+            else:
+                bloque, validos = self._leer(max(f0, tf0), min(f1, tf1), max(c0, tc0), min(c1, tc1))
+                partes.append(bloque[validos].astype(np.int64))
+        return np.unique(np.concatenate(partes))
+
+    def por_mascara(self, mascara, fila_inicio=0, col_inicio=0):
+        """
+        IDs de los píxeles donde mascara es True
+
+        mascara: Arreglo booleano alineado con el raster a partir de
+        (fila_inicio, col_inicio). Las teselas completamente dentro de la
+        máscara se resuelven con el índice; solo se lee el raster en las
+        teselas parcialmente cubiertas.
+        """
+        mascara = np.asarray(mascara, dtype=bool)
+        f0, f1, c0, c1 = self._recortar(fila_inicio, fila_inicio + mascara.shape[0],
+                                        col_inicio, col_inicio + mascara.shape[1])
+        mascara = mascara[f0 - fila_inicio:f1 - fila_inicio, c0 - col_inicio:c1 - col_inicio]
+        if not mascara.any():
+            return np.empty(0, dtype=np.int64)
+
+        partes = []
+        for fila_t, col_t, (tf0, tf1, tc0, tc1) in self._rango_teselas(f0, f1, c0, c1):
+            sub = mascara[max(f0, tf0) - f0:min(f1, tf1) - f0, max(c0, tc0) - c0:min(c1, tc1) - c0]
+            if not sub.any():
+                continue
+            if sub.shape == (tf1 - tf0, tc1 - tc0) and sub.all():
+                partes.append(self.ids_tesela(fila_t, col_t))
+            else:
+                bloque, validos = self._leer(max(f0, tf0), min(f1, tf1), max(c0, tc0), min(c1, tc1))
+                partes.append(bloque[validos & sub].astype(np.int64))
+        return np.unique(np.concatenate(partes)) if partes else np.empty(0, dtype=np.int64)
+
+    def _a_pixeles(self, x, y):
+        """Coordenadas → (fila, columna) fraccionarias (sin rotación)"""
+        if self.transform is None:
+            raise ValueError("El índice no tiene geotransformación: use por_ventana o construir(..., transform=)")
+        a, b, c, d, e, f = self.transform
+        if b != 0 or d != 0:
+            raise ValueError("Rasters rotados no soportados")
+        return (np.asarray(y, dtype=float) - f) / e, (np.asarray(x, dtype=float) - c) / a
+
+    def por_bbox(self, xmin, ymin, xmax, ymax, exacto=True):
+        """IDs de los píxeles cuyo centro cae dentro del rectángulo (en coordenadas del raster)"""
+        filas, cols = self._a_pixeles([xmin, xmax], [ymin, ymax])
+        return self.por_ventana(math.ceil(min(filas) - 0.5), math.floor(max(filas) - 0.5) + 1,
+                                math.ceil(min(cols) - 0.5), math.floor(max(cols) - 0.5) + 1, exacto)
+
+    def por_poligono(self, poligono):
+        """
+        IDs de los píxeles cuyo centro cae dentro del polígono
+
+        poligono: Lista de vértices [[x, y], ...] o geometría GeoJSON
+        (Polygon o MultiPolygon, con huecos) en coordenadas del raster.
+        """
+        anillos = _anillos(poligono)
+        filas, cols = self._a_pixeles(*np.concatenate(anillos).T)
+        f0, f1, c0, c1 = self._recortar(math.floor(filas.min()), math.ceil(filas.max()) + 1,
+                                        math.floor(cols.min()), math.ceil(cols.max()) + 1)
+        if f0 >= f1 or c0 >= c1:
+            return np.empty(0, dtype=np.int64)
+
+        anillos_pixel = [np.column_stack(self._a_pixeles(*anillo.T)) for anillo in anillos]
+        centros_f = np.arange(f0, f1)[:, None] + 0.5
+        centros_c = np.arange(c0, c1)[None, :] + 0.5
+        mascara = np.zeros((f1 - f0, c1 - c0), dtype=bool)
+        for anillo in anillos_pixel:
+            mascara ^= _dentro_anillo(anillo, centros_f, centros_c)
+        return self.por_mascara(mascara, f0, c0)
+
+def _anillos(poligono):
+    """Anillos de un polígono como arreglos (n, 2) de coordenadas x, y"""
+    if isinstance(poligono, dict):
+        if poligono.get('type') == 'Polygon':
+            return [np.asarray(anillo, dtype=float) for anillo in poligono['coordinates']]
+        if poligono.get('type') == 'MultiPolygon':
+            return [np.asarray(anillo, dtype=float) for parte in poligono['coordinates'] for anillo in parte]
+        raise ValueError(f"Geometría no soportada: {poligono.get('type')!r}")
+    return [np.asarray(poligono, dtype=float)]
+
+def _dentro_anillo(anillo, filas, columnas):
+    """Regla par-impar (ray casting) vectorizada sobre una grilla de centros de píxel"""
+    dentro = np.zeros(np.broadcast_shapes(filas.shape, columnas.shape), dtype=bool)
+    for (f_a, c_a), (f_b, c_b) in zip(anillo, np.roll(anillo, -1, axis=0)):
+        if f_a == f_b:
+            continue
+        cruza = (f_a > filas) != (f_b > filas)
+        corte = c_a + (filas - f_a) * (c_b - c_a) / (f_b - f_a)
+        dentro ^= cruza & (columnas < corte)
+    return dentro
+
+# ============================================================================
+# SECCIÓN 2: RESOLUCIÓN DE VARIAS REGIONES
+# ============================================================================
+
+def resolver_region(indice, bbox=None, poligono=None, ventana=None):
+    """
+    HWSD2_SMU_ID de una región (lista lista para extraer_pyaez)
+
+    Exactamente uno de: bbox [xmin, ymin, xmax, ymax], poligono (ver
+    IndiceRegiones.por_poligono) o ventana [fila_inicio, fila_fin, col_inicio, col_fin].
+    """
+    if sum(v is not None for v in (bbox, poligono, ventana)) != 1:
+        raise ValueError("Indique exactamente uno de bbox, poligono o ventana")
+    if bbox is not None:
+        ids = indice.por_bbox(*bbox)
+    elif poligono is not None:
+        ids = indice.por_poligono(poligono)
+    else:
+        ids = indice.por_ventana(*ventana)
+    return ids.tolist()
+
+def resolver_regiones(indice, areas):
+    """
+    Resuelve varias áreas de interés
+
+    Parámetros:
+    - areas: dict nombre → {'bbox': ...} | {'poligono': ...} | {'ventana': ...}
+
+    Retorna:
+    - dict nombre → lista de HWSD2_SMU_ID (formato de extractor.extraer_regiones)
+    """
+    return {nombre: resolver_region(indice, **area) for nombre, area in areas.items()}
+
+# ============================================================================
+# LÍNEA DE COMANDOS
+# ============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resuelve HWSD2_SMU_ID por bbox, polígono o ventana de píxeles")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    indexar = subparsers.add_parser('indexar', help="Construye el índice por teselas del raster de SMU")
+    indexar.add_argument('raster', help="Raster de HWSD2_SMU_ID (.npy o GeoTIFF; GeoTIFF requiere rasterio)")
+    indexar.add_argument('--salida', default='indice_smu.npz', help="Archivo del índice (por defecto: indice_smu.npz)")
+    indexar.add_argument('--tesela', type=int, default=TAMANO_TESELA, help="Lado de las teselas en píxeles")
+    indexar.add_argument('--nodata', type=float, help="Valor sin SMU (por defecto: el del GeoTIFF)")
+    indexar.add_argument('--transform', type=float, nargs=6, metavar=('A', 'B', 'C', 'D', 'E', 'F'),
+                         help="Geotransformación de un .npy (x = A·col + B·fila + C, y = D·col + E·fila + F)")
+
+    resolver = subparsers.add_parser('resolver', help="Resuelve las áreas de un JSON a listas de HWSD2_SMU_ID")
+    resolver.add_argument('indice', help="Índice generado con 'indexar'")
+    resolver.add_argument('areas', help="JSON {nombre: {bbox|poligono|ventana: ...}}")
+    resolver.add_argument('--salida', default='regiones.json',
+                          help="JSON {nombre: [HWSD2_SMU_ID, ...]} para eswatini_pyaez_suelos.py --regiones")
+    resolver.add_argument('--raster', help="Ruta actual del raster indexado (si se movió)")
+    resolver.add_argument('--db', help="Extrae además las regiones de esta base HWSD2 (ver --regiones)")
+    resolver.add_argument('--directorio', default='.', help="Carpeta de salida de la extracción con --db")
+    resolver.add_argument('--formato', default='excel', choices=extractor.FORMATOS_SALIDA)
+    args = parser.parse_args(argv)
+
+    if args.comando == 'indexar':
+        indice = IndiceRegiones.construir(args.raster, args.tesela, args.transform, args.nodata)
+        indice.guardar(args.salida)
+        print(f"✓ {args.salida}: {indice.teselas[0]}x{indice.teselas[1]} teselas, "
+              f"{len(indice.todos())} HWSD2_SMU_ID distintos")
+        return
+
+    with open(args.areas, encoding='utf-8') as f:
+        areas = json.load(f)
+    indice = IndiceRegiones.cargar(args.indice, args.raster)
+    try:
+        regiones = resolver_regiones(indice, areas)
+    finally:
+        indice.cerrar()
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(regiones, f, indent=2)
+    for nombre, smu_ids in regiones.items():
+        print(f"✓ {nombre}: {len(smu_ids)} HWSD2_SMU_ID")
+
+    if args.db is not None:
+        extractor.extraer_regiones(args.db, regiones, args.directorio, formato=args.formato, verbose=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Fixtures comunes: bases HWSD2 sintéticas generadas con benchmark_hwsd2
+
+Las bases se generan una vez por sesión en un directorio temporal; las
+pruebas que modifican una base trabajan sobre una copia.
+"""
+
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import benchmark_hwsd2  # noqa: E402
+import eswatini_pyaez_suelos as extractor  # noqa: E402
+
+# Tamaño de las bases de prueba: suficiente para varios bloques y regiones
+N_SMU = 400
+
+
+@pytest.fixture(scope='session')
+def bd_sintetica(tmp_path_factory):
+    """Ruta de una base sintética sin índices (como un HWSD2.db recién descargado)"""
+    ruta = tmp_path_factory.mktemp('hwsd2') / 'HWSD2.db'
+    benchmark_hwsd2.generar_bd_sintetica(ruta, N_SMU, semilla=1)
+    return ruta
+
+
+@pytest.fixture(scope='session')
+def bd_preparada(bd_sintetica, tmp_path_factory):
+    """Copia de bd_sintetica con los índices de preparar_bd"""
+    ruta = tmp_path_factory.mktemp('hwsd2_preparada') / 'HWSD2.db'
+    shutil.copy(bd_sintetica, ruta)
+    extractor.preparar_bd(ruta, verbose=False)
+    return ruta
+
+
+@pytest.fixture(scope='session')
+def smu_ids(bd_sintetica):
+    """Subconjunto de SMU de la base sintética (uno de cada tres)"""
+    return list(range(1, N_SMU + 1, 3))
@@ -0,0 +1,144 @@
+"""
+Caché persistente (CachePyAEZ): mismas salidas en frío, en caliente y sin caché; claves por base, reglas y motor
+"""
+
+import os
+import shutil
+
+import pandas.testing as pdt
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+
+ID_SIN_REGISTROS = 999999999
+
+
+def _exportado(resultados):
+    df = extractor.exportar_pyaez(extractor.combinar_capas(resultados)).astype({'LAYER': str})
+    return df.sort_values(['LAYER', 'CODE'], kind='mergesort').reset_index(drop=True)
+
+
+def test_frio_caliente_y_directo(bd_sintetica, smu_ids, tmp_path):
+    ids = smu_ids[:80] + [ID_SIN_REGISTROS]
+    directo = _exportado(extractor.extraer_pyaez(bd_sintetica, ids))
+    cache = extractor.CachePyAEZ(tmp_path / 'cache', bd_sintetica)
+    try:
+        # En frío con la mitad de los SMU, luego todos (mitad en caché)
+        extractor.extraer_pyaez(bd_sintetica, ids[:40], cache=cache)
+        assert cache.obtener(ids, extractor.CAPAS)[1] == ids[40:]
+        parcial = _exportado(extractor.extraer_pyaez(bd_sintetica, ids, cache=cache))
+
+        # En caliente no se abre la base: todos los SMU (también el que no
+        # tiene registros) están en caché
+        _, faltantes = cache.obtener(ids, extractor.CAPAS)
+        assert faltantes == []
+        caliente = _exportado(extractor.extraer_pyaez(tmp_path / 'no_existe.db', ids, cache=cache))
+    finally:
+        cache.cerrar()
+
+    pdt.assert_frame_equal(parcial, directo)
+    pdt.assert_frame_equal(caliente, directo)
+
+
+def test_capas_no_procesadas(bd_sintetica, smu_ids, tmp_path):
+    cache = extractor.CachePyAEZ(tmp_path / 'cache', bd_sintetica)
+    try:
+        extractor.extraer_pyaez(bd_sintetica, smu_ids[:10], ['D1', 'D2'], cache=cache)
+
+        assert cache.obtener(smu_ids[:10], ['D1'])[1] == []
+        assert cache.obtener(smu_ids[:10], ['D1', 'D3'])[1] == smu_ids[:10]
+        pdt.assert_frame_equal(_exportado(extractor.extraer_pyaez(bd_sintetica, smu_ids[:10], ['D1', 'D3'],
+                                                                   cache=cache)),
+                               _exportado(extractor.extraer_pyaez(bd_sintetica, smu_ids[:10], ['D1', 'D3'])))
+    finally:
+        cache.cerrar()
+
+
+def _cache_llena(directorio, db_path, smu_ids, motor='pandas'):
+    cache = extractor.CachePyAEZ(directorio, db_path, motor=motor)
+    extractor.extraer_pyaez(db_path, smu_ids, motor=motor, cache=cache)
+    return cache
+
+
+def test_cambio_de_reglas_invalida(bd_sintetica, smu_ids, tmp_path, monkeypatch):
+    cache = _cache_llena(tmp_path, bd_sintetica, smu_ids[:10])
+    cache.cerrar()
+
+    monkeypatch.setitem(extractor.OSD_RANGOS, 5, 45)
+    nueva = extractor.CachePyAEZ(tmp_path, bd_sintetica)
+    try:
+        assert nueva.ruta != cache.ruta
+        assert nueva.obtener(smu_ids[:10], extractor.CAPAS)[1] == smu_ids[:10]
+    finally:
+        nueva.cerrar()
+
+    # Con las reglas originales se vuelve a la caché anterior
+    monkeypatch.undo()
+    anterior = extractor.CachePyAEZ(tmp_path, bd_sintetica)
+    try:
+        assert anterior.ruta == cache.ruta
+        assert anterior.obtener(smu_ids[:10], extractor.CAPAS)[1] == []
+    finally:
+        anterior.cerrar()
+
+
+def test_cambio_de_base_invalida(bd_sintetica, smu_ids, tmp_path):
+    copia = tmp_path / 'HWSD2.db'
+    shutil.copy(bd_sintetica, copia)
+    cache = _cache_llena(tmp_path / 'cache', copia, smu_ids[:10])
+    cache.cerrar()
+
+    info = copia.stat()
+    os.utime(copia, ns=(info.st_atime_ns, info.st_mtime_ns + 10**9))
+    nueva = extractor.CachePyAEZ(tmp_path / 'cache', copia)
+    try:
+        assert nueva.ruta != cache.ruta
+        assert nueva.obtener(smu_ids[:10], extractor.CAPAS)[1] == smu_ids[:10]
+    finally:
+        nueva.cerrar()
+
+
+def test_caches_por_motor(bd_sintetica, smu_ids, tmp_path):
+    pandas = _cache_llena(tmp_path, bd_sintetica, smu_ids[:10])
+    sql = extractor.CachePyAEZ(tmp_path, bd_sintetica, motor='sql')
+    try:
+        assert sql.ruta != pandas.ruta
+        assert sql.obtener(smu_ids[:10], extractor.CAPAS)[1] == smu_ids[:10]
+
+        # Una caché no se usa con el otro motor
+        with pytest.raises(ValueError, match='motor'):
+            extractor.extraer_pyaez(bd_sintetica, smu_ids[:10], motor='sql', cache=pandas)
+        with pytest.raises(ValueError, match='motor'):
+            extractor.extraer_pyaez(bd_sintetica, smu_ids[:10], cache=sql)
+        with pytest.raises(ValueError, match='Motor desconocido'):
+            extractor.CachePyAEZ(tmp_path, bd_sintetica, motor='duckdb')
+    finally:
+        pandas.cerrar()
+        sql.cerrar()
+
+
+def test_reglas_no_se_combinan_con_cache(bd_sintetica, smu_ids, tmp_path):
+    cache = extractor.CachePyAEZ(tmp_path, bd_sintetica)
+    try:
+        with pytest.raises(ValueError, match='reglas'):
+            extractor.extraer_pyaez(bd_sintetica, smu_ids[:10], cache=cache,
+                                    reglas=extractor.configurar_reglas({'pH_rango': 'reportar'}))
+    finally:
+        cache.cerrar()
+
+
+def test_lectura_no_retiene_el_bloqueo(bd_sintetica, smu_ids, tmp_path):
+    # Dos procesos de extraer_regiones comparten el archivo de caché: después
+    # de obtener(), el lector no debe impedir que el otro guarde
+    lector = _cache_llena(tmp_path, bd_sintetica, smu_ids[:10])
+    escritor = extractor.CachePyAEZ(tmp_path, bd_sintetica)
+    escritor._conn.execute("PRAGMA busy_timeout = 100")
+    try:
+        lector.obtener(smu_ids[:20], extractor.CAPAS)
+        assert not lector._conn.in_transaction
+
+        extractor.extraer_pyaez(bd_sintetica, smu_ids[10:20], cache=escritor)
+        assert lector.obtener(smu_ids[:20], extractor.CAPAS)[1] == []
+    finally:
+        lector.cerrar()
+        escritor.cerrar()
@@ -0,0 +1,41 @@
+"""
+Líneas de comandos: IDs sin registros válidos terminan con un error de uso, sin traza
+"""
+
+import pytest
+
+import almacen_pyaez
+import eswatini_pyaez_suelos as extractor
+import intervalos_pyaez
+
+ID_INEXISTENTE = '999999999'
+
+
+def _error_de_uso(main, argv, capsys):
+    with pytest.raises(SystemExit) as salida:
+        main(argv)
+    assert salida.value.code == 2
+    error = capsys.readouterr().err
+    assert 'error:' in error and 'Traceback' not in error
+    return error
+
+
+def test_extractor_sin_registros(bd_sintetica, tmp_path, capsys):
+    error = _error_de_uso(extractor.main, ['--db', str(bd_sintetica), '--ids', ID_INEXISTENTE,
+                                           '--salida', str(tmp_path / 'pyaez.parquet'), '--silencioso'], capsys)
+
+    assert 'No hay datos válidos' in error
+    assert not (tmp_path / 'pyaez.parquet').exists()
+
+
+def test_intervalos_sin_registros(bd_sintetica, tmp_path, capsys):
+    _error_de_uso(intervalos_pyaez.main, ['--db', str(bd_sintetica), '--ids', ID_INEXISTENTE, '--intervalos', '0-30',
+                                          '--salida', str(tmp_path / 'intervalos.parquet'), '--silencioso'], capsys)
+
+
+def test_almacen_sin_registros(bd_sintetica, smu_ids, tmp_path, capsys):
+    almacen_pyaez.construir_almacen(bd_sintetica, tmp_path / 'almacen', smu_ids[:10], verbose=False)
+
+    error = _error_de_uso(almacen_pyaez.main, [str(tmp_path / 'almacen'), '--ids', ID_INEXISTENTE], capsys)
+
+    assert 'no tiene registros' in error
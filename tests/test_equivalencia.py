@@ -0,0 +1,194 @@
+"""
+Equivalencia de las rutas de extracción con extraer_pyaez (motor 'pandas')
+
+Cada ruta se compara con la salida final ya formateada (exportar_pyaez),
+que es la que se escribe en los archivos.
+"""
+
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+import almacen_pyaez
+import diferencial_pyaez
+import eswatini_pyaez_suelos as extractor
+
+# Filas por bloque de las pruebas: varios bloques con N_SMU = 400
+TAMANO_BLOQUE = 300
+
+
+def _comparable(df_multicapa):
+    """Salida PyAEZ multicapa exportada, ordenada por LAYER y CODE"""
+    df = extractor.exportar_pyaez(extractor.tipar_pyaez(df_multicapa)).astype({'LAYER': str})
+    return df.sort_values(['LAYER', 'CODE'], kind='mergesort').reset_index(drop=True)
+
+
+def _extraer(db, smu_ids):
+    return _comparable(extractor.combinar_capas(extractor.extraer_pyaez(db, smu_ids)))
+
+
+@pytest.fixture(scope='module')
+def referencia(bd_sintetica, smu_ids):
+    return _extraer(bd_sintetica, smu_ids)
+
+
+def _consolidar_por_capa(df_valid):
+    """Consolidación original: un groupby por capa con la moda como lambda"""
+    def moda_o_primero(series):
+        moda = series.mode()
+        return moda[0] if len(moda) > 0 else series.iloc[0]
+
+    agregaciones = {columna: 'mean' for columna in extractor.COLUMNAS_PROMEDIO}
+    agregaciones.update({columna: moda_o_primero for columna in extractor.COLUMNAS_MODA})
+    partes = []
+    for capa in extractor.CAPAS:
+        df_capa = df_valid[df_valid['LAYER'] == capa]
+        if len(df_capa):
+            partes.append(df_capa.groupby('HWSD2_SMU_ID').agg(agregaciones).reset_index().assign(LAYER=capa))
+    return pd.concat(partes, ignore_index=True)
+
+
+def test_consolidacion_una_pasada_igual_a_por_capa(bd_sintetica, smu_ids):
+    conn = extractor.conectar_solo_lectura(bd_sintetica)
+    try:
+        df_all = extractor.obtener_capas(conn, smu_ids, verbose=False)
+    finally:
+        conn.close()
+    df_valid = df_all[df_all['ORG_CARBON'] > 0]
+
+    columnas = extractor.CLAVES_CONSOLIDACION + extractor.COLUMNAS_PROMEDIO + extractor.COLUMNAS_MODA
+    esperado = _consolidar_por_capa(df_valid)[columnas].sort_values(extractor.CLAVES_CONSOLIDACION)
+    obtenido = extractor.consolidar_perfiles(df_valid)[columnas].sort_values(extractor.CLAVES_CONSOLIDACION)
+
+    pdt.assert_frame_equal(obtenido.reset_index(drop=True), esperado.reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.parametrize('formato', ['csv', 'parquet'])
+def test_por_bloques(bd_sintetica, smu_ids, referencia, tmp_path, formato):
+    salida = tmp_path / f'pyaez.{formato}'
+    extractor.extraer_pyaez_por_bloques(bd_sintetica, salida, smu_ids, tamano_bloque=TAMANO_BLOQUE)
+
+    pdt.assert_frame_equal(_comparable(extractor.leer_salida(salida)), referencia)
+
+
+def test_por_bloques_etapas(bd_sintetica, smu_ids, tmp_path):
+    medidor = extractor.MedidorEtapas()
+    registros = extractor.extraer_pyaez_por_bloques(bd_sintetica, tmp_path / 'pyaez.parquet', smu_ids,
+                                                    tamano_bloque=TAMANO_BLOQUE, medidor=medidor)
+
+    etapas = {etapa['etapa']: etapa for etapa in medidor.etapas}
+    partes = ['lectura', 'consolidacion', 'formato', 'escritura']
+    assert list(etapas) == ['tablas'] + partes + ['bloques']
+    assert etapas['escritura']['filas_salida'] == etapas['bloques']['filas_salida'] == registros
+    assert etapas['lectura']['bloques'] == etapas['bloques']['bloques'] > 1
+    assert sum(etapas[parte]['segundos'] for parte in partes) <= etapas['bloques']['segundos']
+
+
+def test_canalizado(bd_sintetica, smu_ids, referencia, tmp_path):
+    salida = tmp_path / 'pyaez.parquet'
+    extractor.extraer_pyaez_canalizado(bd_sintetica, salida, smu_ids, tamano_bloque=TAMANO_BLOQUE,
+                                       trabajadores=3)
+
+    pdt.assert_frame_equal(_comparable(extractor.leer_salida(salida)), referencia)
+
+
+# Paso de redondeo de las variables promediadas en la salida PyAEZ
+PASO_REDONDEO = {'OC': 0.001, 'pH': 0.1, 'TEB': 0.1, 'GYP': 0.1,
+                 'BS': 1, 'CEC_soil': 1, 'CEC_clay': 1, 'ESP': 1, 'EC': 1, 'CCB': 1, 'GRC': 1}
+
+
+def test_motor_sql(bd_sintetica, smu_ids, referencia):
+    # Los motores solo pueden diferir en un paso de redondeo de un promedio
+    # que cae en la mitad (ver comparar_motores); el resto es idéntico
+    df_sql = _comparable(extractor.combinar_capas(extractor.extraer_pyaez(bd_sintetica, smu_ids, motor='sql')))
+    pdt.assert_frame_equal(df_sql[['CODE', 'LAYER']], referencia[['CODE', 'LAYER']])
+    for variable in extractor.COLUMNAS_PYAEZ[2:]:
+        if variable not in PASO_REDONDEO:
+            pdt.assert_series_equal(df_sql[variable], referencia[variable])
+        else:
+            diferencia = (df_sql[variable].astype(float) - referencia[variable].astype(float)).abs()
+            assert (diferencia <= PASO_REDONDEO[variable] * (1 + 1e-6)).all(), variable
+
+    diferencias = extractor.comparar_motores(bd_sintetica, smu_ids)
+    assert set(diferencias['variable']) <= set(PASO_REDONDEO)
+
+
+def test_regiones(bd_sintetica, smu_ids, tmp_path):
+    regiones = {'norte': smu_ids[:60], 'sur': smu_ids[60:]}
+    salidas = extractor.extraer_regiones(bd_sintetica, regiones, tmp_path, formato='parquet', max_workers=2,
+                                         directorio_cache=tmp_path / 'cache')
+
+    for nombre, ids in regiones.items():
+        pdt.assert_frame_equal(_comparable(extractor.leer_salida(salidas[nombre])), _extraer(bd_sintetica, ids))
+
+
+def test_almacen(bd_sintetica, smu_ids, referencia, tmp_path):
+    almacen_pyaez.construir_almacen(bd_sintetica, tmp_path / 'almacen', smu_ids, tamano_bloque=TAMANO_BLOQUE,
+                                    verbose=False)
+    almacen = almacen_pyaez.AlmacenPyAEZ(tmp_path / 'almacen')
+
+    pdt.assert_frame_equal(_comparable(extractor.combinar_capas(almacen.consultar(smu_ids))), referencia)
+    assert almacen.vigente(bd_sintetica)
+
+
+def _modificar_bd(origen, destino, smu_modificados):
+    """Copia de origen con ORG_CARBON y PH_WATER alterados en algunos SMU"""
+    shutil.copy(origen, destino)
+    conn = sqlite3.connect(destino)
+    with conn:
+        conn.executemany("UPDATE HWSD2_LAYERS SET ORG_CARBON = ORG_CARBON * 2, PH_WATER = PH_WATER + 0.5 "
+                         "WHERE HWSD2_SMU_ID = ? AND ORG_CARBON > 0", [(i,) for i in smu_modificados])
+    conn.close()
+    return destino
+
+
+@pytest.mark.parametrize('salida', ['pyaez.parquet', 'almacen'])
+def test_diferencial(bd_sintetica, smu_ids, tmp_path, salida):
+    smu_modificados = smu_ids[5:15]
+    db_nuevo = _modificar_bd(bd_sintetica, tmp_path / 'HWSD2_nueva.db', smu_modificados)
+    ruta = tmp_path / salida
+    if salida == 'almacen':
+        almacen_pyaez.construir_almacen(bd_sintetica, ruta, smu_ids, verbose=False)
+    else:
+        extractor.extraer_pyaez(bd_sintetica, smu_ids, output=ruta)
+
+    df_cambios = diferencial_pyaez.actualizar_salida(ruta, db_nuevo, db_anterior=bd_sintetica, verbose=False)
+
+    assert set(df_cambios['CODE']) == set(smu_modificados)
+    pdt.assert_frame_equal(_comparable(diferencial_pyaez.leer_existente(ruta)), _extraer(db_nuevo, smu_ids))
+
+
+def test_diferencial_sin_cambios(bd_sintetica, smu_ids, tmp_path):
+    ruta = tmp_path / 'pyaez.parquet'
+    extractor.extraer_pyaez(bd_sintetica, smu_ids, output=ruta)
+    copia = shutil.copy(bd_sintetica, tmp_path / 'HWSD2_copia.db')
+
+    df_cambios = diferencial_pyaez.actualizar_salida(ruta, copia, db_anterior=bd_sintetica, verbose=False)
+
+    assert len(df_cambios) == 0
+    assert np.array_equal(_comparable(extractor.leer_salida(ruta))['CODE'],
+                          _extraer(bd_sintetica, smu_ids)['CODE'])
+
+
+def test_regiones_reglas_violaciones_y_medidor(bd_sintetica, smu_ids, tmp_path):
+    regiones = {'norte': smu_ids[:60], 'sur': smu_ids[60:]}
+    reglas = extractor.configurar_reglas(['pH_rango=rechazar'])
+    violaciones, medidor = [], extractor.MedidorEtapas()
+    salidas = extractor.extraer_regiones(bd_sintetica, regiones, tmp_path, formato='parquet', max_workers=2,
+                                         medidor=medidor, reglas=reglas, violaciones=violaciones)
+
+    esperadas = []
+    for nombre, ids in regiones.items():
+        esperado = extractor.extraer_pyaez(bd_sintetica, ids, reglas=reglas, violaciones=esperadas)
+        pdt.assert_frame_equal(_comparable(extractor.leer_salida(salidas[nombre])),
+                               _comparable(extractor.combinar_capas(esperado)))
+    pdt.assert_frame_equal(extractor.tabla_violaciones(violaciones), extractor.tabla_violaciones(esperadas))
+
+    etapas = medidor.reporte()['etapas']
+    assert etapas[-1]['etapa'] == 'regiones'
+    assert etapas[-1]['filas_salida'] == sum(len(extractor.leer_salida(ruta)) for ruta in salidas.values())
+    assert {etapa.get('region') for etapa in etapas[:-1]} == set(regiones)
@@ -0,0 +1,86 @@
+"""
+Planes de consulta (EXPLAIN QUERY PLAN) de HWSD2.db antes y después de preparar_bd
+"""
+
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+
+
+def _planes(conn, smu_ids):
+    """Planes de las consultas de capas, consolidación, WRB y bloques"""
+    return {
+        'capas': extractor.plan_consulta(conn, extractor._consulta_capas(extractor._tabla_ids(conn, smu_ids))),
+        'consolidado': extractor.plan_consulta(
+            conn, extractor._consulta_consolidado(extractor._tabla_ids(conn, smu_ids), extractor.CAPAS)),
+        'wrb': extractor.plan_consulta(
+            conn, extractor._consulta_wrb(extractor._tabla_ids(conn, smu_ids, 'pyaez_ids_smu'))),
+        'bloques': extractor.plan_consulta(
+            conn, extractor._consulta_capas(extractor._tabla_ids(conn, smu_ids, 'pyaez_ids_bloques'))),
+    }
+
+
+def _recorridos(plan):
+    return [linea for linea in plan if linea.startswith(('SCAN HWSD2_LAYERS', 'SCAN HWSD2_SMU'))]
+
+
+def test_sin_indices_recorre_tablas(bd_sintetica, smu_ids):
+    conn = extractor.conectar_solo_lectura(bd_sintetica)
+    try:
+        planes = _planes(conn, smu_ids)
+    finally:
+        conn.close()
+
+    for consulta in ('capas', 'consolidado', 'wrb', 'bloques'):
+        assert _recorridos(planes[consulta]), consulta
+    assert extractor.diagnosticar_bd(bd_sintetica, smu_ids)['recomendaciones']
+
+
+@pytest.mark.parametrize('consulta, indice', [
+    ('capas', 'SEARCH HWSD2_LAYERS USING INDEX idx_pyaez_capas'),
+    ('consolidado', 'SEARCH HWSD2_LAYERS USING INDEX idx_pyaez_capas'),
+    ('wrb', 'SEARCH HWSD2_SMU USING INDEX idx_pyaez_smu'),
+    ('bloques', 'SEARCH HWSD2_LAYERS USING INDEX idx_pyaez_capas'),
+])
+def test_preparada_usa_indices(bd_preparada, smu_ids, consulta, indice):
+    conn = extractor.conectar_solo_lectura(bd_preparada)
+    try:
+        plan = _planes(conn, smu_ids)[consulta]
+    finally:
+        conn.close()
+
+    assert any(linea.startswith(indice) for linea in plan), plan
+    assert not _recorridos(plan), plan
+    if consulta in ('capas', 'bloques'):
+        assert not any('TEMP B-TREE FOR ORDER BY' in linea for linea in plan), plan
+
+
+def test_bloques_toda_la_base_recorre_indice(bd_preparada):
+    # Sin filtro de SMU se lee toda la tabla, pero en el orden del índice
+    conn = extractor.conectar_solo_lectura(bd_preparada)
+    try:
+        plan = extractor.plan_consulta(conn, extractor._consulta_capas(None))
+    finally:
+        conn.close()
+
+    assert plan == ['SCAN HWSD2_LAYERS USING INDEX idx_pyaez_capas']
+
+
+def test_diagnostico_preparada_sin_recomendaciones(bd_preparada, smu_ids):
+    diagnostico = extractor.diagnosticar_bd(bd_preparada, smu_ids)
+
+    assert diagnostico['recomendaciones'] == []
+    assert 'idx_pyaez_capas' in diagnostico['indices']['HWSD2_LAYERS']
+    assert 'idx_pyaez_smu' in diagnostico['indices']['HWSD2_SMU']
+
+
+def test_copia_reducida_sin_recorridos(bd_sintetica, smu_ids, tmp_path):
+    destino = extractor.preparar_bd(bd_sintetica, tmp_path / 'HWSD2_pyaez.db', verbose=False)
+    conn = extractor.conectar_solo_lectura(destino)
+    try:
+        planes = _planes(conn, smu_ids)
+    finally:
+        conn.close()
+
+    for consulta, plan in planes.items():
+        assert not _recorridos(plan), (consulta, plan)
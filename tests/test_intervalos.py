@@ -0,0 +1,48 @@
+"""
+Intervalos de profundidad: un intervalo igual a una capa reproduce esa capa
+"""
+
+import pandas.testing as pdt
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+import intervalos_pyaez
+
+
+@pytest.mark.parametrize('peso', [1.0, 20.0, 7.3])
+def test_ponderado_con_pesos_iguales(bd_sintetica, smu_ids, peso):
+    conn = extractor.conectar_solo_lectura(bd_sintetica)
+    try:
+        df_all = extractor.obtener_capas(conn, smu_ids, verbose=False)
+    finally:
+        conn.close()
+    df_valid = df_all[df_all['ORG_CARBON'] > 0]
+
+    esperado = extractor.consolidar_perfiles(df_valid)
+    obtenido = extractor.consolidar_ponderado(df_valid.assign(_peso=peso), '_peso')
+
+    pdt.assert_frame_equal(obtenido[esperado.columns], esperado, check_dtype=False, check_exact=True)
+
+
+@pytest.mark.parametrize('intervalo, capa', [('0-20', 'D1'), ('40-60', 'D3'), ('100-150', 'D6')])
+def test_intervalo_igual_a_capa(bd_sintetica, smu_ids, intervalo, capa):
+    # En la base sintética cada capa tiene la misma profundidad en todos los perfiles
+    resultados = intervalos_pyaez.extraer_intervalos(bd_sintetica, smu_ids, intervalos=[intervalo], capas=[capa])
+
+    pdt.assert_frame_equal(extractor.exportar_pyaez(resultados[intervalo]),
+                           extractor.exportar_pyaez(resultados[capa]))
+
+
+@pytest.mark.parametrize('formato', ['parquet', 'csv'])
+def test_leer_carpeta_de_intervalos(bd_sintetica, smu_ids, tmp_path, formato):
+    resultados = intervalos_pyaez.extraer_intervalos(bd_sintetica, smu_ids, intervalos=['0-30', '0-RSD'],
+                                                     capas=['D1'])
+    extractor.guardar_resultados(resultados, tmp_path / 'salida', formato=formato, particionar_por_capa=True,
+                                 verbose=False)
+
+    df = extractor.tipar_pyaez(extractor.leer_salida(tmp_path / 'salida'))
+    esperado = extractor.combinar_capas(resultados)
+    clave = ['LAYER', 'CODE']
+    pdt.assert_frame_equal(
+        extractor.exportar_pyaez(df).astype({'LAYER': str}).sort_values(clave).reset_index(drop=True),
+        extractor.exportar_pyaez(esperado).astype({'LAYER': str}).sort_values(clave).reset_index(drop=True))
@@ -0,0 +1,122 @@
+"""
+Mapeos vectorizados (mapear_osd, clasificar_fases, mapear_drenaje) contra sus versiones escalares
+"""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+
+# Códigos como llegan de HWSD2_LAYERS: enteros, reales, textos con signo o
+# espacios, textos no enteros, vacíos y faltantes (sin infinitos: int() de la
+# versión escalar lanza OverflowError, la vectorizada da el valor por defecto)
+VALORES = [1, 2.0, 2.7, -1, 0, 6, 7, 16, 1e20, '+5', ' 4 ', '3', '-2', '2.5', 'abc', '', ' ',
+           np.nan, None]
+
+
+def _series(valores):
+    """La misma lista con los tipos de columna que produce read_sql_query"""
+    series = {'object': pd.Series(valores, dtype=object)}
+    numericos = [v for v in valores if not isinstance(v, str)]
+    textos = [v for v in valores if isinstance(v, str) or v is None]
+    series['float'] = pd.Series(numericos, dtype=float)
+    series['Int64'] = pd.Series([v for v in numericos if v is None or abs(v) < 2**62],
+                                dtype=float).apply(lambda v: v if pd.isna(v) else int(v)).astype('Int64')
+    series['string'] = pd.Series(textos, dtype='string')
+    series['str'] = pd.Series(textos, dtype=object)
+    return series
+
+
+@pytest.fixture(scope='module')
+def registros(bd_sintetica):
+    """RegistroTablas de la base y otro con símbolos de drenaje numéricos"""
+    conn = extractor.conectar_solo_lectura(bd_sintetica)
+    try:
+        base = extractor.RegistroTablas(conn)
+        numerico = extractor.RegistroTablas(conn)
+        numerico._tablas['drainage'] = pd.DataFrame({'SYMBOL': [1, 2, 5, 6], 'CODE': ['VP', 'P', 'W', 'SE']})
+        yield {'base': base, 'numerico': numerico}
+    finally:
+        conn.close()
+
+
+def _drenaje_escalar(val, drainage_map):
+    """Regla escalar original de DRG (map_drainage)"""
+    if pd.isna(val):
+        return ''
+    if isinstance(val, str):
+        return val
+    try:
+        return drainage_map.get(int(val), '')
+    except (ValueError, TypeError):
+        return ''
+
+
+@pytest.mark.parametrize('tipo', ['object', 'float', 'Int64', 'string', 'str'])
+def test_mapear_osd(tipo):
+    serie = _series(VALORES)[tipo]
+
+    esperado = [extractor.convertir_osd_a_cm(v) for v in serie]
+
+    assert extractor.mapear_osd(serie).tolist() == esperado
+
+
+@pytest.mark.parametrize('tipo', ['object', 'float', 'Int64', 'string', 'str'])
+@pytest.mark.parametrize('registro', ['base', 'numerico'])
+def test_mapear_drenaje(registros, registro, tipo):
+    tablas = registros[registro]
+    serie = _series(VALORES)[tipo]
+
+    esperado = [_drenaje_escalar(v, tablas['drainage']) for v in serie]
+
+    assert extractor.mapear_drenaje(serie, tablas).tolist() == esperado
+    if registro == 'numerico' and tipo in ('object', 'float'):
+        assert 'SE' in esperado
+
+
+FASES = [1, 5.0, 6, 13, 14, 0, 16, 2.9, '+6', ' 13 ', '2', '2.5', 'abc', '', np.nan, None]
+
+
+@pytest.mark.parametrize('fases, escalar', [
+    (extractor.FASES_SPH, extractor.clasificar_sph),
+    (extractor.FASES_SPR, extractor.clasificar_spr),
+], ids=['SPH', 'SPR'])
+@pytest.mark.parametrize('tipo', ['object', 'float', 'string'])
+def test_clasificar_fases(registros, fases, escalar, tipo):
+    tablas = registros['base']
+    pares = list(itertools.product(FASES, repeat=2))
+    if tipo == 'float':
+        pares = [(a, b) for a, b in pares if not isinstance(a, str) and not isinstance(b, str)]
+    elif tipo == 'string':
+        pares = [(a, b) for a, b in pares if isinstance(a, (str, type(None))) and isinstance(b, (str, type(None)))]
+    phase1 = pd.Series([a for a, _ in pares], dtype=tipo)
+    phase2 = pd.Series([b for _, b in pares], dtype=tipo)
+
+    esperado = [escalar(a, b, tablas['phase']) for a, b in zip(phase1, phase2)]
+
+    assert extractor.clasificar_fases(phase1, phase2, tablas, fases).tolist() == esperado
+    assert any(v != 0 for v in esperado)
+
+
+def test_mapeador_osd_sigue_a_osd_rangos(monkeypatch):
+    serie = pd.Series(VALORES, dtype=object)
+    extractor.mapear_osd(serie)
+    _, mapeador = extractor._MAPEADOR_OSD
+
+    # Sin cambios se reutiliza el mismo mapeador
+    extractor.mapear_osd(serie)
+    assert extractor._MAPEADOR_OSD[1] is mapeador
+
+    # Un código modificado en el mismo dict
+    monkeypatch.setitem(extractor.OSD_RANGOS, 5, 45)
+    assert extractor.mapear_osd(serie).tolist() == [extractor.convertir_osd_a_cm(v) for v in serie]
+    assert 45 in extractor.mapear_osd(serie).tolist()
+    assert extractor._MAPEADOR_OSD[1] is not mapeador
+
+    # OSD_RANGOS reemplazado por otro dict
+    monkeypatch.setattr(extractor, 'OSD_RANGOS', {**extractor.OSD_RANGOS, 16: 5})
+    assert extractor.mapear_osd(serie).tolist() == [extractor.convertir_osd_a_cm(v) for v in serie]
+    assert 5 in extractor.mapear_osd(serie).tolist()
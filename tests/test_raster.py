@@ -0,0 +1,89 @@
+"""
+Modo raster: grillas de rasterizar_pyaez/leer_grilla contra la extracción por SMU
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+import raster_pyaez
+
+NODATA = 0
+ID_SIN_REGISTROS = 999999
+CAPAS = ['D1', 'D3', 'D7']
+
+
+@pytest.fixture(scope='module')
+def grillas(bd_sintetica, smu_ids, tmp_path_factory):
+    """Raster 13x11 con SMU de la base, nodata e IDs sin registros, y sus grillas"""
+    rng = np.random.default_rng(3)
+    raster = rng.choice(np.array(smu_ids[:40] + [NODATA, ID_SIN_REGISTROS], dtype=np.int32), size=(13, 11))
+    directorio = tmp_path_factory.mktemp('raster')
+    np.save(directorio / 'smu.npy', raster)
+
+    metadatos = raster_pyaez.rasterizar_pyaez(directorio / 'smu.npy', bd_sintetica, directorio / 'grillas', CAPAS,
+                                              nodata=NODATA, filas_por_bloque=4, verbose=False)
+    return raster, directorio / 'grillas', metadatos
+
+
+def _esperado(bd_sintetica, raster, capa, variable):
+    """Valor de cada píxel según extraer_pyaez (None = sin dato)"""
+    ids = np.unique(raster[raster != NODATA]).tolist()
+    resultados = extractor.extraer_pyaez(bd_sintetica, ids, [capa])
+    df = extractor.exportar_pyaez(resultados[capa]).set_index('CODE')[variable]
+    valores = [df.get(int(i)) for i in raster.ravel()]
+    return np.array([None if v is None or pd.isna(v) else v for v in valores], dtype=object).reshape(raster.shape)
+
+
+@pytest.mark.parametrize('capa', CAPAS)
+@pytest.mark.parametrize('variable', ['OC', 'pH', 'BS', 'RSD', 'VSP', 'TXT', 'SPR', 'SPH', 'DRG'])
+def test_grilla_igual_a_extraccion(bd_sintetica, grillas, capa, variable):
+    raster, directorio, metadatos = grillas
+    esperado = _esperado(bd_sintetica, raster, capa, variable)
+    sin_dato = np.array([[v is None for v in fila] for fila in esperado])
+    assert sin_dato[raster == NODATA].all() and sin_dato[raster == ID_SIN_REGISTROS].all()
+
+    tipo = metadatos['variables'][variable]
+    grilla = raster_pyaez.leer_grilla(directorio, capa, variable)
+    assert grilla.shape == raster.shape
+    if tipo == 'real':
+        assert grilla.dtype == np.float32
+        assert np.array_equal(np.isnan(grilla), sin_dato)
+        assert np.array_equal(grilla[~sin_dato], esperado[~sin_dato].astype(np.float32))
+    elif tipo == 'entera':
+        assert grilla.dtype == np.int16
+        assert (grilla[sin_dato] == -9).all()
+        assert np.array_equal(grilla[~sin_dato], esperado[~sin_dato].astype(np.int16))
+    else:
+        assert grilla.dtype == np.uint8
+        assert np.array_equal(grilla == 0, sin_dato)
+        decodificada = raster_pyaez.leer_grilla(directorio, capa, variable, decodificar=True)
+        assert decodificada[sin_dato].tolist() == [None] * sin_dato.sum()
+        assert decodificada[~sin_dato].tolist() == [str(v) for v in esperado[~sin_dato]]
+
+
+def test_metadatos(grillas):
+    raster, _, metadatos = grillas
+
+    assert metadatos['forma'] == list(raster.shape)
+    assert metadatos['capas'] == CAPAS
+    assert metadatos['smu'] == len(np.unique(raster[raster != NODATA]))
+
+
+def test_leyenda_mayor_que_uint8():
+    # 300 texturas: los códigos 256-300 no deben desbordar uint8
+    textura = [f"textura {i:03d}" for i in range(300)]
+    df = pd.DataFrame({'CODE': np.arange(1, 301), 'TXT': textura})
+    leyendas = {'TXT': sorted(textura)}
+    indice = raster_pyaez.IndiceDenso(df['CODE'].to_numpy())
+
+    valores = raster_pyaez.tablas_valores(df, indice, ['TXT'], leyendas)['TXT']
+
+    assert valores.dtype == np.uint16
+    assert valores.tolist() == list(range(1, 301)) + [0]
+
+
+def test_leyenda_demasiado_grande():
+    with pytest.raises(ValueError, match='TXT'):
+        raster_pyaez._tipo_grilla('TXT', {'TXT': [str(i) for i in range(70000)]})
@@ -0,0 +1,153 @@
+"""
+Índice de regiones: por_ventana, por_bbox y por_poligono contra fuerza bruta sobre un raster sintético
+"""
+
+import numpy as np
+import pytest
+
+from regiones_smu import IndiceRegiones
+
+NODATA = 0
+TESELA = 8
+# Píxeles de 0.5 x 0.25, norte arriba: x = 0.5·col + 10, y = -0.25·fila + 40
+TRANSFORM = (0.5, 0.0, 10.0, 0.0, -0.25, 40.0)
+
+
+@pytest.fixture(scope='module')
+def raster(tmp_path_factory):
+    """Raster 37x53 (teselas incompletas en los bordes) con zonas nodata"""
+    rng = np.random.default_rng(5)
+    datos = rng.integers(1, 400, size=(37, 53)).astype(np.int32)
+    datos[rng.random(datos.shape) < 0.1] = NODATA
+    datos[:9, 40:] = NODATA
+    ruta = tmp_path_factory.mktemp('regiones') / 'smu.npy'
+    np.save(ruta, datos)
+    return ruta, datos
+
+
+@pytest.fixture(scope='module', params=['construido', 'cargado'])
+def indice(request, raster, tmp_path_factory):
+    ruta, _ = raster
+    indice = IndiceRegiones.construir(ruta, TESELA, TRANSFORM, NODATA)
+    if request.param == 'cargado':
+        archivo = tmp_path_factory.mktemp('indice') / 'indice_smu.npz'
+        indice.guardar(archivo)
+        indice = IndiceRegiones.cargar(archivo)
+    yield indice
+    indice.cerrar()
+
+
+def _ids(datos, mascara):
+    return np.unique(datos[mascara & (datos != NODATA)]).tolist()
+
+
+def _centros(datos):
+    """(fila, columna) y (x, y) de los centros de píxel"""
+    filas, cols = np.indices(datos.shape) + 0.5
+    a, _, c, _, e, f = TRANSFORM
+    return filas, cols, a * cols + c, e * filas + f
+
+
+@pytest.mark.parametrize('ventana', [
+    (0, 37, 0, 53),          # todo el raster
+    (8, 24, 16, 40),         # alineada con las teselas
+    (3, 30, 5, 47),          # teselas del borde parciales
+    (-5, 4, 50, 70),         # parcialmente fuera del raster
+    (36, 37, 52, 53),        # un píxel de la tesela incompleta
+    (0, 9, 40, 53),          # solo nodata
+    (10, 10, 0, 53),         # vacía
+    (40, 50, 0, 10),         # fuera del raster
+])
+def test_por_ventana(indice, raster, ventana):
+    _, datos = raster
+    f0, f1, c0, c1 = ventana
+    mascara = np.zeros(datos.shape, dtype=bool)
+    mascara[max(f0, 0):max(f1, 0), max(c0, 0):max(c1, 0)] = True
+
+    assert indice.por_ventana(*ventana).tolist() == _ids(datos, mascara)
+    # Sin leer el raster: superconjunto de la respuesta exacta
+    assert set(_ids(datos, mascara)) <= set(indice.por_ventana(*ventana, exacto=False).tolist())
+
+
+@pytest.mark.parametrize('bbox', [
+    (10.0, 30.75, 36.5, 40.0),       # todo el raster
+    (12.3, 33.1, 25.9, 38.2),        # bordes entre centros de píxel
+    (12.25, 33.125, 25.75, 38.375),  # bordes sobre centros de píxel (incluidos)
+    (0.0, 0.0, 11.0, 35.0),          # parcialmente fuera
+    (50.0, 50.0, 60.0, 60.0),        # fuera del raster
+])
+def test_por_bbox(indice, raster, bbox):
+    _, datos = raster
+    _, _, x, y = _centros(datos)
+    xmin, ymin, xmax, ymax = bbox
+    mascara = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+    assert indice.por_bbox(*bbox).tolist() == _ids(datos, mascara)
+
+
+def _a_pixel(x, y):
+    a, _, c, _, e, f = TRANSFORM
+    return (y - f) / e, (x - c) / a
+
+
+def _dentro_fuerza_bruta(anillos, datos):
+    """Regla par-impar píxel a píxel (en coordenadas de píxel, como IndiceRegiones)"""
+    filas, cols, _, _ = _centros(datos)
+    dentro = np.zeros(datos.shape, dtype=bool)
+    for i, j in np.ndindex(datos.shape):
+        fila, col = filas[i, j], cols[i, j]
+        cruces = 0
+        for anillo in anillos:
+            vertices = [_a_pixel(x, y) for x, y in anillo]
+            for (f_a, c_a), (f_b, c_b) in zip(vertices, vertices[1:] + vertices[:1]):
+                if (f_a > fila) != (f_b > fila) and col < c_a + (fila - f_a) * (c_b - c_a) / (f_b - f_a):
+                    cruces += 1
+        dentro[i, j] = cruces % 2 == 1
+    return dentro
+
+
+TRIANGULO = [[11.0, 31.5], [35.0, 33.0], [20.0, 39.5]]
+# Estrella de cinco puntas autointersectada: el pentágono central queda fuera (par-impar)
+ESTRELLA = [[23.0, 39.5], [29.5, 31.5], [12.5, 36.8], [33.5, 36.8], [16.5, 31.5]]
+# Vértices y aristas horizontales/verticales sobre centros de píxel
+RECTANGULO = [[12.25, 33.125], [25.75, 33.125], [25.75, 38.375], [12.25, 38.375]]
+HUECO = [[16.25, 34.625], [20.75, 34.625], [20.75, 36.875], [16.25, 36.875]]
+
+
+@pytest.mark.parametrize('poligono, anillos', [
+    (TRIANGULO, [TRIANGULO]),
+    (ESTRELLA, [ESTRELLA]),
+    (RECTANGULO, [RECTANGULO]),
+    ({'type': 'Polygon', 'coordinates': [RECTANGULO, HUECO]}, [RECTANGULO, HUECO]),
+    ({'type': 'MultiPolygon', 'coordinates': [[HUECO], [TRIANGULO[:2] + [[30.0, 31.0]]]]},
+     [HUECO, TRIANGULO[:2] + [[30.0, 31.0]]]),
+    ([[0.0, 0.0], [100.0, 0.0], [100.0, 100.0], [0.0, 100.0]], None),   # cubre todo el raster
+])
+def test_por_poligono(indice, raster, poligono, anillos):
+    _, datos = raster
+    mascara = np.ones(datos.shape, dtype=bool) if anillos is None else _dentro_fuerza_bruta(anillos, datos)
+    assert mascara.any()
+
+    assert indice.por_poligono(poligono).tolist() == _ids(datos, mascara)
+
+
+def test_estrella_excluye_el_centro(indice, raster):
+    # El centro de la estrella está dentro del contorno pero cruza dos aristas
+    _, datos = raster
+    fila, col = (int(v) for v in _a_pixel(23.0, 35.0))
+    centro = datos[fila, col]
+    mascara = _dentro_fuerza_bruta([ESTRELLA], datos)
+
+    assert not mascara[fila, col]
+    # Con esta semilla el SMU del centro no aparece en ninguna punta
+    assert centro != NODATA and centro not in datos[mascara]
+    assert centro not in indice.por_poligono(ESTRELLA).tolist()
+
+
+def test_sin_transform(raster):
+    ruta, _ = raster
+    indice = IndiceRegiones.construir(ruta, TESELA, nodata=NODATA)
+
+    with pytest.raises(ValueError):
+        indice.por_bbox(10.0, 30.0, 20.0, 40.0)
+    assert indice.todos().tolist() == _ids(np.load(ruta), np.ones((37, 53), dtype=bool))
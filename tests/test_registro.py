@@ -0,0 +1,32 @@
+"""
+Registro de tablas de referencia: atributos WRB por SMU memorizados con límite
+"""
+
+import pandas.testing as pdt
+
+import eswatini_pyaez_suelos as extractor
+
+
+def test_atributos_smu_acotados(bd_sintetica, smu_ids, monkeypatch):
+    conn = extractor.conectar_solo_lectura(bd_sintetica)
+    try:
+        esperado = extractor.RegistroTablas(conn).atributos_smu(conn, smu_ids)
+
+        monkeypatch.setattr(extractor, 'MAX_ATRIBUTOS_SMU', 20)
+        registro = extractor.RegistroTablas(conn)
+        # Una llamada mayor que el límite devuelve todos sus SMU
+        pdt.assert_frame_equal(registro.atributos_smu(conn, smu_ids), esperado)
+        assert list(registro._atributos) == smu_ids[-20:]
+
+        # Bloques sucesivos: se conservan los más recientes, con el mismo resultado
+        for inicio in range(0, len(smu_ids), 15):
+            bloque = smu_ids[inicio:inicio + 15]
+            pdt.assert_frame_equal(registro.atributos_smu(conn, bloque), esperado.loc[bloque])
+            assert len(registro._atributos) <= 20
+        assert list(registro._atributos)[-len(bloque):] == bloque
+
+        # Un SMU que no está en HWSD2_SMU también se memoriza (sin fila en el resultado)
+        assert len(registro.atributos_smu(conn, [999999999] + smu_ids[:2])) == 2
+        assert list(registro._atributos)[-3:] == [999999999] + smu_ids[:2]
+    finally:
+        conn.close()
@@ -0,0 +1,108 @@
+"""
+Esquema tipado: tipar_pyaez/exportar_pyaez sin pérdidas y enteros fuera de rango (BS, ESP)
+"""
+
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+
+INT16 = np.iinfo(np.int16)
+
+
+@pytest.fixture(scope='module')
+def tipados(bd_sintetica, smu_ids):
+    return extractor.combinar_capas(extractor.extraer_pyaez(bd_sintetica, smu_ids))
+
+
+def _verificar_tipos(df):
+    for columna, tipo in extractor.TIPOS_PYAEZ.items():
+        if tipo == 'category':
+            assert isinstance(df[columna].dtype, pd.CategoricalDtype), columna
+        else:
+            assert df[columna].dtype == np.dtype(tipo), columna
+
+
+def test_ida_y_vuelta_sin_perdidas(tipados):
+    _verificar_tipos(tipados)
+    exportado = extractor.exportar_pyaez(tipados)
+    # La base sintética tiene registros sin fase y sin drenaje
+    assert (exportado['SPR'] == 0).any() and (exportado['SPH'] == 0).any() and (exportado['DRG'] == '').any()
+
+    retipado = extractor.tipar_pyaez(exportado)
+    _verificar_tipos(retipado)
+    pdt.assert_frame_equal(retipado, tipados)
+    pdt.assert_frame_equal(extractor.exportar_pyaez(retipado), exportado)
+    # tipar_pyaez es idempotente sobre registros ya tipados
+    pdt.assert_frame_equal(extractor.tipar_pyaez(tipados), tipados)
+
+
+@pytest.mark.parametrize('formato', ['csv', 'parquet'])
+def test_ida_y_vuelta_por_archivo(tipados, tmp_path, formato):
+    salida = tmp_path / f"pyaez.{formato}"
+    extractor.guardar_resultados(extractor.separar_por_capa(tipados, extractor.CAPAS, verbose=False), salida,
+                                 verbose=False)
+
+    leido = extractor.tipar_pyaez(extractor.leer_salida(salida))
+
+    pdt.assert_frame_equal(extractor.exportar_pyaez(leido).astype({'LAYER': str}),
+                           extractor.exportar_pyaez(tipados).astype({'LAYER': str}))
+
+
+def test_enteros_saturan_en_int16():
+    df = pd.DataFrame({'CODE': [1, 2, 3, 4], 'BS': [130, 40000, -40000, 50], 'ESP': [-5, 101, 70000, 0]})
+
+    tipado = extractor.tipar_pyaez(df)
+
+    assert tipado['BS'].dtype == np.int16 and tipado['ESP'].dtype == np.int16
+    assert tipado['BS'].tolist() == [130, INT16.max, INT16.min, 50]
+    assert tipado['ESP'].tolist() == [-5, 101, INT16.max, 0]
+    assert extractor.exportar_pyaez(tipado)['BS'].tolist() == [130, INT16.max, INT16.min, 50]
+
+
+@pytest.fixture(scope='module')
+def bd_fuera_de_rango(bd_sintetica, smu_ids, tmp_path_factory):
+    """Copia de la base con ESP y TEB/CEC_soil fuera de 0-100 (y de int16) en cuatro SMU"""
+    ruta = tmp_path_factory.mktemp('fuera_de_rango') / 'HWSD2.db'
+    shutil.copy(bd_sintetica, ruta)
+    conn = sqlite3.connect(ruta)
+    with conn:
+        for smu, esp in zip(smu_ids[:3], [130.0, -5.0, 50000.0]):
+            conn.execute("UPDATE HWSD2_LAYERS SET ESP = ? WHERE HWSD2_SMU_ID = ?", (esp, smu))
+        conn.execute("UPDATE HWSD2_LAYERS SET TEB = CEC_SOIL * 1000 WHERE HWSD2_SMU_ID = ?", (smu_ids[3],))
+    conn.close()
+    return ruta
+
+
+def test_bs_esp_reportados_no_se_recortan(bd_fuera_de_rango, smu_ids):
+    reglas = extractor.configurar_reglas({'BS_rango': 'reportar', 'ESP_rango': 'reportar'})
+    violaciones = []
+    df = extractor.combinar_capas(extractor.extraer_pyaez(bd_fuera_de_rango, smu_ids[:4], reglas=reglas,
+                                                          violaciones=violaciones)).set_index(['CODE', 'LAYER'])
+    violaciones = pd.concat(violaciones)
+
+    assert df['ESP'].dtype == np.int16 and df['BS'].dtype == np.int16
+    assert (df.loc[smu_ids[0], 'ESP'] == 130).all()
+    assert (df.loc[smu_ids[1], 'ESP'] == -5).all()
+    assert (df.loc[smu_ids[2], 'ESP'] == INT16.max).all()
+    assert (df.loc[smu_ids[3], 'BS'] == INT16.max).all()
+
+    # Cada violación de BS_rango llega a la salida con su valor redondeado
+    # (saturado en int16), sin recorte a 100
+    bs = violaciones[violaciones['regla'] == 'BS_rango']
+    assert (bs['valor'] > 100).any()
+    for code, capa, valor in zip(bs['CODE'], bs['LAYER'], bs['valor']):
+        assert df.loc[(code, capa), 'BS'] == np.clip(np.round(valor), INT16.min, INT16.max)
+
+
+def test_bs_esp_recortados_por_defecto(bd_fuera_de_rango, smu_ids):
+    df = extractor.combinar_capas(extractor.extraer_pyaez(bd_fuera_de_rango, smu_ids[:4]))
+
+    assert df['ESP'].between(0, 100).all() and df['BS'].between(0, 100).all()
+    assert (df.loc[df['CODE'] == smu_ids[0], 'ESP'] == 100).all()
+    assert (df.loc[df['CODE'] == smu_ids[3], 'BS'] == 100).all()
@@ -0,0 +1,133 @@
+"""
+Reglas de validación (validar_registros): valor corregido y tabla de violaciones de cada acción y tipo
+"""
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+import eswatini_pyaez_suelos as extractor
+
+COLUMNAS_VIOLACIONES = ['CODE', 'LAYER', 'regla', 'variable', 'valor', 'accion']
+
+
+def _registros(**columnas):
+    """Registros consolidados de los SMU 1..n en D1, válidos para todas las reglas por defecto"""
+    n = len(next(iter(columnas.values())))
+    df = pd.DataFrame({
+        'HWSD2_SMU_ID': np.arange(1, n + 1), 'LAYER': 'D1', 'TXT': 'loam', 'CLAY': 20.0,
+        'PH_WATER': 6.5, 'ESP': 5.0, 'BS_calculated': 50.0, 'ROOT_DEPTH': 100.0, 'ORG_CARBON': 1.0,
+        'TEB': 10.0, 'CEC_SOIL': 20.0, 'CEC_CLAY': 40.0, 'ELEC_COND': 1.0, 'TCARBON_EQ': 0.0,
+        'GYPSUM': 0.0, 'COARSE': 10.0,
+    }, index=range(n))
+    return df.assign(**columnas)
+
+
+def _regla(nombre, accion):
+    return extractor.configurar_reglas({nombre: accion})
+
+
+def _violaciones(df_violaciones, regla):
+    """(CODE, valor) de las violaciones de una regla"""
+    filas = df_violaciones[df_violaciones['regla'] == regla]
+    return list(zip(filas['CODE'].tolist(), filas['valor'].tolist()))
+
+
+def _verificar_esquema(df_violaciones):
+    assert list(df_violaciones.columns) == COLUMNAS_VIOLACIONES
+    assert df_violaciones['CODE'].dtype == np.int32
+    assert df_violaciones['valor'].dtype == np.float64
+    for columna in ['LAYER', 'regla', 'variable', 'accion']:
+        assert isinstance(df_violaciones[columna].dtype, pd.CategoricalDtype), columna
+
+
+def test_rango_recortar():
+    df, violaciones = extractor.validar_registros(_registros(PH_WATER=[2.0, 6.5, 12.5]))
+
+    assert df['PH_WATER'].tolist() == [3.0, 6.5, 11.0]
+    _verificar_esquema(violaciones)
+    assert len(violaciones) == 2
+    assert _violaciones(violaciones, 'pH_rango') == [(1, 2.0), (3, 12.5)]
+    assert set(violaciones['variable']) == {'pH'} and set(violaciones['accion']) == {'recortar'}
+    assert violaciones['LAYER'].tolist() == ['D1', 'D1']
+
+
+def test_rango_reportar():
+    registros = _registros(ESP=[-1.0, 5.0, 130.0])
+    df, violaciones = extractor.validar_registros(registros, _regla('ESP_rango', 'reportar'))
+
+    pdt.assert_series_equal(df['ESP'], registros['ESP'])
+    _verificar_esquema(violaciones)
+    assert _violaciones(violaciones, 'ESP_rango') == [(1, -1.0), (3, 130.0)]
+    assert set(violaciones['accion']) == {'reportar'}
+
+
+def test_rango_imputar_sin_valor():
+    # Un rango sin 'valor' imputa NaN (y luego pH_faltante no se reevalúa)
+    df, violaciones = extractor.validar_registros(_registros(PH_WATER=[6.5, 12.5]), _regla('pH_rango', 'imputar'))
+
+    assert df['PH_WATER'].iloc[0] == 6.5 and np.isnan(df['PH_WATER'].iloc[1])
+    assert _violaciones(violaciones, 'pH_rango') == [(2, 12.5)]
+    assert _violaciones(violaciones, 'pH_faltante') == []
+
+
+def test_faltante_imputar():
+    df, violaciones = extractor.validar_registros(_registros(PH_WATER=[np.nan, 6.5], ROOT_DEPTH=[60.0, np.nan]))
+
+    assert df['PH_WATER'].tolist() == [7.0, 6.5]
+    assert df['ROOT_DEPTH'].tolist() == [60.0, 100.0]
+    _verificar_esquema(violaciones)
+    assert [(c, np.isnan(v)) for c, v in _violaciones(violaciones, 'pH_faltante')] == [(1, True)]
+    assert [(c, np.isnan(v)) for c, v in _violaciones(violaciones, 'RSD_faltante')] == [(2, True)]
+    assert set(violaciones['variable']) == {'pH', 'RSD'}
+
+
+def test_rechazar():
+    df, violaciones = extractor.validar_registros(_registros(PH_WATER=[6.5, 12.5, 2.0]),
+                                                  _regla('pH_rango', 'rechazar'))
+
+    assert df['HWSD2_SMU_ID'].tolist() == [1]
+    _verificar_esquema(violaciones)
+    assert _violaciones(violaciones, 'pH_rango') == [(2, 12.5), (3, 2.0)]
+    assert set(violaciones['accion']) == {'rechazar'}
+
+
+@pytest.mark.parametrize('accion, esperado', [('reportar', [10.0, 30.0]), ('recortar', [10.0, 20.0])])
+def test_maximo_columna(accion, esperado):
+    df, violaciones = extractor.validar_registros(_registros(TEB=[10.0, 30.0]), _regla('TEB_mayor_CEC', accion))
+
+    assert df['TEB'].tolist() == esperado
+    _verificar_esquema(violaciones)
+    assert _violaciones(violaciones, 'TEB_mayor_CEC') == [(2, 30.0)]
+    assert set(violaciones['variable']) == {'TEB'} and set(violaciones['accion']) == {accion}
+
+
+@pytest.mark.parametrize('textura', ['clay (heavy)', 'Clay (heavy)', 'clay(heavy)'])
+def test_textura_arcilla_heavy_clay(textura):
+    # clay (heavy) admite 60-100 % de arcilla (tolerancia de 5): 45 % se reporta
+    registros = _registros(TXT=[textura, textura, textura], CLAY=[45.0, 58.0, 75.0])
+    df, violaciones = extractor.validar_registros(registros)
+
+    pdt.assert_series_equal(df['CLAY'], registros['CLAY'])
+    _verificar_esquema(violaciones)
+    assert _violaciones(violaciones, 'textura_arcilla') == [(1, 45.0)]
+    assert set(violaciones['variable']) == {'CLAY'}
+
+
+def test_textura_arcilla_rechazar():
+    # Sin arcilla (-9, NaN) o con una clase desconocida no se evalúa
+    registros = _registros(TXT=['loam', 'loam', 'loam', 'loam', 'desconocida'],
+                           CLAY=[20.0, 35.0, -9.0, np.nan, 99.0])
+    df, violaciones = extractor.validar_registros(registros, _regla('textura_arcilla', 'rechazar'))
+
+    assert df['HWSD2_SMU_ID'].tolist() == [1, 3, 4, 5]
+    assert _violaciones(violaciones, 'textura_arcilla') == [(2, 35.0)]
+
+
+def test_sin_violaciones():
+    df, violaciones = extractor.validar_registros(_registros(PH_WATER=[6.5, 7.5]))
+
+    assert len(df) == 2
+    assert len(violaciones) == 0
+    _verificar_esquema(violaciones)